@@ -16,6 +16,8 @@ import pandas as pd
 import matplotlib.gridspec as gridspec
 import matplotlib.patches as patches
 import argparse
+import json
+import multiprocessing as mp
 
 
 #### Now define the functions you're going to use
@@ -38,99 +40,268 @@ def setup_argparser():
     parser.add_argument(dest='data_dir', 
                             type=str,
                             metavar='data_dir',
-                            help='Data directory')
+                            help=('Data directory. This is the DTI directory of one subject,'
+                                    ' or the directory containing SUB_DATA if you give a sublist_file.'
+                                    ' Reports whose input files have not changed since they were'
+                                    ' made are skipped (for one subject as well as a cohort)'
+                                    ' unless you give --force'))
+    
+    # Optional argument: sublist_file
+    parser.add_argument('--sublist_file',
+                            dest='sublist_file',
+                            type=str,
+                            help='File containing a list of subject IDs to make reports for',
+                            default=None,
+                            action='store')
+
+    # Optional argument: DTI identifier
+    parser.add_argument('--dti_id',
+                            dest='dti_id',
+                            type=str,
+                            help='String containing path that defines the DTI directory in subject dir',
+                            default='DTI/MRI0',
+                            action='store')
+
+    # Optional argument: n_jobs
+    parser.add_argument('--n_jobs',
+                            dest='n_jobs',
+                            type=int,
+                            help='number of reports to make at the same time',
+                            default=1,
+                            action='store')
+
+    # Optional argument: force
+    parser.add_argument('--force',
+                            dest='force',
+                            help=('remake reports even if their inputs have not changed'
+                                    ' (by default a report is skipped if the modification'
+                                    ' times and sizes of its inputs match the ones recorded'
+                                    ' in QA_OUTPUT/QAReport_inputs.json)'),
+                            action='store_true',
+                            default=False)
         
     arguments = parser.parse_args()
     
     return arguments, parser
 
 
-def plot_dti_slices(background_file, overlay_file, fig, grid, ax_name_list, cmap='jet'):
+#==============================================================================
+class ImageCache(object):
+    '''
+    Load each image only once for the whole report.
+
+    The data are kept as float32 and shared between all the panels
+    that use them, along with a version scaled by its maximum (for
+    the slice pictures), a binary version (for masks) and the size
+    of the voxels.
+    '''
+    def __init__(self):
+        self.data = {}
+        self.normalised = {}
+        self.masks = {}
+        self.voxel_volumes = {}
+
+    def get(self, filename):
+        # The image data as float32. Only the first volume of a 4D
+        # file is ever used, so only that volume is read (through
+        # nibabel's array proxy) rather than the whole file.
+        if filename not in self.data:
+            img = nib.load(filename)
+            if len(img.shape) == 4:
+                data = img.dataobj[:,:,:,0]
+            else:
+                data = img.dataobj[:,:,:]
+            self.data[filename] = np.asarray(data, dtype=np.float32)
+            self.voxel_volumes[filename] = float(np.prod(img.header.get_zooms()[:3]))
+        return self.data[filename]
+
+    def get_voxel_volume(self, filename):
+        # The volume of one voxel in mm^3
+        if filename not in self.voxel_volumes:
+            self.get(filename)
+        return self.voxel_volumes[filename]
+
+    def get_normalised(self, filename):
+        # The data scaled by its maximum
+        if filename not in self.normalised:
+            data = self.get(filename)
+            self.normalised[filename] = data / data.max()
+        return self.normalised[filename]
+
+    def get_mask(self, filename):
+        # True wherever the image is greater than 0
+        if filename not in self.masks:
+            self.masks[filename] = self.get(filename) > 0
+        return self.masks[filename]
+
+
+#=============================================================================
+def slice_layout(shape, axis_name):
+    '''
+    The number of slices along axis_name and the width and height
+    of each (displayed) slice for a volume of this shape
+    '''
+    X, Y, Z = shape[:3]
+    if axis_name == 'sagittal':
+        return X, Y, Z
+    elif axis_name == 'coronal':
+        return Y, X, Z
+    elif axis_name == 'axial':
+        return Z, X, Y
+
+
+#=============================================================================
+def get_slice(data, axis_name, slice_id):
+    '''
+    Take one slice from a 3D volume and turn it the right way round
+    for display. Only the 2D slice is ever rotated or flipped, never
+    the whole volume. slice_id counts along the axis in display order
+    (coronal slices run from front to back).
+    '''
+    if axis_name == 'sagittal':
+        return np.rot90(data[slice_id,:,:])
+
+    elif axis_name == 'coronal':
+        return np.rot90(data[:,data.shape[1]-1-slice_id,:])
+
+    elif axis_name == 'axial':
+        # Align so that right is right
+        return data[:,:,slice_id].T[::-1,::-1]
+
+
+#=============================================================================
+def colour_lut(cmap, n=256):
+    '''
+    The RGB colour table of a matplotlib colour map
+    '''
+    return plt.get_cmap(cmap)(np.linspace(0, 1, n))[:,:3]
+
+
+#=============================================================================
+def apply_lut(data, lut):
+    '''
+    Look up data (between 0 and 1) in a colour table
+    the same way that imshow does
+    '''
+    n = lut.shape[0]
+    idx = np.clip((data * n).astype(int), 0, n-1)
+    return lut[idx]
+
+
+#=============================================================================
+def slice_mosaic(bg, overlay, axis_name, n_floor, cell_aspect, cmap='jet', alpha=0.3):
+    '''
+    Make one RGB picture of n_floor evenly spaced slices side by side.
+
+    The background is shown in grey and the non-zero parts of the
+    overlay are blended on top (with transparency alpha) in the
+    colours of cmap. Each slice is padded with black so that it fills
+    a cell of width/height cell_aspect, which is how it would sit in
+    its own axis.
+    '''
+    n_slices, width, height = slice_layout(bg.shape, axis_name)
+    slice_ids = [ int(slice_id) for slice_id in np.linspace(0 , n_slices, n_floor+2)[1:-1] ]
+
+    bg_slices = np.array([ get_slice(bg, axis_name, slice_id) for slice_id in slice_ids ])
+    overlay_slices = np.array([ get_slice(overlay, axis_name, slice_id) for slice_id in slice_ids ])
+
+    # Grey background
+    rgb = apply_lut(bg_slices, colour_lut('gray'))
+
+    # Blend in the overlay wherever it isn't 0
+    over = overlay_slices != 0
+    rgb[over] = ( (1 - alpha) * rgb[over]
+                    + alpha * apply_lut(overlay_slices[over], colour_lut(cmap)) )
+
+    # Pad each slice with black to the shape of its cell
+    n, h, w = rgb.shape[:3]
+    pad_w = max(0, int(round(h * cell_aspect)) - w)
+    pad_h = max(0, int(round(w / cell_aspect)) - h)
+    rgb = np.pad(rgb, [ (0, 0),
+                        (pad_h // 2, pad_h - pad_h // 2),
+                        (pad_w // 2, pad_w - pad_w // 2),
+                        (0, 0) ], mode='constant')
+
+    # And put them all side by side
+    return np.hstack(list(rgb))
+
+
+#=============================================================================
+def get_axis(fig, grid, i, axes=None):
+    '''
+    The axis for space i of a grid. If you pass the list of axes
+    that a page template has already made for this grid the axis is
+    reused, otherwise a new one is added to the figure.
+    '''
+    if axes is not None:
+        return axes[i]
+
+    ax = plt.Subplot(fig, grid[i])
+    fig.add_subplot(ax)
+    return ax
+
+
+#=============================================================================
+def plot_dti_slices(background_file, overlay_file, fig, grid, ax_name_list, cmap='jet', cache=None, axes=None):
         
-    # LOAD THE DATA
-    bg_img = nib.load(background_file)
-    bg = bg_img.get_data()
-    if len(bg.shape) == 4:
-        bg = bg[:,:,:,0]
+    if cache is None:
+        cache = ImageCache()
     
-    overlay_img = nib.load(overlay_file)
-    overlay = overlay_img.get_data()
-
-    # Make sure all data is float:
-    bg = bg/1.
-    overlay = overlay/1.
+    # Get the data scaled by its maximum
+    bg = cache.get_normalised(background_file)
+    overlay = cache.get_normalised(overlay_file)
     
-    # Scale the data by its maximum
-    bg = bg / bg.max()
-    overlay = overlay / overlay.max()    
+    fig_width, fig_height = fig.get_size_inches()
         
     # Now we're going to loop through the different slice orientations
+    # and show all the slices for each one as a single picture
 
     for i, axis_name in enumerate(ax_name_list):
-        if axis_name == 'axial':
-            # Align so that right is right
-            overlay_plot = np.rot90(overlay)
-            overlay_plot = np.fliplr(overlay_plot)
-            bg_plot = np.rot90(bg)
-            bg_plot = np.fliplr(bg_plot)
-    
-        elif axis_name == 'coronal':
-            overlay_plot = np.rot90(overlay)
-            bg_plot = np.rot90(bg)
-            overlay_plot = np.flipud(np.swapaxes(overlay_plot, 0, 2))
-            bg_plot = np.flipud(np.swapaxes(bg_plot, 0, 2))
-
-        elif axis_name == 'sagittal':
-            overlay_plot = np.flipud(np.swapaxes(overlay, 0, 2))
-            bg_plot = np.flipud(np.swapaxes(bg, 0, 2))
+        n_slices, width, height = slice_layout(bg.shape, axis_name)
 
-        n = ( np.float(bg_plot.shape[1])/bg_plot.shape[2] ) * (np.float(figsize[0])/ (0.15 * figsize[1]))
+        n = ( float(width)/n_slices ) * (float(fig_width)/ (0.15 * fig_height))
 
-        n_floor = np.int(np.floor(n))
+        n_floor = int(np.floor(n))
         
-        inner_grid = gridspec.GridSpecFromSubplotSpec(1, n_floor,
-                         subplot_spec=grid[i], wspace=0.0, hspace=0.0)
+        # The shape of the space each slice has
+        pos = grid[i].get_position(fig)
+        cell_aspect = (pos.width * fig_width / n_floor) / (pos.height * fig_height)
         
-        for j, slice_id in enumerate(np.linspace(0 , bg_plot.shape[2], n_floor+2)[1:-1]):
+        mosaic = slice_mosaic(bg, overlay, axis_name, n_floor, cell_aspect, cmap=cmap)
         
-            bg_slice = bg_plot[:,:,slice_id]
-            overlay_slice = overlay_plot[:,:,slice_id]
-            
-            ax = plt.Subplot(fig, inner_grid[j])
-            fig.add_subplot(ax)
+        ax = get_axis(fig, grid, i, axes)
 
-            # Add a black background
-            black = ax.imshow(np.ones_like(bg_slice),
-                                    interpolation='none',
-                                    cmap='gray')
-            
-            # Mask the data
-            m_overlay_slice = np.ma.masked_where(overlay_slice==0, overlay_slice)
-
-            # First show the background slice
-            im1 = ax.imshow(bg_slice,
-                                interpolation='none',
-                                cmap='gray',
-                                vmin = 0,
-                                vmax = 1)
-    
-            # Then overlay the overlay_slice
-            im2 = ax.imshow(m_overlay_slice,
-                                interpolation='none',
-                                cmap=cmap,
-                                vmin = 0,
-                                vmax = 1,
-                                alpha = 0.3)
+        # Swap the picture if the axis already has one
+        if ax.images:
+            ax.images[0].set_data(mosaic)
+            ax.images[0].set_extent((-0.5, mosaic.shape[1]-0.5, mosaic.shape[0]-0.5, -0.5))
+        else:
+            ax.imshow(mosaic,
+                        interpolation='none',
+                        aspect='auto')
                
-            # Turn off axis labels
-            ax.get_xaxis().set_visible(False)
-            ax.get_yaxis().set_visible(False)
-            ax.set_frame_on(False)
+        # Turn off axis labels
+        ax.get_xaxis().set_visible(False)
+        ax.get_yaxis().set_visible(False)
+        ax.set_frame_on(False)
             
     return fig
 
 #=============================================================================
-def plot_movement_params(dti_dir, fig, grid):
+def read_disp(dti_dir, suffix):
+    '''
+    Read in the absolute and relative displacements for a group of volumes
+    (suffix is '', '_b0' or '_notb0'). Volumes that aren't in the group
+    are marked with a '.' and come out as NaN.
+    '''
+    disp = pd.read_csv(os.path.join(dti_dir, 'ec_disp{}.txt'.format(suffix)),
+                        delimiter=' ', header=None,
+                        names=['abs'+suffix, 'rel'+suffix], na_values='.')
+    return disp
+
+
+#=============================================================================
+def plot_movement_params(dti_dir, fig, grid, axes=None):
     measures = ['abs', 'rel']
     measure_suffixes = [ '', '_b0', '_notb0' ]
     
@@ -139,13 +310,11 @@ def plot_movement_params(dti_dir, fig, grid):
     # and find the data from each of thoese files
     for i, suffix in enumerate(measure_suffixes):
         
-        ax = plt.Subplot(fig, grid[i])
-        fig.add_subplot(ax)
+        ax = get_axis(fig, grid, i, axes)
+        ax.cla()
 
         # Read in the files
-        disp = pd.read_csv(os.path.join(dti_dir, 'ec_disp{}.txt'.format(suffix)),
-                            delimiter=' ', header=None,
-                            names=['abs'+suffix, 'rel'+suffix], na_values='.')
+        disp = read_disp(dti_dir, suffix)
 
         # Loop through the three different values that you want to know
         # for the two different measures (abs and rel)
@@ -177,29 +346,26 @@ def plot_movement_params(dti_dir, fig, grid):
 
 
 #=============================================================================
-def tensor_histogram(fa_file, mo_file, sse_file, wm_mask_file, fig, grid):
+def tensor_histogram(fa_file, mo_file, sse_file, wm_mask_file, fig, grid, cache=None, axes=None):
     
-    # Load in the data
-    fa_img = nib.load(fa_file)
-    fa = fa_img.get_data()
-    mo_img = nib.load(mo_file)
-    mo = mo_img.get_data()
-    sse_img = nib.load(sse_file)
-    sse = sse_img.get_data()
+    if cache is None:
+        cache = ImageCache()
     
-    wm_mask_img = nib.load(wm_mask_file)
-    wm_mask = wm_mask_img.get_data()
-    wm_mask[wm_mask>0] = 1
+    # Get the data
+    fa = cache.get(fa_file)
+    mo = cache.get(mo_file)
+    sse = cache.get(sse_file)
+    wm_mask = cache.get_mask(wm_mask_file)
     
-    # Mask the fa data with the white matter mask
-    # so we're only looking inside the mask
-    fa = fa * wm_mask
+    # Only look at voxels inside the white matter mask
+    # that have an FA value
+    in_wm = wm_mask & (fa > 0)
     
     # Add a subplot to the first space in the grid
     # and enter a histogram of FA values
-    ax = plt.Subplot(fig, grid[0])
-    fig.add_subplot(ax)    
-    ax.hist(fa[fa>0].reshape(-1), bins=np.linspace(0,1,100), color='green',histtype='stepfilled')
+    ax = get_axis(fig, grid, 0, axes)
+    ax.cla()
+    ax.hist(fa[in_wm], bins=np.linspace(0,1,100), color='green',histtype='stepfilled')
     # Label the x axis:
     ax.set_xlabel('Fractional Anisotropy')
     # Set the y axis to always between 0 and 2500
@@ -213,9 +379,9 @@ def tensor_histogram(fa_file, mo_file, sse_file, wm_mask_file, fig, grid):
     
     # Add a subplot to the second space in the grid
     # and plot a histogram of mode values
-    ax = plt.Subplot(fig, grid[1])
-    fig.add_subplot(ax)    
-    ax.hist(mo[fa>0].reshape(-1), bins=np.linspace(-1,1,100), color='orange', histtype='stepfilled')
+    ax = get_axis(fig, grid, 1, axes)
+    ax.cla()
+    ax.hist(mo[in_wm], bins=np.linspace(-1,1,100), color='orange', histtype='stepfilled')
     # Label the x axes:
     ax.set_xlabel('Mode of Anisotropy')
     # Set the y axis to always between 0 and 3500
@@ -232,9 +398,9 @@ def tensor_histogram(fa_file, mo_file, sse_file, wm_mask_file, fig, grid):
     # The y-axis is therefore limited so that the histogram highlights
     # "bad" fit voxels.
 
-    ax = plt.Subplot(fig, grid[2])
-    fig.add_subplot(ax)    
-    ax.hist(sse[fa>0].reshape(-1), bins=np.linspace(0,5,100), color='red', histtype='stepfilled')
+    ax = get_axis(fig, grid, 2, axes)
+    ax.cla()
+    ax.hist(sse[in_wm], bins=np.linspace(0,5,100), color='red', histtype='stepfilled')
     # Label the x axis:
     ax.set_xlabel('Sum of Square Errors')
     # Set the y axis to always between 0 and 3500
@@ -243,6 +409,69 @@ def tensor_histogram(fa_file, mo_file, sse_file, wm_mask_file, fig, grid):
     return fig
 
 
+#=============================================================================
+def qa_metrics(files, dti_dir, cache=None, sse_threshold=1.0):
+    '''
+    Summary numbers for the report so that a whole cohort can be
+    checked without looking at every picture:
+
+        * percentiles of FA, MO and SSE inside the white matter mask
+        * the fraction of those voxels with an SSE above sse_threshold
+        * the number of voxels and volume (mm^3) of the brain and
+          white matter masks
+        * the SNR of the first (b0) volume: the mean inside the brain
+          divided by the standard deviation outside it
+        * the mean and maximum absolute and relative displacements
+          for all, b0 and diffusion weighted volumes
+    '''
+    if cache is None:
+        cache = ImageCache()
+
+    metrics = {}
+
+    fa = cache.get(files['fa'])
+    wm_mask = cache.get_mask(files['wm_mask'])
+    in_wm = wm_mask & (fa > 0)
+
+    # Tensor values in the white matter
+    percentiles = [ 5, 25, 50, 75, 95 ]
+    for name in [ 'fa', 'mo', 'sse' ]:
+        values = cache.get(files[name])[in_wm]
+        for p, value in zip(percentiles, np.percentile(values, percentiles)):
+            metrics['{}_p{:02d}'.format(name, p)] = float(value)
+        metrics['{}_mean'.format(name)] = float(values.mean())
+
+    sse = cache.get(files['sse'])[in_wm]
+    metrics['sse_high_fraction'] = float((sse > sse_threshold).mean())
+    metrics['sse_threshold'] = sse_threshold
+
+    # Mask sizes
+    for name in [ 'mask', 'wm_mask' ]:
+        n_voxels = int(cache.get_mask(files[name]).sum())
+        metrics['{}_voxels'.format(name)] = n_voxels
+        metrics['{}_mm3'.format(name)] = n_voxels * cache.get_voxel_volume(files[name])
+
+    # b0 signal to noise
+    b0 = cache.get(files['dti'])
+    brain = cache.get_mask(files['mask'])
+    metrics['b0_snr'] = float(b0[brain].mean() / b0[~brain].std())
+
+    # Movement
+    for suffix in [ '', '_b0', '_notb0' ]:
+        disp = read_disp(dti_dir, suffix)
+        for measure in [ 'abs', 'rel' ]:
+            values = disp[measure+suffix].dropna()
+            metrics['{}{}_mean'.format(measure, suffix)] = float(values.mean())
+            metrics['{}{}_max'.format(measure, suffix)] = float(values.max())
+
+    # JSON has no NaN or inf, so those are written as null
+    for key, value in metrics.items():
+        if isinstance(value, float) and not np.isfinite(value):
+            metrics[key] = None
+
+    return metrics
+
+
 #=============================================================================
 def add_background(fig, grid):
     ax = plt.Subplot(fig, grid[0])
@@ -296,86 +525,242 @@ def add_header(fig, grid):
 
 
 #=============================================================================
+def report_files(data_dir):
+    '''
+    All the files that go into the report for one DTI directory
+    '''
+    files = {}
+
+    # These files should have been created by dti_preprocessing.sh
+    files['dti'] = os.path.join(data_dir, 'dti_ec.nii.gz')
+    files['bvals'] = os.path.join(data_dir, 'bvals')
+    files['bvecs'] = os.path.join(data_dir, 'bvecs')
+    files['mask'] = os.path.join(data_dir, 'dti_ec_brain_mask.nii.gz')
+    for measure in [ 'FA', 'MO', 'sse' ]:
+        fdt_files = glob(os.path.join(data_dir, 'FDT', '*_{}.nii.gz'.format(measure)))
+        if not fdt_files:
+            raise IOError('No {} map in {}'.format(measure, os.path.join(data_dir, 'FDT')))
+        files[measure.lower()] = fdt_files[0]
+    for suffix in [ '', '_b0', '_notb0' ]:
+        files['ec_disp'+suffix] = os.path.join(data_dir, 'ec_disp{}.txt'.format(suffix))
+
+    # These files may not yet exist! They probably should!
+    files['dti_vol0'] = os.path.join(data_dir, 'dti_ec_brain.nii.gz')
+    files['wm_mask'] = os.path.join(data_dir, 'wm_DTIspace_mask.nii.gz')
+
+    return files
+
+
+#=============================================================================
+def file_stats(files):
+    '''
+    The modification time and size of each file (None if it's missing)
+    '''
+    stats = {}
+    for f in files.values():
+        if os.path.exists(f):
+            stats[f] = [ os.path.getmtime(f), os.path.getsize(f) ]
+        else:
+            stats[f] = None
+    return stats
+
+
+#=============================================================================
+def report_is_current(qa_dir, files):
+    '''
+    True if the report and metrics exist and none of their inputs
+    have changed since they were made
+    '''
+    for filename in [ 'QAReport.jpg', 'QAMetrics.json', 'QAReport_inputs.json' ]:
+        if not os.path.exists(os.path.join(qa_dir, filename)):
+            return False
+
+    inputs_filename = os.path.join(qa_dir, 'QAReport_inputs.json')
+
+    with open(inputs_filename) as f:
+        old_stats = json.load(f)
+
+    return old_stats == file_stats(files)
+
+
 #=============================================================================
-# Define the files you're going to need
+def build_report_template():
+    '''
+    Set up everything on the page that is the same for every subject:
+    the grids, the header, the black backgrounds and empty axes for
+    all the data. Returns the figure, the grids and the axes.
+    '''
+    # Create a figure that's the same size as an A4 piece of paper
+    figsize = (8.3,11.6)
+    fig = plt.figure(figsize = figsize)
 
-# Read in the arguments from argparse
-arguments, parser = setup_argparser()
+    grids = {}
 
-data_dir = arguments.data_dir
+    # Now set up the plotting areas using GridSpec 
+    # Header grid - to contain the header at the top of the page
+    grids['header'] = gridspec.GridSpec(1,1)
+    grids['header'].update(left=0.05, right=0.95, top = 0.98, bottom = 0.9)
 
-# Define the output directory and make it if it doesn't yet exist
-qa_dir = os.path.join(data_dir, 'QA_OUTPUT')
-if not os.path.isdir(qa_dir):
-    os.makedirs(qa_dir)
+    # Background A - to go behind brain_grid A
+    grids['bgA'] = gridspec.GridSpec(1, 1)
+    grids['bgA'].update(left=0.05, right=0.95, top = 0.9, bottom = 0.65)
 
-# These files should have been created by dti_preprocessing.sh
-dti_file = os.path.join(data_dir, 'dti_ec.nii.gz')
-bvals_file = os.path.join(data_dir, 'bvals')
-bvecs_file = os.path.join(data_dir, 'bvecs')
-mask_file = os.path.join(data_dir, 'dti_ec_brain_mask.nii.gz')
-fa_file = glob(os.path.join(data_dir, 'FDT', '*_FA.nii.gz'))[0]
-mo_file = glob(os.path.join(data_dir, 'FDT', '*_MO.nii.gz'))[0]
-sse_file = glob(os.path.join(data_dir, 'FDT', '*_sse.nii.gz'))[0]
+    # Brain grid A - non-diffusion weighted image and brain mask
+    grids['brainA'] = gridspec.GridSpec(3, 1)
+    grids['brainA'].update(left=0.05, right=0.95, top = 0.9, bottom = 0.65)
 
-# These files may not yet exist! They probably should!
-dti_vol0_file = os.path.join(data_dir, 'dti_ec_brain.nii.gz')
-wm_mask_file = os.path.join(data_dir, 'wm_DTIspace_mask.nii.gz')
+    # Movement grid - movement and eddy_correct realignment parameters 
+    grids['movement'] = gridspec.GridSpec(1, 3)
+    grids['movement'].update(left=0.1, right=0.95, top = 0.63, bottom = 0.5, wspace=0.2)
 
+    # Background B - to go behind brain_grid B
+    grids['bgB'] = gridspec.GridSpec(1, 1)
+    grids['bgB'].update(left=0.05, right=0.95, top = 0.45, bottom = 0.2)
 
-#### Now actually run the code
+    # Brain grid B - FA image and white matter mask
+    grids['brainB'] = gridspec.GridSpec(3, 1)
+    grids['brainB'].update(left=0.05, right=0.95, top = 0.45, bottom = 0.2)
 
-# Create a figure that's the same size as an A4 piece of paper
+    # Histogram grid - histograms of FA, MO, and sum of square errors
+    grids['hist'] = gridspec.GridSpec(1, 3)
+    grids['hist'].update(left=0.1, right=0.95, top = 0.18, bottom = 0.05, wspace=0.2)
 
-figsize = (8.3,11.6)
-fig = plt.figure(figsize = figsize)
+    # The static parts of the page
+    fig = add_header(fig, grids['header'])
+    fig = add_background(fig, grids['bgA'])
 
+    # Empty axes for the data (added in the same order as before so
+    # that they're drawn in the same order)
+    axes = {}
+    axes['brainA'] = [ get_axis(fig, grids['brainA'], i) for i in range(3) ]
+    axes['movement'] = [ get_axis(fig, grids['movement'], i) for i in range(3) ]
+    fig = add_background(fig, grids['bgB'])
+    axes['brainB'] = [ get_axis(fig, grids['brainB'], i) for i in range(3) ]
+    axes['hist'] = [ get_axis(fig, grids['hist'], i) for i in range(3) ]
 
-# Now set up the plotting areas using GridSpec 
-# Header grid - to contain the header at the top of the page
-header_grid = gridspec.GridSpec(1,1)
-header_grid.update(left=0.05, right=0.95, top = 0.98, bottom = 0.9)
+    return fig, grids, axes
 
-# Background A - to go behind brain_grid A
-bgA_grid = gridspec.GridSpec(1, 1)
-bgA_grid.update(left=0.05, right=0.95, top = 0.9, bottom = 0.65)
 
-# Brain grid A - non-diffusion weighted image and brain mask
-brainA_grid = gridspec.GridSpec(3, 1)
-brainA_grid.update(left=0.05, right=0.95, top = 0.9, bottom = 0.65)
+#=============================================================================
+def make_report(data_dir, template=None, force=False):
+    '''
+    Make the QAReport.jpg and QAMetrics.json for one DTI directory.
+    Pass a template from build_report_template to reuse the same page
+    for many subjects.
+    Returns False if the report was already up to date.
+    '''
+    files = report_files(data_dir)
 
-# Movement grid - movement and eddy_correct realignment parameters 
-movement_grid = gridspec.GridSpec(1, 3)
-movement_grid.update(left=0.1, right=0.95, top = 0.63, bottom = 0.5, wspace=0.2)
+    # Define the output directory and make it if it doesn't yet exist
+    qa_dir = os.path.join(data_dir, 'QA_OUTPUT')
+    if not os.path.isdir(qa_dir):
+        os.makedirs(qa_dir)
 
-# Background B - to go behind brain_grid B
-bgB_grid = gridspec.GridSpec(1, 1)
-bgB_grid.update(left=0.05, right=0.95, top = 0.45, bottom = 0.2)
+    if not force and report_is_current(qa_dir, files):
+        return False
 
-# Brain grid B - FA image and white matter mask
-brainB_grid = gridspec.GridSpec(3, 1)
-brainB_grid.update(left=0.05, right=0.95, top = 0.45, bottom = 0.2)
+    if template is None:
+        template = build_report_template()
+    fig, grids, axes = template
 
-# Histogram grid - histograms of FA, MO, and sum of square errors
-hist_grid = gridspec.GridSpec(1, 3)
-hist_grid.update(left=0.1, right=0.95, top = 0.18, bottom = 0.05, wspace=0.2)
+    # Fill in these plotting areas using the functions defined above
+    # sharing one cache so that each image is only loaded once
+    cache = ImageCache()
 
+    fig = plot_dti_slices(files['dti_vol0'], files['mask'], fig, grids['brainA'],
+                            ['sagittal', 'coronal', 'axial'], cmap='cool_r',
+                            cache=cache, axes=axes['brainA'])
+    fig = plot_movement_params(data_dir, fig, grids['movement'], axes=axes['movement'])
+    fig = plot_dti_slices(files['fa'], files['wm_mask'], fig, grids['brainB'],
+                            ['sagittal', 'coronal', 'axial'], cmap='cool',
+                            cache=cache, axes=axes['brainB'])
+    fig = tensor_histogram(files['fa'], files['mo'], files['sse'], files['wm_mask'],
+                            fig, grids['hist'], cache=cache, axes=axes['hist'])
 
-# Fill in these plotting areas using the functions defined above
+    # Finally, save the figure
+    report_filename = os.path.join(qa_dir, 'QAReport.jpg')
+    fig.savefig(report_filename, bbox_inches=0, dpi=300)
 
-fig = add_header(fig, header_grid)
-fig = add_background(fig, bgA_grid)
-fig = plot_dti_slices(dti_vol0_file, mask_file, fig, brainA_grid, ['sagittal', 'coronal', 'axial'], cmap='cool_r')
-fig = plot_movement_params(data_dir, fig, movement_grid)
-fig = add_background(fig, bgB_grid)
-fig = plot_dti_slices(fa_file, wm_mask_file, fig, brainB_grid, ['sagittal', 'coronal', 'axial'], cmap='cool')
-fig = tensor_histogram(fa_file, mo_file, sse_file, wm_mask_file, fig, hist_grid)
+    # Along with the numbers, using the same data
+    metrics = qa_metrics(files, data_dir, cache=cache)
+    with open(os.path.join(qa_dir, 'QAMetrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=4, sort_keys=True)
 
+    # And keep a record of the inputs so we know if it needs remaking
+    with open(os.path.join(qa_dir, 'QAReport_inputs.json'), 'w') as f:
+        json.dump(file_stats(files), f)
 
-# Finally, save the figure
+    return True
 
-report_filename = os.path.join(qa_dir, 'QAReport.jpg')
-fig.savefig(report_filename, bbox_inches=0, dpi=300)
+
+#=============================================================================
+# Each worker process builds its page template once
+_template = None
+
+def _init_worker():
+    global _template
+    _template = build_report_template()
+
+def _report_worker(task):
+    # A subject with missing or broken files shouldn't stop the
+    # rest of the cohort, so any error is passed back as a message
+    data_dir, force = task
+    try:
+        made = make_report(data_dir, template=_template, force=force)
+    except Exception as e:
+        return data_dir, 'failed', '{}: {}'.format(type(e).__name__, e)
+    if made:
+        return data_dir, 'made', None
+    return data_dir, 'current', None
+
+
+#=============================================================================
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    data_dir = arguments.data_dir
+
+    if arguments.sublist_file is None:
+        # Just the one subject
+        if make_report(data_dir, force=arguments.force):
+            print('Made report for {}'.format(data_dir))
+        else:
+            print('Report already up to date for {} (use --force to remake it)'.format(data_dir))
+
+    else:
+        # A whole cohort: find all the subjects' DTI dirs
+        sublist = [ sub.strip() for sub in open(arguments.sublist_file) if sub.strip() ]
+        dti_dir_list = []
+        for sub in sublist:
+            dti_dir_list.extend(glob(os.path.join(data_dir, 'SUB_DATA', sub, arguments.dti_id)))
+
+        tasks = [ (dti_dir, arguments.force) for dti_dir in dti_dir_list ]
+
+        if arguments.n_jobs > 1:
+            pool = mp.Pool(arguments.n_jobs, initializer=_init_worker)
+            results = pool.imap_unordered(_report_worker, tasks)
+        else:
+            _init_worker()
+            results = map(_report_worker, tasks)
+
+        failed = []
+        for dti_dir, status, error in results:
+            if status == 'made':
+                print('Made report for {}'.format(dti_dir))
+            elif status == 'current':
+                print('Report already up to date for {}'.format(dti_dir))
+            else:
+                print('FAILED to make report for {} ({})'.format(dti_dir, error))
+                failed.append(dti_dir)
+
+        if arguments.n_jobs > 1:
+            pool.close()
+            pool.join()
+
+        if failed:
+            print('{} of {} reports failed'.format(len(failed), len(tasks)))
 
 
 # **That's it! You're done :)**
@@ -9,7 +9,12 @@ import pandas as pd
 import matplotlib as mpl
 import itertools as it
 import argparse
-from boxplot_dti_movement import boxplot_dti_movement
+import json
+import copy
+import sqlite3
+import warnings
+from multiprocessing.pool import ThreadPool
+from boxplot_dti_movement import boxplot_dti_movement, iqr_fliers
 
 #==============================================================================
 def setup_argparser():
@@ -17,111 +22,293 @@ def setup_argparser():
     # CODE TO READ ARGUMENTS FROM THE COMMAND LINE AND SET OPTIONS
     # ALSO INCLUDES SOME HELP TEXT
     '''
-    
+
     # Build a basic parser.
     help_text = ('Create a quality control report for a bunch of DTI directories')
-    
+
     sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
-    
+
     parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
-    
+
     # Now add the arguments
     # Required argument: data_dir
-    parser.add_argument(dest='data_dir', 
+    parser.add_argument(dest='data_dir',
                             type=str,
                             metavar='data_dir',
                             help='Data directory')
-    
+
     # Required argument: sublist_file
-    parser.add_argument(dest='sublist_file', 
+    parser.add_argument(dest='sublist_file',
                             type=str,
                             metavar='sublist_file',
                             help='File containing a list of subject IDs')
 
     # Required argument: DTI identifier
-    parser.add_argument(dest='dti_id', 
+    parser.add_argument(dest='dti_id',
                             type=str,
                             metavar='dti_id',
                             help='String containing path that defines the DTI directory in subject dir')
-    
+
+    # Optional argument: n_jobs
+    parser.add_argument('--n_jobs',
+                            dest='n_jobs',
+                            type=int,
+                            help='number of threads used to read the motion files',
+                            default=8,
+                            action='store')
+
+    # Optional argument: plot_iterations
+    parser.add_argument('--plot_iterations',
+                            dest='plot_iterations',
+                            type=int,
+                            nargs='*',
+                            help=('outlier removal iterations to make boxplots for'
+                                    ' (0 is the boxplot of all the subjects)'),
+                            default=[0],
+                            action='store')
+
     arguments = parser.parse_args()
-    
+
     return arguments, parser
 
 
 ### DEFINE SOME VARIABLES ###
-# Read in the arguments from argparse
-arguments, parser = setup_argparser()
-
-data_dir = arguments.data_dir
-dti_id = arguments.dti_id
-
-# Read in the subjects into a sublist (list) 
-sublist = np.loadtxt(arguments.sublist_file, dtype='string')
+# The two measures (abs and rel) and the groups of volumes that
+# are considered (all, b0 and not b0) for each of them
+measures = ['abs', 'rel']
+measure_suffixes = [ '', '_b0', '_notb0' ]
 
-# Define the output directory and make it if it doesn't yet exist
-qa_dir = os.path.join(data_dir, 'QA_OUTPUT')
-if not os.path.isdir(qa_dir):
-    os.makedirs(qa_dir)
+# The columns of the motion table, one for each ec_disp file column
+disp_columns = [ measure+suffix for suffix in measure_suffixes for measure in measures ]
 
-### SET UP A DATA FRAME ###
 
-# Create an empty dti_dir_list. This will make it easier for you to loop through all the
-# subjects - you'll loop through this list instead of the subjects and have to add the dti identifier
-# in each time
-dti_dir_list = []
+#==============================================================================
+def motion_files(dti_dir):
+    '''
+    The three ec_disp files and the bvals file for a DTI directory
+    '''
+    files = [ os.path.join(dti_dir, 'ec_disp{}.txt'.format(suffix))
+                for suffix in measure_suffixes ]
+    files.append(os.path.join(dti_dir, 'bvals'))
+    return files
 
-# Fill up the dti_dir_list with all the subjects' DTI dirs
-for sub in sublist:
-    dti_dir_list.append(glob(os.path.join(data_dir, 'SUB_DATA', sub, dti_id))[0])
-    
-# Generate an empty data frame for the subject data
-# Define the columns
-columns = ['subid', 'dirname']
 
-# Loop through the measures and the groups of volumes that are considered
-# and add these names to the columns list
-measures = ['abs', 'rel']
-measure_suffixes = [ '', '_b0', '_notb0' ]
-for measure, suffix in it.product(measures, measure_suffixes):
-    columns.append('mean_rms_'+measure+suffix)
-    columns.append('std_rms_'+measure+suffix)
-    columns.append('max_rms_'+measure+suffix)
-
-# Now create the empty data frame    
-subs_df = pd.DataFrame(index=range(len(dti_dir_list)),
-                        columns=columns)
-
-### FILL IN THE DATA ###
-
-# Loop through the subjects
-for i, (sub, dti_dir) in enumerate(zip(sublist, dti_dir_list)):
-    # Write the subject id and the dirname into the first two columns of the subs_df
-    subs_df.ix[i, 'dirname'] = dti_dir
-    subs_df.ix[i, 'subid'] = sub
-    
-    # Loop through the measure suffixes ('', '_b0', '_notb0')
-    # which you can think of as the groups of volumes that are being considered
-    # and find the data from each of thoese files
+#==============================================================================
+def read_subject_motion(dti_dir):
+    '''
+    Read the displacements for one subject into an (n_vols, 7) array:
+    the six disp_columns followed by the bval of each volume.
+    Volumes that aren't in a group are marked with a '.' and are NaN.
+    '''
+    columns = []
     for suffix in measure_suffixes:
-        
-        # Read in the files and add the mean and standard deviations to your subs_df
         disp = pd.read_csv(os.path.join(dti_dir, 'ec_disp{}.txt'.format(suffix)),
                             delimiter=' ', header=None,
                             names=['abs'+suffix, 'rel'+suffix], na_values='.')
+        columns.append(disp.values.astype(float))
+
+    n_vols = columns[0].shape[0]
+    bvals = np.loadtxt(os.path.join(dti_dir, 'bvals')).reshape(-1)[:n_vols]
+
+    return np.column_stack(columns + [bvals])
+
+
+#==============================================================================
+def summary_columns():
+    '''
+    The names of the per subject summary columns (eg: mean_rms_abs_notb0)
+    in the same order as the subs_df columns
+    '''
+    return [ '{}_rms_{}{}'.format(stat, measure, suffix)
+                for measure, suffix in it.product(measures, measure_suffixes)
+                for stat in [ 'mean', 'std', 'max' ] ]
+
+
+#==============================================================================
+def open_motion_store(db_name):
+    '''
+    Open (or create) the cohort motion database. It has two tables:
+    subjects, with the DTI dir, the modification times of its motion
+    files and the summary measures for each subject, and volumes, with
+    the displacements and bval of every volume.
+    '''
+    con = sqlite3.connect(db_name)
+
+    con.execute('CREATE TABLE IF NOT EXISTS subjects '
+                    '(subid TEXT, dti_id TEXT, dirname TEXT, mtimes TEXT, {}, '
+                    'PRIMARY KEY (subid, dti_id))'.format(
+                        ', '.join([ '{} REAL'.format(col) for col in summary_columns() ])))
+    con.execute('CREATE TABLE IF NOT EXISTS volumes '
+                    '(dirname TEXT, vol INTEGER, {}, bval REAL)'.format(
+                        ', '.join([ '{} REAL'.format(col) for col in disp_columns ])))
+    con.execute('CREATE INDEX IF NOT EXISTS volumes_dirname ON volumes (dirname)')
+
+    return con
+
+
+#==============================================================================
+def update_motion_store(con, data_dir, sublist, dti_id, n_jobs=8):
+    '''
+    Bring the motion database up to date for the subjects in sublist.
+
+    The DTI dir of a subject that's already in the database is only
+    looked for again if it has gone, and their files are only read
+    again (in a pool of threads) if any of their modification times
+    have changed, so the time this takes depends on how much new data
+    there is rather than the size of the cohort.
+
+    Returns the list of DTI dirs (in the same order as sublist) and
+    the list of those that were read.
+    '''
+    known = {}
+    for subid, dirname, mtimes in con.execute('SELECT subid, dirname, mtimes FROM subjects '
+                                                'WHERE dti_id = ?', (dti_id,)):
+        known[subid] = (dirname, mtimes)
+
+    dti_dir_list = []
+    to_read = []
+    for sub in sublist:
+        dirname = known.get(sub, (None, None))[0]
+        if dirname is None or not os.path.isdir(dirname):
+            dirname = glob(os.path.join(data_dir, 'SUB_DATA', sub, dti_id))[0]
+        dti_dir_list.append(dirname)
+
+        mtimes = json.dumps([ os.path.getmtime(f) for f in motion_files(dirname) ])
+        if known.get(sub) != (dirname, mtimes):
+            to_read.append((sub, dirname, mtimes))
+
+    if len(to_read) == 0:
+        return dti_dir_list, []
+
+    pool = ThreadPool(n_jobs)
+    arrays = pool.map(read_subject_motion, [ dirname for sub, dirname, mtimes in to_read ])
+    pool.close()
+    pool.join()
+
+    # Summarise the new data
+    motion = motion_table_from_arrays(arrays)
+    subs_df = motion_summary(motion,
+                                [ sub for sub, dirname, mtimes in to_read ],
+                                [ dirname for sub, dirname, mtimes in to_read ])
+    cols = summary_columns()
+
+    for i, ((sub, dirname, mtimes), values) in enumerate(zip(to_read, arrays)):
+        # Remove the old volumes, including any from where the
+        # subject's DTI dir used to be
+        old_dirname = known.get(sub, (None, None))[0]
+        if old_dirname is not None and old_dirname != dirname:
+            con.execute('DELETE FROM volumes WHERE dirname = ?', (old_dirname,))
+        con.execute('DELETE FROM volumes WHERE dirname = ?', (dirname,))
+        con.executemany('INSERT INTO volumes VALUES ({})'.format(', '.join(['?'] * (values.shape[1] + 2))),
+                        [ [ dirname, vol ] + [ None if np.isnan(x) else float(x) for x in row ]
+                            for vol, row in enumerate(values) ])
+        con.execute('INSERT OR REPLACE INTO subjects VALUES ({})'.format(', '.join(['?'] * (len(cols) + 4))),
+                        [ sub, dti_id, dirname, mtimes ]
+                        + [ None if np.isnan(x) else float(x) for x in subs_df.loc[i, cols] ])
+    con.commit()
+
+    return dti_dir_list, [ dirname for sub, dirname, mtimes in to_read ]
+
+
+#==============================================================================
+def load_motion_store(con, sublist, dti_id):
+    '''
+    Read the summaries (subs_df) and the long table of displacements
+    (with a row for every volume) for the subjects in sublist from the
+    motion database. The sub column of the long table is the row of
+    subs_df that the volume belongs to.
+
+    The subjects are put in a temporary table and joined to the
+    others, so only their rows are read out of the database.
+    '''
+    con.execute('DROP TABLE IF EXISTS temp.wanted')
+    con.execute('CREATE TEMP TABLE wanted (subid TEXT PRIMARY KEY)')
+    con.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [ (sub,) for sub in sublist ])
+
+    subjects = pd.read_sql_query('SELECT subjects.* FROM subjects '
+                                    'JOIN wanted ON subjects.subid = wanted.subid '
+                                    'WHERE subjects.dti_id = ?', con,
+                                    params=(dti_id,))
+    subjects = subjects.set_index('subid').reindex(list(sublist))
+
+    subs_df = pd.DataFrame({ 'subid' : list(sublist),
+                             'dirname' : subjects['dirname'].values },
+                            columns=['subid', 'dirname'])
+    for col in summary_columns():
+        subs_df[col] = subjects[col].values.astype(float)
+
+    volumes = pd.read_sql_query('SELECT volumes.* FROM volumes '
+                                    'JOIN subjects ON volumes.dirname = subjects.dirname '
+                                    'JOIN wanted ON subjects.subid = wanted.subid '
+                                    'WHERE subjects.dti_id = ?', con,
+                                    params=(dti_id,))
+    con.execute('DROP TABLE temp.wanted')
+
+    sub_index = pd.Series(np.arange(len(sublist)), index=subs_df['dirname'].values)
+    volumes.insert(0, 'sub', sub_index[volumes['dirname'].values].values)
+    motion = volumes.drop('dirname', axis=1).sort_values(['sub', 'vol']).reset_index(drop=True)
+    motion[disp_columns + ['bval']] = motion[disp_columns + ['bval']].astype(float)
+
+    return subs_df, motion
+
+
+#==============================================================================
+def motion_table_from_arrays(arrays):
+    '''
+    Put the (n_vols, 7) arrays from read_subject_motion together into
+    one long data frame with a row for every volume of every subject
+    (columns: sub, vol, the six disp_columns and bval)
+    '''
+    n_vols = [ a.shape[0] for a in arrays ]
+    motion = pd.DataFrame(np.vstack(arrays), columns=disp_columns + ['bval'])
+    motion.insert(0, 'vol', np.concatenate([ np.arange(n) for n in n_vols ]))
+    motion.insert(0, 'sub', np.repeat(np.arange(len(arrays)), n_vols))
+    return motion
+
+
+#==============================================================================
+def motion_summary(motion, sublist, dti_dir_list):
+    '''
+    The mean, standard deviation and maximum of every displacement
+    column for every subject, all from one groupby. The columns are
+    named (eg) mean_rms_abs_notb0.
+    '''
+    stats = motion.groupby('sub')[disp_columns].agg(['mean', 'std', 'max'])
+    stats = stats.reindex(range(len(dti_dir_list)))
+
+    subs_df = pd.DataFrame({ 'subid' : list(sublist),
+                             'dirname' : list(dti_dir_list) },
+                            columns=['subid', 'dirname'])
 
+    for col in summary_columns():
+        stat, rest = col.split('_rms_')
+        subs_df[col] = stats[(rest, stat)].values
+
+    return subs_df
+
+
+#==============================================================================
+def plot_subject_motion(dti_dir, sub_motion):
+    '''
+    Plot the abs and rel displacements for each group of volumes of
+    one subject. A figure is only remade if it is older than the
+    ec_disp file it shows.
+    '''
+    for suffix in measure_suffixes:
+
+        disp_file = os.path.join(dti_dir, 'ec_disp{}.txt'.format(suffix))
         figure_name = os.path.join(dti_dir, 'QC_ec_disp{}.png'.format(suffix))
+        if (os.path.exists(figure_name)
+                and os.path.getmtime(figure_name) >= os.path.getmtime(disp_file)):
+            continue
+
         fig, ax = plt.subplots()
-        
-        # Loop through the three different values that you want to know
-        # for the two different measures (abs and rel)
+
         for measure in measures:
-            subs_df.ix[i, 'mean_rms_'+measure+suffix] = disp[measure+suffix].mean()
-            subs_df.ix[i, 'std_rms_'+measure+suffix] = disp[measure+suffix].std()
-            subs_df.ix[i, 'max_rms_'+measure+suffix] = disp[measure+suffix].max()
+            values = sub_motion[measure+suffix]
+            keep = values.notnull().values
+            ax.plot(sub_motion['vol'].values[keep], values.values[keep], label=measure)
 
-            ax.plot(disp[measure+suffix][disp[measure+suffix].notnull()], label=measure)
-            
         # Label the x axis according to which plot this is:
         if suffix == '':
             ax.set_xlabel('Volume Number')
@@ -129,7 +316,7 @@ for i, (sub, dti_dir) in enumerate(zip(sublist, dti_dir_list)):
             ax.set_xlabel('B0 Volume Number')
         else:
             ax.set_xlabel('Diff weighted Volume Number')
-            
+
         # And label the yaxis
         ax.set_ylabel('Displacement (mm)')
         # And set the y axis to always between 0 and 3
@@ -140,78 +327,207 @@ for i, (sub, dti_dir) in enumerate(zip(sublist, dti_dir_list)):
         plt.tight_layout()
         fig.savefig(figure_name, bbox_inches=0, dpi=100)
         plt.close()
-        
-### Make the figure from ALL of the subjects
-figure_name = os.path.join(qa_dir, 'movement_boxplot_all.png')
-subs_df = boxplot_dti_movement(subs_df, figure_name)
-
-### Now drop all those outliers:
-iter=1
-while iter<10:
-    print iter
-    figure_name = os.path.join(qa_dir, 'movement_boxplot_iter{}.png'.format(iter))
-    subs_df = boxplot_dti_movement(subs_df, figure_name)
-
-    if subs_df.subid[subs_df.color>0].count() == 0:
-        break
-        
-    subs_df = subs_df[subs_df.color<1]
-    iter+=1
-
-### NEXT THING TO DO IS AUTOMATICALLY FIND THE TRACE FOR THESE BAD GUYS
-
-    
-'''
-# Now, we need to ignore the values that compare to a bval of 0
-bvals_file=os.path.join(os.path.dirname(file), 'bvals')
-bvals = np.loadtxt(bvals_file)
-disp['bvals'] = bvals
-bval_locs = np.where(disp.bvals==0)[0]
-bval_locs = list(bval_locs)
-exclude_locs = [ b +1 for b in bval_locs] + bval_locs
-mask = ~disp.index.isin(exclude_locs)
-subs_df.ix[i, 'mean_rms_abs_corr'] = disp[0][mask].mean()
-subs_df.ix[i, 'mean_rms_rel_corr'] = disp[1][mask].mean()
-'''
-
-
-n = subs_df.subid.count()
-
-cmap = mpl.cm.jet
-norm = mpl.colors.Normalize(vmin=0, vmax=n)
-cmap = mpl.cm.ScalarMappable( norm, 'jet')
-
-fig = plt.figure()
-ax = fig.add_subplot(111, projection='3d')
-
-for i, dti_dir in enumerate(subs_df['dirname']):
-
-    # Read in the three files that contain information on the displacements
-    # again (but this time the subjects are in order of their mean_rms_abs_notb0)
-    filenames = [ 'ec_disp.txt', 'ec_disp_b0.txt', 'ec_disp_notb0.txt' ]
-    measure_suffixes = [ '', '_b0', '_notb0' ]
-    for file, suffix in zip(filenames, measure_suffixes):
-        disp = pd.read_csv(os.path.join(dti_dir, file),
-                            delimiter=' ', header=None,
-                            names=['abs'+suffix, 'rel'+suffix], na_values='.')
 
+
+#==============================================================================
+def iterative_outliers(subs_df, max_iter=9, whis=1.5):
+    '''
+    Find the subjects whose mean displacements are outliers (see
+    iqr_fliers), drop them, and look again until there aren't any
+    left or max_iter iterations have been run.
+
+    Returns a list with an (included, fliers) pair for each iteration
+    - included is a boolean mask of the subjects that were still in at
+    the start of that iteration and fliers is the (n_included, n_cols)
+    array of outliers - and the mask of the subjects left at the end.
+    '''
+    cols = [ name for name in subs_df.columns if 'mean_rms' in name ]
+    values = subs_df[cols].values.astype(float)
+
+    included = np.ones(values.shape[0], dtype=bool)
+    iterations = []
+    for iter in range(max_iter):
+        fliers = iqr_fliers(values[included], whis=whis)
+        iterations.append((included.copy(), fliers))
+
+        outliers = fliers.any(axis=1)
+        if not outliers.any():
+            break
+
+        included[np.flatnonzero(included)[outliers]] = False
+
+    return iterations, included
+
+
+#==============================================================================
+def save_outliers(subs_df, iterations, csv_name):
+    '''
+    Write out which subjects were outliers in each iteration and
+    for which measures
+    '''
+    cols = [ name for name in subs_df.columns if 'mean_rms' in name ]
+    subids = subs_df.subid.values
+
+    with open(csv_name, 'w') as f:
+        f.write('iteration,subid,measures\n')
+        for iter, (included, fliers) in enumerate(iterations, 1):
+            for row, flier_row in zip(np.flatnonzero(included), fliers):
+                if flier_row.any():
+                    f.write('{},{},{}\n'.format(iter, subids[row],
+                            ' '.join([ col for col, flier in zip(cols, flier_row) if flier ])))
+
+
+#==============================================================================
+def beaches_image(motion, sub_rows, column='rel_notb0'):
+    '''
+    Put the displacements in column into an (n_subs, n_vols) array
+    with a row for each of the subjects in sub_rows (the sub values
+    in the motion table), sorted so that the subject with the smallest
+    mean displacement is first.
+
+    The b0 volumes and the volumes straight after them are NaN
+    (the displacements between b0 and diffusion weighted volumes
+    aren't very meaningful), as are any volumes a subject doesn't have.
+    Returns the array and the order of sub_rows it's in.
+    '''
+    sub = motion['sub'].values.astype(int)
+    vol = motion['vol'].values.astype(int)
+    values = motion[column].values.astype(float)
+
+    # Mask the b0 volumes and the ones after them
+    # (the table is sorted by subject and then volume)
+    is_b0 = motion['bval'].values == 0
+    after_b0 = np.zeros_like(is_b0)
+    after_b0[1:] = is_b0[:-1] & (sub[1:] == sub[:-1])
+    values[is_b0 | after_b0] = np.nan
+
+    # Fill in the picture with one indexing step rather than
+    # a loop over the subjects
+    sub_rows = np.asarray(sub_rows, dtype=int)
+    keep = np.isin(sub, sub_rows)
+    sort_idx = np.argsort(sub_rows)
+    rows = sort_idx[np.searchsorted(sub_rows, sub[keep], sorter=sort_idx)]
+
+    n_vols = vol[keep].max() + 1 if keep.any() else 0
+    beaches = np.full([sub_rows.shape[0], n_vols], np.nan)
+    beaches[rows, vol[keep]] = values[keep]
+
+    # Sort by mean displacement
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        order = np.argsort(np.nanmean(beaches, axis=1))
+
+    return beaches[order], order
+
+
+#==============================================================================
+def plot_beaches(beaches, figure_name, vmax=None):
+    '''
+    Show the (n_subs, n_vols) beaches array as one image, masked
+    volumes are grey. The figure is the same size however many
+    subjects there are.
+    '''
+    if vmax is None:
+        finite = beaches[np.isfinite(beaches)]
+        vmax = np.percentile(finite, 99) if finite.shape[0] > 0 else 1.0
+
+    cmap = copy.copy(plt.get_cmap('hot'))
+    cmap.set_bad('grey')
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    im = ax.imshow(np.ma.masked_invalid(beaches),
+                        aspect='auto',
+                        interpolation='nearest',
+                        cmap=cmap,
+                        vmin=0,
+                        vmax=vmax)
+
+    ax.set_xlabel('Volume')
+    ax.set_ylabel('Participant (sorted by mean displacement)')
+    cbar = fig.colorbar(im, ax=ax)
+    cbar.set_label('Relative displacement (mm)')
+
+    fig.savefig(figure_name, bbox_inches=0, dpi=100)
+    plt.close(fig)
+
+
+#==============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    data_dir = arguments.data_dir
+    dti_id = arguments.dti_id
+
+    # Read in the subjects into a sublist (list)
+    sublist = [ sub.strip() for sub in open(arguments.sublist_file) if sub.strip() ]
+
+    # Define the output directory and make it if it doesn't yet exist
+    qa_dir = os.path.join(data_dir, 'QA_OUTPUT')
+    if not os.path.isdir(qa_dir):
+        os.makedirs(qa_dir)
+
+    ### SET UP A DATA FRAME ###
+
+    ### FILL IN THE DATA ###
+
+    # Read the displacements of any new (or changed) subjects
+    # into the cohort motion database
+    con = open_motion_store(os.path.join(qa_dir, 'motion.sqlite'))
+    dti_dir_list, updated = update_motion_store(con, data_dir, sublist, dti_id,
+                                                    n_jobs=arguments.n_jobs)
+    print('Read motion files for {} of {} subjects'.format(len(updated), len(sublist)))
+
+    # And get everyone back out of it
+    subs_df, motion = load_motion_store(con, sublist, dti_id)
+    con.close()
+
+    # Plot the displacements of the subjects that have changed
+    updated = set(updated)
+    for sub_idx, sub_motion in motion.groupby('sub'):
+        if dti_dir_list[sub_idx] in updated:
+            plot_subject_motion(dti_dir_list[sub_idx], sub_motion)
+
+    ### Now find and drop all those outliers:
+    iterations, included = iterative_outliers(subs_df)
+    for iter, (iter_included, fliers) in enumerate(iterations, 1):
+        print('Iteration {}: {} outliers'.format(iter, fliers.any(axis=1).sum()))
+    save_outliers(subs_df, iterations, os.path.join(qa_dir, 'movement_outliers.csv'))
+
+    ### Only draw the boxplots that were asked for
+    for iter in arguments.plot_iterations:
+        if iter == 0:
+            # The figure from ALL of the subjects
+            figure_name = os.path.join(qa_dir, 'movement_boxplot_all.png')
+            iter_included, fliers = iterations[0]
+        elif iter <= len(iterations):
+            figure_name = os.path.join(qa_dir, 'movement_boxplot_iter{}.png'.format(iter))
+            iter_included, fliers = iterations[iter-1]
+        else:
+            continue
+        boxplot_dti_movement(subs_df[iter_included], figure_name, fliers=fliers)
+
+    subs_df = subs_df[included]
+
+    ### NEXT THING TO DO IS AUTOMATICALLY FIND THE TRACE FOR THESE BAD GUYS
+
+
+    '''
     # Now, we need to ignore the values that compare to a bval of 0
-    bvals_file=os.path.join(os.path.join(dti_dir, 'bvals'))
+    bvals_file=os.path.join(os.path.dirname(file), 'bvals')
     bvals = np.loadtxt(bvals_file)
     disp['bvals'] = bvals
     bval_locs = np.where(disp.bvals==0)[0]
     bval_locs = list(bval_locs)
-    exclude_locs = [ b + 1 for b in bval_locs] + bval_locs
+    exclude_locs = [ b +1 for b in bval_locs] + bval_locs
     mask = ~disp.index.isin(exclude_locs)
-    colors = cmap.to_rgba(i)
-    xs = range(disp['rel'+suffix][mask].count())
-    ys = np.ones_like(xs)*i
-    zs = disp['rel'+suffix][mask].values
-    ax.plot(xs, ys, zs, c=colors)
-    
-ax.set_xlabel('Volume')
-ax.set_ylabel('Participant')
-ax.set_zlabel('Translation (mm)')
-
-figure_name = os.path.join(data_dir, 'movement_beaches.png')
-fig.savefig(figure_name, bbox_inches=0, dpi=100)
+    subs_df.ix[i, 'mean_rms_abs_corr'] = disp[0][mask].mean()
+    subs_df.ix[i, 'mean_rms_rel_corr'] = disp[1][mask].mean()
+    '''
+
+
+    ### The movement beaches: everyone's relative displacements
+    ### with the least movement at the top
+    beaches, order = beaches_image(motion, subs_df.index.values)
+    figure_name = os.path.join(data_dir, 'movement_beaches.png')
+    plot_beaches(beaches, figure_name)
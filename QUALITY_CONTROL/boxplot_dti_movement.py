@@ -1,9 +1,34 @@
 #!/usr/bin/env python
 
-def boxplot_dti_movement(subs_df, figure_name):
+def iqr_fliers(values, whis=1.5):
+    '''
+    Find the outliers in each column of values: anything more than
+    whis times the interquartile range below the first quartile or
+    above the third quartile. These are the same points that a
+    matplotlib boxplot draws as fliers. NaNs are never outliers.
+    Returns a boolean array the same shape as values.
+    '''
+    #===============================================================
+    # IMPORTS
+    #---------------------------------------------------------------
+    import numpy as np
+    #===============================================================
+
+    values = np.asarray(values, dtype=float)
+    q1, q3 = np.nanpercentile(values, [25, 75], axis=0)
+    iqr = q3 - q1
+
+    with np.errstate(invalid='ignore'):
+        return (values < q1 - whis*iqr) | (values > q3 + whis*iqr)
+
+
+def boxplot_dti_movement(subs_df, figure_name, fliers=None):
     '''
     Create a boxplot showing the 6 different ways of calculating
     displacement for dti scans. Label the outliers with their subid.
+
+    The outliers can be passed in as fliers (from iqr_fliers),
+    otherwise they're calculated here.
     '''
     #===============================================================
     # IMPORTS
@@ -21,6 +46,11 @@ def boxplot_dti_movement(subs_df, figure_name):
     
     # First: the columns we're going to plot
     cols = [ name for name in subs_df.columns if 'mean_rms' in name ]
+    values = subs_df[cols].values.astype(float)
+    ids = subs_df.subid.values
+
+    if fliers is None:
+        fliers = iqr_fliers(values)
     
     # The total number of subjects
     n = subs_df.subid.count()
@@ -34,7 +64,8 @@ def boxplot_dti_movement(subs_df, figure_name):
     color_counter = 1.0
 
     # Make sure everyone is originally set with a color of 0
-    subs_df['color'] = 0.0
+    subs_df = subs_df.copy()
+    colors = np.zeros(values.shape[0])
 
     #===============================================================
     # Make the figure
@@ -42,48 +73,35 @@ def boxplot_dti_movement(subs_df, figure_name):
     fig, ax = plt.subplots()
     
     # Make a box plot of the six different measures of movement
-    box = plt.boxplot(subs_df[cols].values)
+    box = plt.boxplot(values)
 
-    # One of the pieces of information contained in the box variable
-    # are the locations of the fliers (the outliers)
-    for f in box['fliers']:
+    # Loop through the columns and label the outliers in each one
+    for x, col in enumerate(cols, 1):
 
-        # Get the information from each of the 12 positions that fliers
-        # could be found in.
-        # x_list: list of x positions, fliers_list: list of y positions
-        x_list, fliers_list = f.get_data()
-        
-        # Sort the fliers_list so that they're in order smallest to largest
-        # Note that you don't have to sort the x list because they're all the
-        # same value :)
-        fliers_list.sort()
+        # The rows that are outliers in this column, sorted so that
+        # they're in order smallest to largest
+        rows = np.flatnonzero(fliers[:, x-1])
+        rows = rows[np.argsort(values[rows, x-1])]
         
-        # Now loop through all the x, y pairs in the x_list and
-        # fliers_list and define a counter (c)
-        for c, (x, y) in enumerate(zip(x_list, fliers_list)):
-        
-            # You can find the subID for each of the outliers
-            # by looking up the y value in the appropriate column
-            #(indexed as x-1 because the plot doesn't start counting at 0)
-            id = subs_df.subid[subs_df[cols[np.int(x-1)]]==y].values[0]
+        # Now loop through all the outliers and define a counter (c)
+        for c, row in enumerate(rows):
+            y = values[row, x-1]
+            id = ids[row]
 
             # We're also going to set the color of each box so that it's the
             # same for each individual across plots. Note that you don't have to
             # do this step if the person already has a color.
-            if subs_df.color[subs_df.subid==id] == 0:
-                subs_df.color[subs_df.subid==id] = color_counter
+            if colors[row] == 0:
+                colors[row] = color_counter
                 color_counter+=1
             
-            # Get the sub_color_id, this is the number that's been filled in
-            # in the subs_df for this participant, and define the color that
-            # will be used in the annotation
-            sub_color_id = subs_df.color[subs_df.subid==id]
-            color = map.to_rgba(10.0*sub_color_id.values[0]/n)
+            # Define the color that will be used in the annotation
+            color = map.to_rgba(10.0*colors[row]/n)
                         
             # In order to make the labels flip sides left and right as
             # we go through each person we're going do something creative
             # with modulo division
-            offset_x = -0.5 * np.float(c%2) + 0.25 + x
+            offset_x = -0.5 * float(c%2) + 0.25 + x
             offset_y = 0.25 + y
             
             # Annotate all the outliers with a box that contains their subid
@@ -94,6 +112,8 @@ def boxplot_dti_movement(subs_df, figure_name):
                 arrowprops=dict(arrowstyle='->', 
                                 color='black'))
 
+    subs_df['color'] = colors
+
     # Make the plot look nicer:
     # Lets make sure the labels all fit onto the x axis
     plt.xticks(range(1,len(cols)+1), cols, rotation=45)
@@ -106,5 +126,6 @@ def boxplot_dti_movement(subs_df, figure_name):
     plt.tight_layout()
     # Name the figure and save it
     fig.savefig(figure_name, bbox_inches=0, dpi=100)
+    plt.close(fig)
     
     return subs_df
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+'''
+Look for signal dropout in the individual diffusion weighted volumes.
+
+The eddy corrected data (dti_ec.nii.gz) is read one volume at a time
+through nibabel's array proxy so that only one volume is ever held in
+memory, however many directions were acquired. For each volume the
+mean intensity inside the brain mask is calculated for every slice.
+
+Each slice is then compared to the same slice in all the other
+volumes with the same b value (the b-shell) using a robust z score:
+
+    z = (mean - shell median) / (1.4826 * shell MAD)
+
+where the MAD is not allowed to fall below the median MAD of all
+the slices in that shell.
+
+Slices with a z score below -z_threshold are flagged as dropouts.
+The per volume summary is saved as QA_OUTPUT/QADropout.csv and the
+z scores (slices x volumes) are shown in QA_OUTPUT/QADropout.png.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import warnings
+from glob import glob
+import numpy as np
+import nibabel as nib
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pylab as plt
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Find slices with signal dropout in diffusion weighted volumes')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: data_dir
+    parser.add_argument(dest='data_dir',
+                            type=str,
+                            metavar='data_dir',
+                            help=('Data directory. This is the DTI directory of one subject,'
+                                    ' or the directory containing SUB_DATA if you give a sublist_file'))
+
+    # Optional argument: sublist_file
+    parser.add_argument('--sublist_file',
+                            dest='sublist_file',
+                            type=str,
+                            help='File containing a list of subject IDs',
+                            default=None,
+                            action='store')
+
+    # Optional argument: DTI identifier
+    parser.add_argument('--dti_id',
+                            dest='dti_id',
+                            type=str,
+                            help='String containing path that defines the DTI directory in subject dir',
+                            default='DTI/MRI0',
+                            action='store')
+
+    # Optional argument: z_threshold
+    parser.add_argument('--z_threshold',
+                            dest='z_threshold',
+                            type=float,
+                            help='slices with a robust z score below minus this are dropouts',
+                            default=5.0,
+                            action='store')
+
+    # Optional argument: min_voxels
+    parser.add_argument('--min_voxels',
+                            dest='min_voxels',
+                            type=int,
+                            help='ignore slices with fewer brain voxels than this',
+                            default=100,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def slice_means(dti_file, mask_file, min_voxels=100):
+    '''
+    The mean intensity inside the mask of every slice (along the
+    third axis) of every volume. Volumes are read one at a time.
+    Slices with fewer than min_voxels in the mask are NaN.
+    Returns an (n_vols, n_slices) array.
+    '''
+    mask = nib.load(mask_file).get_fdata() > 0
+    n_voxels = mask.sum(axis=(0, 1)).astype(float)
+    n_voxels[n_voxels < min_voxels] = np.nan
+
+    # Keeping the file open means that the volumes are read in turn
+    # rather than decompressing the file from the start every time
+    img = nib.load(dti_file, keep_file_open=True)
+    n_vols = img.shape[3]
+
+    means = np.zeros([n_vols, mask.shape[2]])
+    for v in range(n_vols):
+        vol = np.asarray(img.dataobj[..., v], dtype=np.float32)
+        means[v] = np.where(mask, vol, 0).sum(axis=(0, 1)) / n_voxels
+
+    return means
+
+#-----------------------------------------------------------------------------
+
+def shell_z_scores(means, bvals, shell_width=100):
+    '''
+    Robust z scores of every slice of every volume compared to the
+    volumes in the same b-shell. b values are rounded to the nearest
+    shell_width to find the shells. Shells with fewer than three
+    volumes (or slices with no spread) get a z score of NaN.
+    The spread of each slice is at least the median spread of all
+    the slices in the shell.
+    Returns an (n_vols, n_slices) array.
+    '''
+    shells = np.round(np.asarray(bvals, dtype=float) / shell_width) * shell_width
+
+    z = np.full(means.shape, np.nan)
+    for shell in np.unique(shells):
+        in_shell = shells == shell
+        if in_shell.sum() < 3:
+            continue
+
+        with warnings.catch_warnings():
+            # Slices outside the brain are all NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(means[in_shell], axis=0)
+            mad = 1.4826 * np.nanmedian(np.abs(means[in_shell] - median), axis=0)
+
+        # With only a few volumes in a shell the MAD of a slice can
+        # be tiny by chance, so it's not allowed to be smaller than
+        # the typical MAD of all the slices
+        if np.any(mad > 0):
+            mad = np.fmax(mad, np.nanmedian(mad[mad > 0]))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_shell = (means[in_shell] - median) / mad
+        z_shell[:, ~(mad > 0)] = np.nan
+        z[in_shell] = z_shell
+
+    return z
+
+#-----------------------------------------------------------------------------
+
+def save_dropout_table(z, bvals, csv_name, z_threshold=5.0):
+    '''
+    One row per volume: its b value, the number of slices that are
+    dropouts and the lowest z score (and the slice it's in)
+    '''
+    flagged = z < -z_threshold
+
+    with open(csv_name, 'w') as f:
+        f.write('volume,bval,n_dropout_slices,min_z,min_z_slice,dropout_slices\n')
+        for v in range(z.shape[0]):
+            if np.all(np.isnan(z[v])):
+                min_z, min_slice = '', ''
+            else:
+                min_slice = int(np.nanargmin(z[v]))
+                min_z = '{:.2f}'.format(z[v, min_slice])
+            f.write('{},{:g},{},{},{},{}\n'.format(v,
+                                                    bvals[v],
+                                                    flagged[v].sum(),
+                                                    min_z,
+                                                    min_slice,
+                                                    ' '.join([ str(s) for s in np.flatnonzero(flagged[v]) ])))
+
+#-----------------------------------------------------------------------------
+
+def plot_dropout_heatmap(z, figure_name, z_threshold=5.0):
+    '''
+    Picture of the z scores with a slice for each row and a volume for
+    each column. Dropouts are circled.
+    '''
+    fig, ax = plt.subplots(figsize=(8, 6))
+
+    im = ax.imshow(z.T, origin='lower', aspect='auto', interpolation='none',
+                        cmap='RdBu', vmin=-2*z_threshold, vmax=2*z_threshold)
+
+    v, s = np.nonzero(z < -z_threshold)
+    ax.scatter(v, s, s=60, facecolors='none', edgecolors='black')
+
+    ax.set_xlabel('Volume Number')
+    ax.set_ylabel('Slice Number')
+    cbar = fig.colorbar(im, ax=ax)
+    cbar.set_label('Robust z score')
+
+    fig.savefig(figure_name, bbox_inches=0, dpi=100)
+    plt.close(fig)
+
+#-----------------------------------------------------------------------------
+
+def dropout_qa(dti_dir, z_threshold=5.0, min_voxels=100):
+    '''
+    Run the dropout check on one DTI directory and save the table
+    and heatmap in its QA_OUTPUT directory.
+    Returns the number of volumes with at least one dropout.
+    '''
+    qa_dir = os.path.join(dti_dir, 'QA_OUTPUT')
+    if not os.path.isdir(qa_dir):
+        os.makedirs(qa_dir)
+
+    bvals = np.loadtxt(os.path.join(dti_dir, 'bvals')).reshape(-1)
+
+    means = slice_means(os.path.join(dti_dir, 'dti_ec.nii.gz'),
+                            os.path.join(dti_dir, 'dti_ec_brain_mask.nii.gz'),
+                            min_voxels=min_voxels)
+    z = shell_z_scores(means, bvals)
+
+    save_dropout_table(z, bvals, os.path.join(qa_dir, 'QADropout.csv'),
+                            z_threshold=z_threshold)
+    plot_dropout_heatmap(z, os.path.join(qa_dir, 'QADropout.png'),
+                            z_threshold=z_threshold)
+
+    return int(np.any(z < -z_threshold, axis=1).sum())
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    data_dir = arguments.data_dir
+
+    if arguments.sublist_file is None:
+        dti_dir_list = [ data_dir ]
+    else:
+        sublist = [ sub.strip() for sub in open(arguments.sublist_file) if sub.strip() ]
+        dti_dir_list = []
+        for sub in sublist:
+            dti_dir_list.extend(glob(os.path.join(data_dir, 'SUB_DATA', sub, arguments.dti_id)))
+
+    for dti_dir in dti_dir_list:
+        n_bad = dropout_qa(dti_dir,
+                            z_threshold=arguments.z_threshold,
+                            min_voxels=arguments.min_voxels)
+        print('{}: {} volumes with dropouts'.format(dti_dir, n_bad))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+'''
+Motion parameters from the eddy_correct log file, without FSL.
+
+This does the same job as dti_motion.py (Mark Jenkinson's script from
+the FSL forum) but instead of writing every registration matrix to a
+temporary file and running rmsdiff twice and avscale twice for every
+volume, all the matrices are read from the .ecclog in one go and the
+measures are calculated for all the volumes at the same time:
+
+    ec_disp.txt   - absolute (to the first volume) and relative (to
+                    the previous volume) RMS displacement in mm
+    ec_rot.txt    - rotation angles (x, y, z) in radians
+    ec_trans.txt  - translations (x, y, z) in mm
+
+along with ec_disp_b0.txt and ec_disp_notb0.txt, which have a '.' for
+the volumes that aren't b0 (or are b0) volumes.
+
+The RMS displacement is Jenkinson's formula for the mean displacement
+over a sphere of radius 80 mm, as in rmsdiff:
+
+    rms^2 = t't + (R^2/5) trace(A'A)
+
+where A is the 3x3 part of (M1 inv(M2) - I), t is its translation
+column plus A times the centre, and the centre is the centre of
+gravity of the first volume of dti_ec.nii.gz. The rotations and
+translations come from the same decomposition that avscale uses
+(M = rotation . skew . scales, angles with R = Rx.Ry.Rz), with the
+translations measured around the same centre.
+
+All positions are in FSL's "scaled mm" coordinates (voxel index
+times voxel size, with x flipped for neurologically ordered images)
+which are the coordinates the FLIRT matrices use.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import numpy as np
+import nibabel as nib
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Calculate displacements, rotations and translations from an eddy_correct log file')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: ecclog
+    parser.add_argument(dest='ecclog',
+                            type=str,
+                            metavar='ecclog',
+                            help='eddy current log file (eg: dti_ec.ecclog)')
+
+    # Required argument: bvals
+    parser.add_argument(dest='bvals',
+                            type=str,
+                            metavar='bvals',
+                            help='bvals file')
+
+    # Optional argument: plot
+    parser.add_argument('--plot',
+                            dest='plot',
+                            help='also save ec_disp.png, ec_rot.png and ec_trans.png',
+                            action='store_true',
+                            default=False)
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def read_ecclog(ecclog_file):
+    '''
+    All the registration matrices in an eddy_correct log file.
+    Each one is the four lines after a line containing "Final".
+    Returns an (n_vols, 4, 4) array.
+    '''
+    lines = open(ecclog_file).read().splitlines()
+
+    mats = []
+    for i, line in enumerate(lines):
+        if 'Final' in line:
+            mats.append([ [ float(x) for x in l.split() ] for l in lines[i+1:i+5] ])
+
+    return np.array(mats).reshape([-1, 4, 4])
+
+#-----------------------------------------------------------------------------
+
+def image_centre(img_file):
+    '''
+    The centre of gravity of the first volume of an image in FSL's
+    scaled mm coordinates (what rmsdiff and avscale use)
+    '''
+    img = nib.load(img_file)
+    if len(img.shape) == 4:
+        data = np.asarray(img.dataobj[:,:,:,0], dtype=float)
+    else:
+        data = np.asarray(img.dataobj[:,:,:], dtype=float)
+
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+
+    total = data.sum()
+    cog = np.array([ (data.sum(axis=tuple(a for a in range(3) if a != ax))
+                        * np.arange(data.shape[ax])).sum() / total
+                        for ax in range(3) ])
+
+    # FSL works in radiological order so x is flipped
+    # for images stored in neurological order
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        cog[0] = data.shape[0] - 1 - cog[0]
+
+    return cog * zooms
+
+#-----------------------------------------------------------------------------
+
+def rms_deviation(mats1, mats2, centre, rmax=80.0):
+    '''
+    Jenkinson's RMS deviation between two sets of (n, 4, 4) affine
+    matrices over a sphere of radius rmax mm around centre
+    (the same as FSL's rmsdiff)
+    '''
+    diff = np.matmul(mats1, np.linalg.inv(mats2)) - np.eye(4)
+    A = diff[:, :3, :3]
+    t = diff[:, :3, 3] + np.matmul(A, centre)
+
+    return np.sqrt((t ** 2).sum(axis=1)
+                    + (rmax ** 2 / 5.0) * (A ** 2).sum(axis=(1, 2)))
+
+#-----------------------------------------------------------------------------
+
+def decompose_aff(mats, centre):
+    '''
+    Split (n, 4, 4) affine matrices into rotations, translations
+    (around centre), scales and skews in the same way as FSL's
+    decompose_aff: M = rotation . skew . scales.
+    Returns a dictionary of arrays, including the (n, 3, 3) rotation
+    matrices.
+    '''
+    aff3 = mats[:, :3, :3]
+    x, y, z = aff3[:, :, 0], aff3[:, :, 1], aff3[:, :, 2]
+
+    def dot(u, v):
+        return (u * v).sum(axis=1)
+
+    sx = np.sqrt(dot(x, x))
+    sy = np.sqrt(dot(y, y) - dot(x, y) ** 2 / sx ** 2)
+    a = dot(x, y) / (sx * sy)
+    x0 = x / sx[:, np.newaxis]
+    y0 = y / sy[:, np.newaxis] - a[:, np.newaxis] * x0
+    sz = np.sqrt(dot(z, z) - dot(x0, z) ** 2 - dot(y0, z) ** 2)
+    b = dot(x0, z) / sz
+    c = dot(y0, z) / sz
+
+    n = mats.shape[0]
+    scales = np.zeros([n, 3, 3])
+    scales[:, 0, 0], scales[:, 1, 1], scales[:, 2, 2] = sx, sy, sz
+    skew = np.tile(np.eye(3), [n, 1, 1])
+    skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = a, b, c
+
+    rotmat = np.matmul(aff3, np.linalg.inv(np.matmul(skew, scales)))
+
+    params = {}
+    params['rotmat'] = rotmat
+    params['rotations'] = rotmat2euler(rotmat)
+    params['translations'] = np.matmul(aff3, centre) + mats[:, :3, 3] - centre
+    params['scales'] = np.column_stack([sx, sy, sz])
+    params['skews'] = np.column_stack([a, b, c])
+
+    return params
+
+#-----------------------------------------------------------------------------
+
+def rotmat2euler(rotmat):
+    '''
+    Euler angles (x, y, z) in radians of (n, 3, 3) rotation matrices
+    using FSL's convention R = Rx.Ry.Rz (miscmaths: rotmat2euler)
+    '''
+    R = rotmat
+    cy = np.sqrt(R[:, 0, 0] ** 2 + R[:, 0, 1] ** 2)
+    angles = np.zeros([R.shape[0], 3])
+
+    ok = cy >= 1e-4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angles[:, 0] = np.where(ok, np.arctan2(R[:, 1, 2] / cy, R[:, 2, 2] / cy),
+                                    np.arctan2(-R[:, 2, 1], R[:, 1, 1]))
+        angles[:, 1] = np.where(ok, np.arctan2(-R[:, 0, 2], cy),
+                                    np.arctan2(-R[:, 0, 2], 0.0))
+        angles[:, 2] = np.where(ok, np.arctan2(R[:, 0, 1] / cy, R[:, 0, 0] / cy),
+                                    0.0)
+
+    return angles
+
+#-----------------------------------------------------------------------------
+
+def motion_params(mats, centre):
+    '''
+    The absolute and relative RMS displacements, rotations and
+    translations for every volume
+    '''
+    params = decompose_aff(mats, centre)
+
+    # The first volume is compared to itself
+    previous = np.concatenate([mats[:1], mats[:-1]])
+
+    motion = {}
+    motion['disp'] = np.column_stack([ rms_deviation(mats, mats[:1], centre),
+                                        rms_deviation(mats, previous, centre) ])
+    motion['rot'] = params['rotations']
+    motion['trans'] = params['translations']
+
+    return motion
+
+#-----------------------------------------------------------------------------
+
+def write_columns(values, filename, keep=None):
+    '''
+    Write one row per volume. Rows where keep is False are written
+    as a '.' for every column.
+    '''
+    values = np.atleast_2d(values)
+    if keep is None:
+        keep = np.ones(values.shape[0], dtype=bool)
+
+    with open(filename, 'w') as f:
+        for row, k in zip(values, keep):
+            if k:
+                # (adding 0 turns -0 into 0)
+                f.write(' '.join([ '{:g}'.format(x + 0.0) for x in row ]) + '\n')
+            else:
+                f.write(' '.join([ '.' ] * row.shape[0]) + '\n')
+
+#-----------------------------------------------------------------------------
+
+def plot_motion(motion, dwi_dir):
+    '''
+    Time series plots of the displacements, rotations and translations
+    (the same as the fsl_tsplot pictures)
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pylab as plt
+
+    plots = [ ('disp', 'Eddy Current estimated mean displacement (mm)', [ 'absolute', 'relative' ]),
+              ('rot', 'Eddy Current estimated rotations (radians)', [ 'x', 'y', 'z' ]),
+              ('trans', 'Eddy Current estimated translations (mm)', [ 'x', 'y', 'z' ]) ]
+
+    for name, title, labels in plots:
+        fig, ax = plt.subplots(figsize=(8, 3))
+        for column, label in zip(motion[name].T, labels):
+            ax.plot(column, label=label)
+        ax.set_title(title)
+        ax.set_xlabel('Volume Number')
+        ax.legend(loc=2, fontsize=8)
+        plt.tight_layout()
+        fig.savefig(os.path.join(dwi_dir, 'ec_{}.png'.format(name)), bbox_inches=0, dpi=100)
+        plt.close(fig)
+
+#-----------------------------------------------------------------------------
+
+def ec_motion(ecclog_file, bvals_file, plot=False):
+    '''
+    Calculate and save all the motion files for one eddy_correct
+    log file. They go in the same directory as the log file and the
+    centre comes from the eddy corrected image with the same name.
+    '''
+    dwi_dir = os.path.dirname(os.path.abspath(ecclog_file))
+    basenm = os.path.splitext(os.path.basename(ecclog_file))[0]
+
+    mats = read_ecclog(ecclog_file)
+    centre = image_centre(os.path.join(dwi_dir, basenm + '.nii.gz'))
+    motion = motion_params(mats, centre)
+
+    write_columns(motion['disp'], os.path.join(dwi_dir, 'ec_disp.txt'))
+    write_columns(motion['rot'], os.path.join(dwi_dir, 'ec_rot.txt'))
+    write_columns(motion['trans'], os.path.join(dwi_dir, 'ec_trans.txt'))
+
+    # Split the displacements into b0 and diffusion weighted volumes
+    b0 = np.loadtxt(bvals_file).reshape(-1) == 0
+    write_columns(motion['disp'], os.path.join(dwi_dir, 'ec_disp_b0.txt'), keep=b0)
+    write_columns(motion['disp'], os.path.join(dwi_dir, 'ec_disp_notb0.txt'), keep=~b0)
+
+    if plot:
+        plot_motion(motion, dwi_dir)
+
+    return motion
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    ec_motion(arguments.ecclog, arguments.bvals, plot=arguments.plot)
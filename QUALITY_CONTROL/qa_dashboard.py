@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+'''
+Make one html page that shows the quality assurance results for a
+whole cohort.
+
+Every subject gets a row with a small picture of their QAReport.jpg
+(which links to the full size report) and the numbers from their
+QAMetrics.json. Click on a column heading to sort the table by it.
+The cohort figures in QA_OUTPUT (eg: the movement boxplots made by
+QC_report_DTIprocessing.py) are shown at the top of the page.
+
+The thumbnails are only made again for subjects whose report or
+metrics have changed. A manifest (QA_OUTPUT/dashboard_manifest.json)
+keeps the modification time, size and md5 hash of every subject's
+files along with their metrics, so adding a subject to the cohort
+only means one new thumbnail. Files that have been touched but not
+changed are recognised by their hash.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import hashlib
+import json
+from glob import glob
+from PIL import Image
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Make an html dashboard of the quality assurance reports for a bunch of DTI directories')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: data_dir
+    parser.add_argument(dest='data_dir',
+                            type=str,
+                            metavar='data_dir',
+                            help='Data directory')
+
+    # Required argument: sublist_file
+    parser.add_argument(dest='sublist_file',
+                            type=str,
+                            metavar='sublist_file',
+                            help='File containing a list of subject IDs')
+
+    # Required argument: DTI identifier
+    parser.add_argument(dest='dti_id',
+                            type=str,
+                            metavar='dti_id',
+                            help='String containing path that defines the DTI directory in subject dir')
+
+    # Optional argument: thumbnail scale
+    parser.add_argument('--scale',
+                            dest='scale',
+                            type=float,
+                            help='size of the thumbnails as a fraction of the report',
+                            default=0.08,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def file_md5(filename):
+    '''
+    The md5 hash of a file (read in blocks)
+    '''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+#-----------------------------------------------------------------------------
+
+def file_signature(filename, old=None):
+    '''
+    The modification time, size and md5 hash of a file (None if it
+    doesn't exist). The hash is only calculated if the time or size
+    is different from the old signature.
+    '''
+    if not os.path.exists(filename):
+        return None
+
+    signature = { 'mtime' : os.path.getmtime(filename),
+                  'size' : os.path.getsize(filename) }
+
+    if (old is not None
+            and old['mtime'] == signature['mtime']
+            and old['size'] == signature['size']):
+        signature['md5'] = old['md5']
+    else:
+        signature['md5'] = file_md5(filename)
+
+    return signature
+
+#-----------------------------------------------------------------------------
+
+def same_contents(signature, old):
+    '''
+    True if two file signatures describe the same file contents
+    '''
+    if signature is None or old is None:
+        return signature is old
+    return signature['size'] == old['size'] and signature['md5'] == old['md5']
+
+#-----------------------------------------------------------------------------
+
+def find_dti_dirs(data_dir, sublist, dti_id):
+    '''
+    All the DTI directories for the subjects in sublist, named by
+    their path inside SUB_DATA (eg: 1234/DTI/MRI0)
+    '''
+    sub_data_dir = os.path.join(data_dir, 'SUB_DATA')
+
+    dti_dirs = []
+    for sub in sublist:
+        for dti_dir in sorted(glob(os.path.join(sub_data_dir, sub, dti_id))):
+            dti_dirs.append((os.path.relpath(dti_dir, sub_data_dir), dti_dir))
+
+    return dti_dirs
+
+#-----------------------------------------------------------------------------
+
+def make_thumbnail(image_file, thumb_file, scale=0.08):
+    '''
+    Save a small copy of an image
+    '''
+    img = Image.open(image_file)
+    width, height = img.size
+    img.thumbnail((max(1, int(width * scale)), max(1, int(height * scale))))
+    img.convert('RGB').save(thumb_file, quality=85)
+
+#-----------------------------------------------------------------------------
+
+def update_entry(key, dti_dir, qa_dir, old=None, scale=0.08):
+    '''
+    Make (or reuse) the dashboard entry for one DTI directory.
+    Returns the entry and whether anything had to be remade.
+    '''
+    report_file = os.path.join(dti_dir, 'QA_OUTPUT', 'QAReport.jpg')
+    metrics_file = os.path.join(dti_dir, 'QA_OUTPUT', 'QAMetrics.json')
+    thumb_file = os.path.join(qa_dir, 'thumbnails', key.replace(os.sep, '_') + '.jpg')
+
+    if old is None:
+        old = { 'report' : None, 'metrics_file' : None }
+
+    entry = { 'dti_dir' : dti_dir,
+              'report' : file_signature(report_file, old['report']),
+              'metrics_file' : file_signature(metrics_file, old['metrics_file']),
+              'thumbnail' : None,
+              'metrics' : {} }
+
+    changed = False
+
+    # The thumbnail
+    if entry['report'] is not None:
+        entry['thumbnail'] = thumb_file
+        if not same_contents(entry['report'], old['report']) or not os.path.exists(thumb_file):
+            if not os.path.isdir(os.path.dirname(thumb_file)):
+                os.makedirs(os.path.dirname(thumb_file))
+            make_thumbnail(report_file, thumb_file, scale=scale)
+            changed = True
+
+    # The metrics
+    if entry['metrics_file'] is not None:
+        if same_contents(entry['metrics_file'], old['metrics_file']):
+            entry['metrics'] = old['metrics']
+        else:
+            with open(metrics_file) as f:
+                entry['metrics'] = json.load(f)
+            changed = True
+
+    return entry, changed
+
+#-----------------------------------------------------------------------------
+
+def format_value(value):
+    '''
+    How a metric is written in the table
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '{:.3g}'.format(value)
+    return '{}'.format(value)
+
+#-----------------------------------------------------------------------------
+
+# A little javascript to sort the table when you click on a heading.
+# Numbers are sorted as numbers and empty cells go to the bottom.
+SORT_SCRIPT = '''
+<script>
+function sortTable(col) {
+    var table = document.getElementById('subjects');
+    var body = table.tBodies[0];
+    var rows = Array.prototype.slice.call(body.rows);
+    var up = table.getAttribute('data-col') != col || table.getAttribute('data-dir') != 'up';
+    rows.sort(function(a, b) {
+        var x = a.cells[col].getAttribute('data-value');
+        var y = b.cells[col].getAttribute('data-value');
+        if (x === '') return 1;
+        if (y === '') return -1;
+        var nx = parseFloat(x), ny = parseFloat(y);
+        var cmp = (isNaN(nx) || isNaN(ny)) ? x.localeCompare(y) : nx - ny;
+        return up ? cmp : -cmp;
+    });
+    rows.forEach(function(row) { body.appendChild(row); });
+    table.setAttribute('data-col', col);
+    table.setAttribute('data-dir', up ? 'up' : 'down');
+}
+</script>
+'''
+
+def write_dashboard(entries, qa_dir, html_name):
+    '''
+    Write the html page. entries is a list of (key, entry) pairs.
+    '''
+    def rel(filename):
+        return os.path.relpath(filename, qa_dir)
+
+    columns = sorted(set([ name for key, entry in entries for name in entry['metrics'] ]))
+
+    lines = [ '<!DOCTYPE html>',
+              '<html>',
+              '<head>',
+              '<meta charset="utf-8">',
+              '<title>DTI Quality Assurance</title>',
+              '<style>',
+              'body { font-family: sans-serif; }',
+              'table { border-collapse: collapse; font-size: 12px; }',
+              'th { cursor: pointer; background: #ddd; position: sticky; top: 0; }',
+              'th, td { border: 1px solid #aaa; padding: 2px 4px; text-align: right; }',
+              '</style>',
+              SORT_SCRIPT,
+              '</head>',
+              '<body>',
+              '<h1>DTI Quality Assurance</h1>' ]
+
+    # The cohort figures
+    for figure in sorted(glob(os.path.join(qa_dir, '*.png'))):
+        lines.append('<a href="{0}"><img src="{0}" loading="lazy" height="300"></a>'.format(rel(figure)))
+
+    # The table of subjects
+    lines.append('<table id="subjects">')
+    lines.append('<thead><tr>')
+    for col, name in enumerate([ 'subject', 'report' ] + columns):
+        lines.append('<th onclick="sortTable({})">{}</th>'.format(col, name))
+    lines.append('</tr></thead>')
+    lines.append('<tbody>')
+
+    for key, entry in entries:
+        cells = [ '<td data-value="{0}" style="text-align: left">{0}</td>'.format(key) ]
+
+        if entry['thumbnail'] is None:
+            cells.append('<td data-value="">missing</td>')
+        else:
+            report_file = os.path.join(entry['dti_dir'], 'QA_OUTPUT', 'QAReport.jpg')
+            cells.append('<td data-value="{0}"><a href="{1}"><img src="{2}" loading="lazy"></a></td>'.format(
+                                key, rel(report_file), rel(entry['thumbnail'])))
+
+        for name in columns:
+            value = entry['metrics'].get(name)
+            cells.append('<td data-value="{}">{}</td>'.format('' if value is None else value,
+                                                                format_value(value)))
+
+        lines.append('<tr>' + ''.join(cells) + '</tr>')
+
+    lines.extend([ '</tbody>', '</table>', '</body>', '</html>' ])
+
+    with open(html_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    data_dir = arguments.data_dir
+
+    # Read in the subjects into a sublist (list)
+    sublist = [ sub.strip() for sub in open(arguments.sublist_file) if sub.strip() ]
+
+    # Define the output directory and make it if it doesn't yet exist
+    qa_dir = os.path.join(data_dir, 'QA_OUTPUT')
+    if not os.path.isdir(qa_dir):
+        os.makedirs(qa_dir)
+
+    # Read in what was done last time
+    manifest_name = os.path.join(qa_dir, 'dashboard_manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_name):
+        with open(manifest_name) as f:
+            manifest = json.load(f)
+
+    # Update everyone's entry
+    entries = []
+    n_changed = 0
+    for key, dti_dir in find_dti_dirs(data_dir, sublist, arguments.dti_id):
+        entry, changed = update_entry(key, dti_dir, qa_dir,
+                                        old=manifest.get(key),
+                                        scale=arguments.scale)
+        entries.append((key, entry))
+        n_changed += changed
+
+    print('Updated {} of {} entries'.format(n_changed, len(entries)))
+
+    # Write the page and the manifest
+    write_dashboard(entries, qa_dir, os.path.join(qa_dir, 'index.html'))
+
+    manifest.update(dict(entries))
+    with open(manifest_name, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
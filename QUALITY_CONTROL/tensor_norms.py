@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+'''
+Compare everyone's FA, MO and SSE histograms to the rest of the cohort.
+
+The histograms are the same ones that DTI_QualityAssurance_Report.py
+draws (voxels inside the white matter mask that have an FA value,
+with the same fixed bins) but they're counted with np.bincount and
+kept as one row per subject of an integer array. The array is saved
+in QA_OUTPUT/tensor_histograms.npz along with the modification times
+of each subject's files, so running this again only counts the
+subjects that are new or have changed.
+
+Each row is turned into the fraction of voxels in each bin and the
+cohort median and MAD of every bin make the normative band. Every
+subject is then scored, for each measure, by the root mean square of
+their robust z scores over the bins and by the fraction of bins that
+fall outside median +/- n_mad * 1.4826 * MAD. Subjects with a score
+above the threshold for any measure are flagged.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import sys
+import argparse
+import warnings
+from glob import glob
+import numpy as np
+import nibabel as nib
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pylab as plt
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Compare FA, MO and SSE histograms to the rest of the cohort')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: data_dir
+    parser.add_argument(dest='data_dir',
+                            type=str,
+                            metavar='data_dir',
+                            help='Data directory')
+
+    # Required argument: sublist_file
+    parser.add_argument(dest='sublist_file',
+                            type=str,
+                            metavar='sublist_file',
+                            help='File containing a list of subject IDs')
+
+    # Required argument: DTI identifier
+    parser.add_argument(dest='dti_id',
+                            type=str,
+                            metavar='dti_id',
+                            help='String containing path that defines the DTI directory in subject dir')
+
+    # Optional argument: n_mad
+    parser.add_argument('--n_mad',
+                            dest='n_mad',
+                            type=float,
+                            help='width of the normative band in (scaled) MADs',
+                            default=3.0,
+                            action='store')
+
+    # Optional argument: threshold
+    parser.add_argument('--threshold',
+                            dest='threshold',
+                            type=float,
+                            help='flag subjects with a score above this for any measure',
+                            default=3.0,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+# The same bins as tensor_histogram in DTI_QualityAssurance_Report.py
+MEASURES = [ 'FA', 'MO', 'sse' ]
+BIN_EDGES = { 'FA' : np.linspace(0, 1, 100),
+              'MO' : np.linspace(-1, 1, 100),
+              'sse' : np.linspace(0, 5, 100) }
+
+#-----------------------------------------------------------------------------
+
+def bin_counts(values, edges):
+    '''
+    The number of values in each bin, the same as np.histogram
+    (the last bin includes its right edge, values outside are ignored)
+    '''
+    n_bins = edges.shape[0] - 1
+    idx = np.searchsorted(edges, values, side='right') - 1
+    idx[values == edges[-1]] = n_bins - 1
+    idx = idx[(idx >= 0) & (idx < n_bins)]
+
+    return np.bincount(idx, minlength=n_bins)
+
+#-----------------------------------------------------------------------------
+
+def input_files(dti_dir):
+    '''
+    The white matter mask and the FA, MO and sse maps for one DTI directory
+    '''
+    files = [ os.path.join(dti_dir, 'wm_DTIspace_mask.nii.gz') ]
+    for measure in MEASURES:
+        files += glob(os.path.join(dti_dir, 'FDT', '*_{}.nii.gz'.format(measure)))[:1]
+    return files
+
+#-----------------------------------------------------------------------------
+
+def subject_counts(dti_dir):
+    '''
+    One row of histogram counts for a subject: the FA, then MO, then
+    sse bins for the voxels in the white matter mask that have an FA
+    '''
+    wm_file, fa_file, mo_file, sse_file = input_files(dti_dir)
+
+    fa = np.asarray(nib.load(fa_file).dataobj, dtype=np.float32)
+    in_wm = (np.asarray(nib.load(wm_file).dataobj) > 0) & (fa > 0)
+
+    row = [ bin_counts(fa[in_wm], BIN_EDGES['FA']) ]
+    for measure, filename in zip(MEASURES[1:], [ mo_file, sse_file ]):
+        data = np.asarray(nib.load(filename).dataobj, dtype=np.float32)
+        row.append(bin_counts(data[in_wm], BIN_EDGES[measure]))
+
+    return np.concatenate(row)
+
+#-----------------------------------------------------------------------------
+
+def update_cohort(store_name, dti_dirs):
+    '''
+    Load the cohort histograms from store_name (if it exists), count
+    the subjects in dti_dirs that are new or whose files have changed,
+    and save the store again. Subjects in the store that aren't in
+    dti_dirs are kept (so running on part of the cohort doesn't lose
+    them) unless their files have gone.
+    Returns the keys (the DTI dirs in dti_dirs that have all their
+    files, in that order), their counts and the number updated.
+    '''
+    stored = {}
+    if os.path.exists(store_name):
+        store = np.load(store_name)
+        for key, row, mtime in zip(store['keys'], store['counts'], store['mtimes']):
+            stored[str(key)] = (row, mtime)
+
+    keys = []
+    n_updated = 0
+    n_removed = 0
+    for dti_dir in dti_dirs:
+        files = input_files(dti_dir)
+        if len(files) < 4 or not all([ os.path.exists(f) for f in files ]):
+            print('Missing files for {}'.format(dti_dir))
+            if stored.pop(dti_dir, None) is not None:
+                n_removed += 1
+            continue
+
+        mtime = max([ os.path.getmtime(f) for f in files ])
+        if dti_dir not in stored or stored[dti_dir][1] != mtime:
+            stored[dti_dir] = (subject_counts(dti_dir), mtime)
+            n_updated += 1
+
+        keys.append(dti_dir)
+
+    # Forget the subjects outside the list whose files have been removed
+    for key in [ key for key in stored if key not in keys ]:
+        files = input_files(key)
+        if len(files) < 4 or not all([ os.path.exists(f) for f in files ]):
+            del stored[key]
+            n_removed += 1
+
+    if n_removed > 0:
+        print('Removed {} subjects whose files have gone from the store'.format(n_removed))
+
+    if n_updated > 0 or n_removed > 0:
+        store_keys = sorted(stored)
+        np.savez_compressed(store_name,
+                                keys=np.array(store_keys),
+                                counts=np.array([ stored[key][0] for key in store_keys ],
+                                                    dtype=np.int64).reshape([len(store_keys), -1]),
+                                mtimes=np.array([ stored[key][1] for key in store_keys ]))
+
+    return keys, np.array([ stored[key][0] for key in keys ]), n_updated
+
+#-----------------------------------------------------------------------------
+
+def split_measures(counts):
+    '''
+    Split the rows of counts into a dictionary with the fraction of
+    voxels in each bin for each measure
+    '''
+    counts = np.atleast_2d(counts).astype(float)
+
+    fractions = {}
+    start = 0
+    for measure in MEASURES:
+        n_bins = BIN_EDGES[measure].shape[0] - 1
+        c = counts[:, start:start+n_bins]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fractions[measure] = c / c.sum(axis=1, keepdims=True)
+        start += n_bins
+
+    return fractions
+
+#-----------------------------------------------------------------------------
+
+def normative_bands(fractions, n_mad=3.0):
+    '''
+    The cohort median and scaled MAD of every bin (with the MAD no
+    smaller than the median MAD of all the bins) and the band
+    median +/- n_mad * MAD
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(fractions, axis=0)
+        mad = 1.4826 * np.nanmedian(np.abs(fractions - median), axis=0)
+
+    if np.any(mad > 0):
+        mad = np.fmax(mad, np.median(mad[mad > 0]))
+
+    return median, mad, median - n_mad * mad, median + n_mad * mad
+
+#-----------------------------------------------------------------------------
+
+def score_subjects(fractions, n_mad=3.0):
+    '''
+    For every subject the root mean square robust z score over the
+    bins and the fraction of bins outside the normative band
+    '''
+    median, mad, lower, upper = normative_bands(fractions, n_mad=n_mad)
+
+    ok = mad > 0
+    z = (fractions[:, ok] - median[ok]) / mad[ok]
+    score = np.sqrt(np.nanmean(z ** 2, axis=1))
+    outside = ((fractions < lower) | (fractions > upper)).mean(axis=1)
+
+    return score, outside
+
+#-----------------------------------------------------------------------------
+
+def plot_bands(fractions, scores, figure_name, n_mad=3.0, threshold=3.0):
+    '''
+    The normative band for each measure, with the histograms of the
+    flagged subjects drawn on top
+    '''
+    fig, axes = plt.subplots(1, len(MEASURES), figsize=(12, 3.5))
+
+    for ax, measure in zip(axes, MEASURES):
+        edges = BIN_EDGES[measure]
+        centres = (edges[:-1] + edges[1:]) / 2.0
+        median, mad, lower, upper = normative_bands(fractions[measure], n_mad=n_mad)
+
+        ax.fill_between(centres, np.clip(lower, 0, None), upper, color='grey', alpha=0.4)
+        ax.plot(centres, median, color='black')
+        for row in np.flatnonzero(scores[measure] > threshold):
+            ax.plot(centres, fractions[measure][row], color='red', alpha=0.5)
+
+        ax.set_xlabel(measure)
+
+    axes[0].set_ylabel('Fraction of voxels')
+    plt.tight_layout()
+    fig.savefig(figure_name, bbox_inches=0, dpi=100)
+    plt.close(fig)
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    data_dir = arguments.data_dir
+
+    # Read in the subjects into a sublist (list)
+    sublist = [ sub.strip() for sub in open(arguments.sublist_file) if sub.strip() ]
+
+    # Define the output directory and make it if it doesn't yet exist
+    qa_dir = os.path.join(data_dir, 'QA_OUTPUT')
+    if not os.path.isdir(qa_dir):
+        os.makedirs(qa_dir)
+
+    dti_dirs = []
+    for sub in sublist:
+        dti_dirs.extend(sorted(glob(os.path.join(data_dir, 'SUB_DATA', sub, arguments.dti_id))))
+
+    if not dti_dirs:
+        sys.exit('No DTI directories found for the subjects in {}'.format(arguments.sublist_file))
+
+    # Update the cohort store
+    keys, counts, n_updated = update_cohort(os.path.join(qa_dir, 'tensor_histograms.npz'),
+                                                dti_dirs)
+    print('Counted {} new or changed subjects, {} in the cohort'.format(n_updated, len(keys)))
+
+    if not keys:
+        sys.exit('None of the DTI directories have all of their files, so there is no cohort to compare')
+
+    # Score everyone against the cohort
+    fractions = split_measures(counts)
+    scores = {}
+    outside = {}
+    for measure in MEASURES:
+        scores[measure], outside[measure] = score_subjects(fractions[measure],
+                                                                n_mad=arguments.n_mad)
+
+    flagged = np.zeros(len(keys), dtype=bool)
+    for measure in MEASURES:
+        flagged |= scores[measure] > arguments.threshold
+
+    csv_name = os.path.join(qa_dir, 'tensor_norms.csv')
+    with open(csv_name, 'w') as f:
+        f.write(','.join([ 'dirname' ]
+                            + [ '{}_score'.format(m) for m in MEASURES ]
+                            + [ '{}_outside'.format(m) for m in MEASURES ]
+                            + [ 'flagged' ]) + '\n')
+        for i, key in enumerate(keys):
+            values = ([ '{:.3f}'.format(scores[m][i]) for m in MEASURES ]
+                        + [ '{:.3f}'.format(outside[m][i]) for m in MEASURES ]
+                        + [ '{:d}'.format(flagged[i]) ])
+            f.write(','.join([ key ] + values) + '\n')
+
+    plot_bands(fractions, scores, os.path.join(qa_dir, 'tensor_norms.png'),
+                    n_mad=arguments.n_mad, threshold=arguments.threshold)
+
+    print('{} subjects flagged'.format(flagged.sum()))
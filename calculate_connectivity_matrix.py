@@ -17,7 +17,6 @@ import sys
 from glob import glob
 import argparse
 import numpy as np
-import matplotlib.pylab as plt
 import nibabel as nib
 
 import dipy.reconst.dti as dti
@@ -38,9 +37,8 @@ from dipy.viz.colormap import line_colors
 
 import networkx as nx
 
-import matplotlib.colors as colors
-
 from condition_seeds import condition_seeds
+from matrix_png import save_matrix_png, save_matrix_panels
 
 #=============================================================================
 # FUNCTIONS
@@ -100,17 +98,8 @@ def save_mat(M, M_text_name):
 def save_png(M, M_fig_name):
     # Make a png image of the matrix
     if not os.path.exists(M_fig_name):
-
-        fig, ax = plt.subplots(figsize=(4,4))    
         # Plot the matrix on a log scale
-        axM = ax.imshow(np.log1p(M[1:,1:]), 
-                        interpolation='nearest',
-                        cmap='jet')
-        
-        # Add a colorbar
-        cbar = fig.colorbar(axM)
-
-        fig.savefig(M_fig_name, bbox_inches=0, dpi=600)
+        save_matrix_png(np.log1p(M[1:,1:]), M_fig_name)
 
 #=============================================================================
 # Define some variables
@@ -264,23 +253,13 @@ for M, name in zip([Msym, Mdir, Mdiff], ['Msym', 'Mdir', 'Mdiff']):
 # Save an image of all three matrices        
 fig_name = os.path.join(connectivity_dir, 'AllMatrices.png')
 if not os.path.exists(fig_name):
-    # Now make the plot of all three figures
-    fig, ax = plt.subplots(1,3, figsize=(12, 4))
-
-    M0 = ax[0].imshow(np.log1p(Msym[1:,1:]), interpolation='nearest', cmap='jet', 
-                    vmin=0, vmax=np.log1p(1000))
-    M1 = ax[1].imshow(np.log1p(Mdir[1:,1:]), interpolation='nearest', cmap='jet',
-                    vmin=0, vmax=np.log1p(1000))
-    M2 = ax[2].imshow(np.log1p(Mdiff[1:,1:]), interpolation='nearest', cmap='jet',
-                    vmin=0, vmax=np.log1p(1000))
-
-    ax[0].set_title('Symmetric')
-    ax[1].set_title('Directed')
-    ax[2].set_title('Difference\nA --> B and B --> A')
-
-    plt.tight_layout()
-
-    fig.savefig(fig_name, bbox_inches=0, dpi=600)
+    # Now make the plot of all three figures side by side
+    save_matrix_panels([ np.log1p(M[1:,1:]) for M in [Msym, Mdir, Mdiff] ],
+                            fig_name,
+                            vmin=0, vmax=np.log1p(1000),
+                            titles=[ 'Symmetric',
+                                     'Directed',
+                                     'Difference\nA --> B and B --> A' ])
 
 #------------------------------------------------
 ### THE END ###
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+'''
+Network measures across a range of costs for one weighted matrix.
+
+Rather than thresholding the matrix again at every cost and starting
+from scratch, the edges are added one at a time from the strongest
+to the weakest. The degree and number of triangles of every node
+(and so the clustering) and the connected components are updated as
+each edge goes in, and the measures are only read off when the
+network reaches one of the requested costs. Path length and
+efficiency can't be updated cheaply so the distances are calculated
+once, for all the snapshots together, at the end.
+
+Edges with the same weight are added in a random order (as in
+threshold_matrix.py) set by the seed.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import numpy as np
+
+import graph_measures as gm
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Calculate network measures at a range of costs for a connectivity matrix')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: M_file
+    parser.add_argument('M_file',
+                            type=str,
+                            metavar='M_file',
+                            help='Matrix (text file)')
+
+    # Optional argument: costs
+    parser.add_argument('--costs',
+                            dest='costs',
+                            type=float,
+                            nargs='+',
+                            help='costs (in %%) at which to calculate the measures',
+                            default=list(range(1, 31)),
+                            action='store')
+
+    # Optional argument: seed
+    parser.add_argument('--seed',
+                            dest='seed',
+                            type=int,
+                            help='random seed used to order edges with the same weight',
+                            default=0,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def sorted_edges(M, seed=0):
+    '''
+    The i, j indices of all the non-zero edges in the top triangle
+    of M ordered from the strongest to the weakest
+    '''
+    M = np.abs(np.asarray(M, dtype=float))
+    i, j = np.nonzero(np.triu(M, 1))
+    w = M[i, j]
+
+    # Sort by weight (descending) and then by a random number
+    # so that ties are broken randomly
+    tie_break = np.random.RandomState(seed).rand(w.shape[0])
+    order = np.lexsort((tie_break, -w))
+
+    return i[order], j[order]
+
+#-----------------------------------------------------------------------------
+
+def find_root(parent, u):
+    '''
+    Union find: the root of node u (with path halving)
+    '''
+    while parent[u] != u:
+        parent[u] = parent[parent[u]]
+        u = parent[u]
+    return u
+
+#-----------------------------------------------------------------------------
+
+def cost_curve(M, costs, seed=0):
+    '''
+    Calculate the network measures for matrix M at each of the costs
+    (fractions between 0 and 1).
+
+    Returns a dictionary with one value per cost for each measure:
+    cost, n_edges, kmean, a, C, L, E, CE, n_components and giant
+    (the number of nodes in the largest component).
+    Costs that need more edges than M has are left out.
+    '''
+    n = np.asarray(M).shape[0]
+    ei, ej = sorted_edges(M, seed=seed)
+    n_possible = n * (n - 1) / 2.0
+
+    # Number of edges (in the top triangle) at each cost
+    n_keep = np.round(np.asarray(costs, dtype=float) * n_possible).astype(int)
+    n_keep = np.unique(n_keep[(n_keep > 0) & (n_keep <= ei.shape[0])])
+
+    A = np.zeros([n, n], dtype=bool)
+    deg = np.zeros(n)
+    tri = np.zeros(n)
+
+    # Components: union find with sizes
+    parent = np.arange(n)
+    size = np.ones(n, dtype=int)
+    n_comp = n
+    giant = 1
+
+    snapshots = []
+    s = { 'n_edges' : n_keep,
+          'C' : [],
+          'n_components' : [],
+          'giant' : [] }
+
+    e = 0
+    for target in n_keep:
+        while e < target:
+            u, v = ei[e], ej[e]
+
+            # Every common neighbour of u and v makes a new triangle
+            common = np.flatnonzero(A[u] & A[v])
+            tri[u] += common.shape[0]
+            tri[v] += common.shape[0]
+            tri[common] += 1
+
+            A[u, v] = A[v, u] = True
+            deg[u] += 1
+            deg[v] += 1
+
+            ru, rv = find_root(parent, u), find_root(parent, v)
+            if ru != rv:
+                if size[ru] < size[rv]:
+                    ru, rv = rv, ru
+                parent[rv] = ru
+                size[ru] += size[rv]
+                giant = max(giant, size[ru])
+                n_comp -= 1
+
+            e += 1
+
+        # Take a snapshot
+        C = np.zeros(n)
+        ok = deg > 1
+        C[ok] = 2.0 * tri[ok] / (deg[ok] * (deg[ok] - 1))
+        s['C'].append(C.mean())
+        s['n_components'].append(n_comp)
+        s['giant'].append(giant)
+        snapshots.append(A.copy())
+
+    # The measures that need the whole network are calculated
+    # for all the snapshots at once
+    snapshots = np.array(snapshots).reshape([-1, n, n])
+    D = gm.distance_bin(snapshots)
+
+    s['C'] = np.array(s['C'])
+    s['n_components'] = np.array(s['n_components'])
+    s['giant'] = np.array(s['giant'])
+    s['cost'] = n_keep / n_possible
+    s['kmean'] = 2.0 * n_keep / n
+    s['a'] = gm.assortativity_bin(snapshots)
+    s['L'] = gm.path_length(D)
+    s['E'] = gm.efficiency_bin(D)
+    s['CE'] = s['E'] - s['cost']
+
+    return s
+
+#-----------------------------------------------------------------------------
+
+def save_cost_curve(s, csv_name):
+    '''
+    Write the cost curve to a comma separated file with one row per cost
+    '''
+    names = [ 'cost', 'n_edges', 'kmean', 'a', 'C', 'L', 'E', 'CE',
+                'n_components', 'giant' ]
+
+    with open(csv_name, 'w') as f:
+        f.write(','.join(names) + '\n')
+        for i in range(s['cost'].shape[0]):
+            f.write(','.join([ '{:.5f}'.format(s[name][i]) for name in names ]) + '\n')
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    M_file = arguments.M_file
+    costs = np.array(arguments.costs) / 100.0
+
+    # Load in the matrix
+    M = np.loadtxt(M_file)
+
+    # Calculate the measures at every cost
+    s = cost_curve(M, costs, seed=arguments.seed)
+
+    # And save them next to the matrix
+    csv_name = os.path.splitext(M_file)[0] + '_costCurve.csv'
+    save_cost_curve(s, csv_name)
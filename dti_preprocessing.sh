@@ -167,8 +167,16 @@ fi
 
 if [[ ! -f ${dir}/bvecs ]]; then
     echo "    Rotating bvecs"
-    ${rot_bvecs_script} ${dir}/bvecs_orig ${dir}/bvecs \
-        ${dir}/dti_ec.ecclog >> ${logdir}/eddycorrect 2> ${logdir}/errors_eddycorrect
+    # Use rotate_bvecs.py if it's saved next to this script
+    # as it's much faster than the shell script
+    py_rot_bvecs_script="$( cd "$( dirname "$0" )" && pwd )"/rotate_bvecs.py
+    if [[ -f ${py_rot_bvecs_script} ]]; then
+        python ${py_rot_bvecs_script} ${dir}/bvecs_orig ${dir}/bvecs \
+            ${dir}/dti_ec.ecclog >> ${logdir}/eddycorrect 2> ${logdir}/errors_eddycorrect
+    else
+        ${rot_bvecs_script} ${dir}/bvecs_orig ${dir}/bvecs \
+            ${dir}/dti_ec.ecclog >> ${logdir}/eddycorrect 2> ${logdir}/errors_eddycorrect
+    fi
 else
     echo "    Bvecs already rotated"
 fi
@@ -204,19 +212,37 @@ elif [[ ! -f ${dir}/bvecs ]]; then
 elif [[ ! -f ${dir}/FDT/${sub}_sse.nii.gz ]]; then
     echo "    Fitting tensor"
     mkdir -p ${dir}/FDT
-    dtifit -k ${dir}/dti_ec.nii.gz \
-        -m ${dir}/dti_ec_brain_mask.nii.gz \
-        -r ${dir}/bvecs \
-        -b ${dir}/bvals \
-        --sse \
-        --save_tensor \
-        -o ${dir}/FDT/${sub} \
-        > ${logdir}/dtifit 2> ${logdir}/errors_dtifit
+    # Use fit_tensors.py if it's saved next to this script
+    # as it only fits the voxels in the mask and can use more
+    # than one processor (set NSLOTS to the number of processors
+    # to use, as the cluster does). It makes the L23 map itself, and
+    # --save_tensor keeps the same outputs as dtifit --save_tensor
+    # (L2, L3, S0, V1, V2, V3 and the tensor)
+    py_fit_tensors_script="$( cd "$( dirname "$0" )" && pwd )"/fit_tensors.py
+    if [[ -f ${py_fit_tensors_script} ]]; then
+        python ${py_fit_tensors_script} ${dir}/dti_ec.nii.gz \
+            ${dir}/dti_ec_brain_mask.nii.gz \
+            ${dir}/bvecs \
+            ${dir}/bvals \
+            ${dir}/FDT/${sub} \
+            --save_tensor \
+            --n_jobs ${NSLOTS:-1} \
+            > ${logdir}/dtifit 2> ${logdir}/errors_dtifit
+    else
+        dtifit -k ${dir}/dti_ec.nii.gz \
+            -m ${dir}/dti_ec_brain_mask.nii.gz \
+            -r ${dir}/bvecs \
+            -b ${dir}/bvals \
+            --sse \
+            --save_tensor \
+            -o ${dir}/FDT/${sub} \
+            > ${logdir}/dtifit 2> ${logdir}/errors_dtifit
     
-    # Add L2 and L3 together and divide by two to create a measure of
-    # radial (perpendicular) diffusivity
-    fslmaths ${dir}/FDT/${sub}_L2.nii.gz -add ${dir}/FDT/${sub}_L3.nii.gz -div 2 \
-        ${dir}/FDT/${sub}_L23.nii.gz
+        # Add L2 and L3 together and divide by two to create a measure of
+        # radial (perpendicular) diffusivity
+        fslmaths ${dir}/FDT/${sub}_L2.nii.gz -add ${dir}/FDT/${sub}_L3.nii.gz -div 2 \
+            ${dir}/FDT/${sub}_L23.nii.gz
+    fi
 
 else
    echo "    Tensor already fit"
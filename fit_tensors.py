@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+'''
+Fit the diffusion tensor in python and save the FDT maps.
+
+This does the job of dtifit (followed by the fslmaths step that makes
+the L23 map) for the maps that the rest of the scripts use:
+
+    <out_base>_FA, _MD, _MO, _L1, _L23 and _sse (all .nii.gz)
+
+With --save_tensor the rest of the images that dtifit --save_tensor
+writes are saved too: _L2, _L3, _S0, the eigenvectors _V1, _V2 and _V3
+(3 volumes each) and _tensor (6 volumes: Dxx, Dxy, Dxz, Dyy, Dyz, Dzz).
+They aren't used by the other scripts so they're left out by default.
+
+Only the voxels inside the brain mask are fitted. The data is read one
+volume at a time into a (n_voxels, n_vols) float32 array of the masked
+voxels, which is split into chunks of voxels that are fitted in a pool
+of processes.
+
+The fit is linear least squares of the log signal (as dtifit does,
+and like dtifit a signal of zero or less is treated as 1) which is one
+matrix product per chunk with the pseudo-inverse of the design
+matrix. With --wls the ordinary least squares fit is used to
+weight a second, weighted least squares fit (weights of the predicted
+signal squared, Salvador et al 2005) which solves a 7x7 system for
+every voxel of the chunk at the same time.
+
+The sse map is the sum of the squared residuals of the fit to the log
+signal. The mode (MO) is 3 * sqrt(6) * det of the normalised
+anisotropic part of the tensor (Ennis and Kindlmann 2006), the same
+as dtifit's.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import multiprocessing as mp
+import numpy as np
+import nibabel as nib
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Fit diffusion tensors inside a brain mask and save the FDT maps')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: data
+    parser.add_argument(dest='data',
+                            type=str,
+                            metavar='data',
+                            help='diffusion weighted data (eg: dti_ec.nii.gz)')
+
+    # Required argument: mask
+    parser.add_argument(dest='mask',
+                            type=str,
+                            metavar='mask',
+                            help='brain mask (eg: dti_ec_brain_mask.nii.gz)')
+
+    # Required argument: bvecs
+    parser.add_argument(dest='bvecs',
+                            type=str,
+                            metavar='bvecs',
+                            help='bvecs file')
+
+    # Required argument: bvals
+    parser.add_argument(dest='bvals',
+                            type=str,
+                            metavar='bvals',
+                            help='bvals file')
+
+    # Required argument: out_base
+    parser.add_argument(dest='out_base',
+                            type=str,
+                            metavar='out_base',
+                            help='output basename (eg: FDT/<sub>)')
+
+    # Optional argument: wls
+    parser.add_argument('--wls',
+                            dest='wls',
+                            help='fit the tensor with weighted least squares',
+                            action='store_true',
+                            default=False)
+
+    # Optional argument: save_tensor
+    parser.add_argument('--save_tensor',
+                            dest='save_tensor',
+                            help=('also save the L2, L3, S0, V1, V2, V3 and tensor images'
+                                    ' (as dtifit --save_tensor does)'),
+                            action='store_true',
+                            default=False)
+
+    # Optional argument: n_jobs
+    parser.add_argument('--n_jobs',
+                            dest='n_jobs',
+                            type=int,
+                            help='number of processes fitting chunks of voxels',
+                            default=1,
+                            action='store')
+
+    # Optional argument: chunk_size
+    parser.add_argument('--chunk_size',
+                            dest='chunk_size',
+                            type=int,
+                            help='number of voxels in each chunk',
+                            default=20000,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+# The maps that are saved, in the order fit_chunk returns them
+MAPS = [ 'FA', 'MD', 'MO', 'L1', 'L23', 'sse' ]
+
+# The extra images (and how many volumes each has) that are saved
+# with --save_tensor, in the order fit_chunk returns them after MAPS
+TENSOR_MAPS = [ ('L2', 1), ('L3', 1), ('S0', 1),
+                ('V1', 3), ('V2', 3), ('V3', 3),
+                ('tensor', 6) ]
+
+#-----------------------------------------------------------------------------
+
+def design_matrix(bvals, bvecs):
+    '''
+    The (n_vols, 7) design matrix for the log signal:
+    log(S) = B . [ Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, log(S0) ]
+    '''
+    bvals = np.asarray(bvals, dtype=float).reshape(-1)
+    gx, gy, gz = np.asarray(bvecs, dtype=float)
+
+    return np.column_stack([ -bvals * gx * gx,
+                             -bvals * gy * gy,
+                             -bvals * gz * gz,
+                             -2 * bvals * gx * gy,
+                             -2 * bvals * gx * gz,
+                             -2 * bvals * gy * gz,
+                             np.ones_like(bvals) ])
+
+#-----------------------------------------------------------------------------
+
+def masked_signal(data_file, mask):
+    '''
+    The signal of every voxel in the mask as an (n_voxels, n_vols)
+    float32 array. Volumes are read one at a time.
+    '''
+    # Keeping the file open means that the volumes are read in turn
+    # rather than decompressing the file from the start every time
+    img = nib.load(data_file, keep_file_open=True)
+    n_vols = img.shape[3]
+
+    signal = np.zeros([mask.sum(), n_vols], dtype=np.float32)
+    for v in range(n_vols):
+        signal[:, v] = np.asarray(img.dataobj[..., v], dtype=np.float32)[mask]
+
+    return signal
+
+#-----------------------------------------------------------------------------
+
+def fit_chunk(signal, B, B_pinv, wls=False, save_tensor=False):
+    '''
+    Fit the tensor to an (n_voxels, n_vols) chunk of signal and
+    return an (n_voxels, 6) float32 array of the MAPS (followed by
+    the 18 volumes of the TENSOR_MAPS if save_tensor is True)
+    '''
+    # Signal of zero (or less) has no log, so it's set to 1 (a log
+    # of 0) as dtifit does, rather than a tiny value whose log would
+    # pull the fit and the sse around at the edge of the mask
+    log_s = np.log(np.where(signal > 0, signal, np.float32(1)))
+
+    params = log_s.dot(B_pinv.T)
+
+    if wls:
+        # Weight every volume by its predicted signal squared and
+        # solve the normal equations of all the voxels at once
+        # (the weights are scaled by each voxel's largest so that
+        # they stay sensible in float32)
+        pred = params.dot(B.T)
+        w = np.exp(2 * (pred - pred.max(axis=1, keepdims=True)))
+        BtWB = np.einsum('vi,ij,ik->vjk', w, B, B)
+        BtWy = np.einsum('vi,ij,vi->vj', w, B, log_s)
+        params = np.linalg.solve(BtWB, BtWy[..., np.newaxis])[..., 0]
+
+    sse = ((log_s - params.dot(B.T)) ** 2).sum(axis=1)
+
+    # The tensors and their eigenvalues (largest first)
+    D = np.zeros([signal.shape[0], 3, 3], dtype=np.float32)
+    D[:, 0, 0], D[:, 1, 1], D[:, 2, 2] = params[:, 0], params[:, 1], params[:, 2]
+    D[:, 0, 1] = D[:, 1, 0] = params[:, 3]
+    D[:, 0, 2] = D[:, 2, 0] = params[:, 4]
+    D[:, 1, 2] = D[:, 2, 1] = params[:, 5]
+    if save_tensor:
+        evals, evecs = np.linalg.eigh(D)
+        evals, evecs = evals[:, ::-1], evecs[:, :, ::-1]
+    else:
+        evals = np.linalg.eigvalsh(D)[:, ::-1]
+
+    md = evals.mean(axis=1)
+    dev = evals - md[:, np.newaxis]
+    norm_dev = (dev ** 2).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fa = np.sqrt(1.5 * norm_dev / (evals ** 2).sum(axis=1))
+        mo = 3 * np.sqrt(6) * dev.prod(axis=1) / norm_dev ** 1.5
+
+    fa = np.where(np.isfinite(fa), fa, 0)
+    mo = np.where(np.isfinite(mo), np.clip(mo, -1, 1), 0)
+
+    maps = np.column_stack([ fa,
+                             md,
+                             mo,
+                             evals[:, 0],
+                             (evals[:, 1] + evals[:, 2]) / 2,
+                             sse ])
+
+    if save_tensor:
+        maps = np.column_stack([ maps,
+                                 evals[:, 1],
+                                 evals[:, 2],
+                                 np.exp(params[:, 6]),
+                                 evecs[:, :, 0],
+                                 evecs[:, :, 1],
+                                 evecs[:, :, 2],
+                                 params[:, [0, 3, 4, 1, 5, 2]] ])
+
+    return maps.astype(np.float32)
+
+#-----------------------------------------------------------------------------
+
+def _init_worker(B, B_pinv, wls, save_tensor):
+    global _design
+    _design = (B, B_pinv, wls, save_tensor)
+
+def _fit_worker(signal):
+    B, B_pinv, wls, save_tensor = _design
+    return fit_chunk(signal, B, B_pinv, wls=wls, save_tensor=save_tensor)
+
+#-----------------------------------------------------------------------------
+
+def fit_tensors(data_file, mask_file, bvecs_file, bvals_file, out_base,
+                    wls=False, save_tensor=False, n_jobs=1, chunk_size=20000):
+    '''
+    Fit the tensor in every voxel of the mask and save the MAPS
+    (and the TENSOR_MAPS if save_tensor is True) as
+    <out_base>_<map>.nii.gz
+    '''
+    mask_img = nib.load(mask_file)
+    mask = np.asarray(mask_img.dataobj) > 0
+
+    bvals = np.loadtxt(bvals_file).reshape(-1)
+    bvecs = np.loadtxt(bvecs_file, ndmin=2)
+    if bvecs.shape[0] != 3 and bvecs.shape[1] == 3:
+        bvecs = bvecs.T
+
+    B = design_matrix(bvals, bvecs)
+    B_pinv = np.linalg.pinv(B)
+    B, B_pinv = B.astype(np.float32), B_pinv.astype(np.float32)
+
+    signal = masked_signal(data_file, mask)
+    chunks = [ signal[i:i+chunk_size] for i in range(0, signal.shape[0], chunk_size) ]
+
+    if n_jobs > 1:
+        pool = mp.Pool(n_jobs, initializer=_init_worker, initargs=(B, B_pinv, wls, save_tensor))
+        results = pool.map(_fit_worker, chunks)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(B, B_pinv, wls, save_tensor)
+        results = [ _fit_worker(chunk) for chunk in chunks ]
+
+    names = [ (name, 1) for name in MAPS ]
+    if save_tensor:
+        names += TENSOR_MAPS
+    n_cols = sum([ n_vols for name, n_vols in names ])
+
+    maps = np.concatenate(results) if results else np.zeros([0, n_cols], dtype=np.float32)
+
+    out_dir = os.path.dirname(os.path.abspath(out_base))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    start = 0
+    for name, n_vols in names:
+        if n_vols == 1:
+            data = np.zeros(mask.shape, dtype=np.float32)
+            data[mask] = maps[:, start]
+        else:
+            data = np.zeros(mask.shape + (n_vols,), dtype=np.float32)
+            data[mask] = maps[:, start:start+n_vols]
+        start += n_vols
+        img = nib.Nifti1Image(data, mask_img.affine, mask_img.header)
+        img.set_data_dtype(np.float32)
+        nib.save(img, '{}_{}.nii.gz'.format(out_base, name))
+
+    return maps
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    fit_tensors(arguments.data,
+                    arguments.mask,
+                    arguments.bvecs,
+                    arguments.bvals,
+                    arguments.out_base,
+                    wls=arguments.wls,
+                    save_tensor=arguments.save_tensor,
+                    n_jobs=arguments.n_jobs,
+                    chunk_size=arguments.chunk_size)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+'''
+Calculate graph theory measures for a whole cohort of binary
+undirected networks at once.
+
+These are the same measures that gmeasure.m calculates with the
+Brain Connectivity Toolbox (degree, assortativity, clustering,
+distance, path length, small world coefficient and efficiency) but
+rather than looping over subjects every function works on a stack
+of adjacency matrices with shape (n_subs, n_nodes, n_nodes).
+A single (n_nodes, n_nodes) matrix is treated as a stack of one.
+
+The BCT function each measure reproduces is given in its docstring.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import numpy as np
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Calculate graph measures for a list of connectivity matrices')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: M_file_list
+    parser.add_argument(dest='M_file_list',
+                            type=str,
+                            metavar='M_file_list',
+                            help='Text file containing full paths of all matrices')
+
+    # Optional argument: n_null
+    parser.add_argument('--n_null',
+                            dest='n_null',
+                            type=int,
+                            help='number of random networks per subject (0 for none)',
+                            default=0,
+                            action='store')
+
+    # Optional argument: n_iter
+    parser.add_argument('--n_iter',
+                            dest='n_iter',
+                            type=int,
+                            help='number of times each edge is rewired in the random networks',
+                            default=5,
+                            action='store')
+
+    # Optional argument: n_jobs
+    parser.add_argument('--n_jobs',
+                            dest='n_jobs',
+                            type=int,
+                            help='number of processes used to make the random networks',
+                            default=1,
+                            action='store')
+
+    # Optional argument: seed
+    parser.add_argument('--seed',
+                            dest='seed',
+                            type=int,
+                            help='random seed for the random networks',
+                            default=0,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def as_stack(A):
+    '''
+    Make sure A is a 3D stack of matrices (n_subs, n_nodes, n_nodes)
+    '''
+    A = np.asarray(A)
+    if A.ndim == 2:
+        A = A[np.newaxis, :, :]
+    return A
+
+#-----------------------------------------------------------------------------
+
+def load_matrix_stack(M_file_list):
+    '''
+    Load all the matrices in M_file_list into one
+    (n_subs, n_nodes, n_nodes) array
+    '''
+    return np.array([ np.loadtxt(M_file) for M_file in M_file_list ])
+
+#-----------------------------------------------------------------------------
+
+def binarize_stack(M):
+    '''
+    Convert a stack of weighted matrices into binary undirected
+    adjacency matrices in the same way as NetworkMeasuresDTI_loop.m:
+    take the absolute value, zero the diagonal and set every
+    remaining non-zero value to 1.
+    '''
+    A = np.abs(as_stack(M)) > 0
+    n = A.shape[-1]
+    A[:, np.arange(n), np.arange(n)] = False
+    return A
+
+#-----------------------------------------------------------------------------
+
+def cost(A):
+    '''
+    The proportion of all possible connections that are present
+    (enum/(n*(n-1)) in NetworkMeasuresDTI_loop.m)
+    '''
+    A = as_stack(A)
+    n = A.shape[-1]
+    return np.count_nonzero(A, axis=(1, 2)) / float(n * (n - 1))
+
+#-----------------------------------------------------------------------------
+
+def degrees_und(A):
+    '''
+    Number of connections of each node (BCT: degrees_und)
+    Returns an (n_subs, n_nodes) array
+    '''
+    return as_stack(A).sum(axis=-1).astype(float)
+
+#-----------------------------------------------------------------------------
+
+def assortativity_bin(A):
+    '''
+    Degree correlation between the two ends of each edge
+    (BCT: assortativity_bin with flag 0)
+
+    The sums over edges in the BCT code are rewritten as sums over
+    nodes so that nothing needs to be looped over:
+        sum(degi.*degj)            = k'Ak / 2
+        sum(0.5*(degi+degj))       = sum(k.^2) / 2
+        sum(0.5*(degi.^2+degj.^2)) = sum(k.^3) / 2
+    '''
+    A = as_stack(A).astype(float)
+    k = A.sum(axis=-1)
+
+    K = k.sum(axis=-1) / 2.0
+    prod = np.einsum('si,sij,sj->s', k, A, k) / 2.0
+    mean = (k ** 2).sum(axis=-1) / 2.0
+    sq = (k ** 3).sum(axis=-1) / 2.0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (prod / K - (mean / K) ** 2) / (sq / K - (mean / K) ** 2)
+
+    return r
+
+#-----------------------------------------------------------------------------
+
+def triangles(A):
+    '''
+    Number of triangles around each node, the diagonal of A^3 / 2
+    Returns an (n_subs, n_nodes) array
+    '''
+    A = as_stack(A).astype(np.float32)
+    # Only the diagonal of A^3 is needed so there's no need for the
+    # second matrix product: diag(A.A.A) = sum((A.A) * A, along rows)
+    return (np.matmul(A, A) * A).sum(axis=-1).astype(float) / 2.0
+
+#-----------------------------------------------------------------------------
+
+def clustering_coef_bu(A, tri=None):
+    '''
+    Clustering coefficient of each node (BCT: clustering_coef_bu)
+    Nodes with fewer than two neighbours have a clustering of 0
+    Returns an (n_subs, n_nodes) array
+    '''
+    k = degrees_und(A)
+    if tri is None:
+        tri = triangles(A)
+
+    C = np.zeros_like(k)
+    ok = k > 1
+    C[ok] = 2.0 * tri[ok] / (k[ok] * (k[ok] - 1))
+
+    return C
+
+#-----------------------------------------------------------------------------
+
+def distance_bin(A):
+    '''
+    Shortest path length between every pair of nodes (BCT: distance_bin)
+
+    All subjects and all source nodes are searched at the same time by
+    expanding a boolean frontier one step at a time, so there are at
+    most n_nodes - 1 (and usually only a handful of) matrix products.
+    Unconnected pairs are np.inf, the diagonal is 0.
+    Returns an (n_subs, n_nodes, n_nodes) array
+    '''
+    A = as_stack(A).astype(np.float32)
+    n_subs, n = A.shape[0], A.shape[-1]
+
+    D = np.full(A.shape, np.inf)
+    reached = np.zeros(A.shape, dtype=bool)
+    reached[:, np.arange(n), np.arange(n)] = True
+    D[reached] = 0
+
+    frontier = reached.astype(np.float32)
+
+    for d in range(1, n):
+        new = (np.matmul(frontier, A) > 0) & ~reached
+        if not new.any():
+            break
+        D[new] = d
+        reached |= new
+        frontier = new.astype(np.float32)
+
+    return D
+
+#-----------------------------------------------------------------------------
+
+def path_length(D):
+    '''
+    Characteristic path length as it is calculated in gmeasure.m:
+        mean(mean(Dist))*n/(n-1)
+    which is the mean over all off diagonal distances.
+    This is np.inf for any network that is not connected.
+    '''
+    D = as_stack(D)
+    n = D.shape[-1]
+    return D.sum(axis=(1, 2)) / float(n * (n - 1))
+
+#-----------------------------------------------------------------------------
+
+def efficiency_bin(D):
+    '''
+    Global efficiency from a distance matrix (BCT: efficiency_bin)
+    The mean of the inverse distances between all pairs of nodes
+    '''
+    D = as_stack(D)
+    n = D.shape[-1]
+    with np.errstate(divide='ignore'):
+        invD = 1.0 / D
+    invD[:, np.arange(n), np.arange(n)] = 0
+    return invD.sum(axis=(1, 2)) / float(n * (n - 1))
+
+#-----------------------------------------------------------------------------
+
+def small_world_sigma(C, L, Crand, Lrand):
+    '''
+    Small world coefficient (C/Crand)/(L/Lrand)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (C / Crand) / (L / Lrand)
+
+#-----------------------------------------------------------------------------
+
+def graph_measures(A):
+    '''
+    Calculate all the gmeasure.m measures (other than modularity)
+    for a stack of binary adjacency matrices.
+
+    Returns a dictionary that uses the same names as the s structure
+    in NetworkMeasuresDTI_loop.m, each value has one entry per subject
+    (k has one row per subject).
+    '''
+    A = as_stack(A)
+
+    k = degrees_und(A)
+    tri = triangles(A)
+    D = distance_bin(A)
+
+    s = {}
+    s['cost'] = cost(A)
+    s['k'] = k
+    s['kmean'] = k.mean(axis=-1)
+    s['a'] = assortativity_bin(A)
+    s['C'] = clustering_coef_bu(A, tri=tri).mean(axis=-1)
+    s['L'] = path_length(D)
+    s['E'] = efficiency_bin(D)
+    s['CE'] = s['E'] - s['cost']
+
+    return s
+
+#-----------------------------------------------------------------------------
+
+def save_measures(s, M_file_list, csv_name, names=None):
+    '''
+    Write the global measures to a comma separated file
+    with one row per matrix file
+    '''
+    if names is None:
+        names = [ name for name in sorted(s.keys()) if s[name].ndim == 1 ]
+
+    with open(csv_name, 'w') as f:
+        f.write(','.join(['M_file'] + names) + '\n')
+        for i, M_file in enumerate(M_file_list):
+            values = [ '{:.5f}'.format(s[name][i]) for name in names ]
+            f.write(','.join([M_file] + values) + '\n')
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+    M_file_list_file = arguments.M_file_list
+
+    M_file_list = [ M.strip() for M in open(M_file_list_file) if M.strip() ]
+
+    # Load all the matrices and binarize them
+    A = binarize_stack(load_matrix_stack(M_file_list))
+
+    # Calculate the measures for everyone at the same time
+    s = graph_measures(A)
+
+    # Compare them to the average of the random networks
+    if arguments.n_null > 0:
+        from null_models import null_measures, normalised_measures
+        rand = null_measures(A,
+                                n_null=arguments.n_null,
+                                n_iter=arguments.n_iter,
+                                seed=arguments.seed,
+                                n_jobs=arguments.n_jobs)
+        s = normalised_measures(s, rand)
+
+    # Save the measures next to the list file
+    csv_name = os.path.splitext(M_file_list_file)[0] + '_graphMeasures.csv'
+    save_measures(s, M_file_list, csv_name)
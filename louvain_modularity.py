@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+'''
+Modularity of binary undirected networks with the Louvain method.
+
+gmeasure.m runs modularity_louvain_und once per subject, but the
+Louvain method starts from a random node order so it can give a
+different answer every time. Here it is run many times (restarts) in
+a pool of worker processes and the best modularity (Q) is kept.
+
+The restarts are also combined into a consensus partition: the
+fraction of restarts in which every pair of nodes ends up in the same
+module is itself clustered with the Louvain method until all the
+runs agree (Lancichinetti & Fortunato, 2012; BCT: consensus_und).
+
+Q can also be calculated for degree preserving random networks made
+with null_models.py, which gives the Mrand measure that is commented
+out in gmeasure.m.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import argparse
+import multiprocessing as mp
+import numpy as np
+import scipy.sparse as sp
+
+import graph_measures as gm
+from null_models import randmio_und_connected, null_seed
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Calculate the modularity of a list of connectivity matrices')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: M_file_list
+    parser.add_argument(dest='M_file_list',
+                            type=str,
+                            metavar='M_file_list',
+                            help='Text file containing full paths of all matrices')
+
+    # Optional argument: n_restarts
+    parser.add_argument('--n_restarts',
+                            dest='n_restarts',
+                            type=int,
+                            help='number of times to run the Louvain method per subject',
+                            default=100,
+                            action='store')
+
+    # Optional argument: n_null
+    parser.add_argument('--n_null',
+                            dest='n_null',
+                            type=int,
+                            help='number of random networks per subject (0 for none)',
+                            default=0,
+                            action='store')
+
+    # Optional argument: n_null_restarts
+    parser.add_argument('--n_null_restarts',
+                            dest='n_null_restarts',
+                            type=int,
+                            help='number of times to run the Louvain method per random network',
+                            default=10,
+                            action='store')
+
+    # Optional argument: tau
+    parser.add_argument('--tau',
+                            dest='tau',
+                            type=float,
+                            help='agreement threshold for the consensus partition',
+                            default=0.5,
+                            action='store')
+
+    # Optional argument: n_jobs
+    parser.add_argument('--n_jobs',
+                            dest='n_jobs',
+                            type=int,
+                            help='number of processes',
+                            default=1,
+                            action='store')
+
+    # Optional argument: seed
+    parser.add_argument('--seed',
+                            dest='seed',
+                            type=int,
+                            help='random seed',
+                            default=0,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def modularity(A, ci):
+    '''
+    Newman's modularity Q of the partition ci of the network A
+    '''
+    A = sp.coo_matrix(A, dtype=float)
+    m2 = A.sum()
+    if m2 == 0:
+        return 0.0
+
+    k = np.asarray(A.sum(axis=1)).ravel()
+    same = ci[A.row] == ci[A.col]
+    within = A.data[same].sum()
+    tot = np.bincount(ci, weights=k)
+
+    return (within - (tot ** 2).sum() / m2) / m2
+
+#-----------------------------------------------------------------------------
+
+def _move_nodes(A, k, m2, order):
+    '''
+    The first phase of the Louvain method: move single nodes to the
+    neighbouring module that increases Q the most until no move helps.
+    Returns the module of each node and whether anything moved.
+    '''
+    n = A.shape[0]
+    indptr, indices, data = A.indptr, A.indices, A.data
+
+    comm = np.arange(n)
+    tot = k.copy()
+
+    improved = False
+    moved = True
+    while moved:
+        moved = False
+        for i in order:
+            nb = indices[indptr[i]:indptr[i+1]]
+            w = data[indptr[i]:indptr[i+1]]
+            not_self = nb != i
+            nb, w = nb[not_self], w[not_self]
+
+            ci = comm[i]
+            tot[ci] -= k[i]
+
+            # Sum of the weights from i to each neighbouring module
+            cands, inv = np.unique(comm[nb], return_inverse=True)
+            k_in = np.bincount(inv, weights=w)
+
+            # Gain in Q from putting i back where it was...
+            best_c = ci
+            best_gain = k_in[cands == ci].sum() - tot[ci] * k[i] / m2
+
+            # ...and from each neighbouring module
+            if cands.shape[0] > 0:
+                gain = k_in - tot[cands] * k[i] / m2
+                j = np.argmax(gain)
+                if gain[j] > best_gain + 1e-10:
+                    best_c = cands[j]
+
+            tot[best_c] += k[i]
+            if best_c != ci:
+                comm[i] = best_c
+                moved = True
+                improved = True
+
+    return comm, improved
+
+#-----------------------------------------------------------------------------
+
+def louvain(A, random_state=None):
+    '''
+    Find the modules of A with the Louvain method
+    (BCT: modularity_louvain_und). random_state can be a seed or
+    a np.random.RandomState and sets the order the nodes are visited.
+
+    Returns the module of each node (numbered from 0) and Q.
+    '''
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    A0 = sp.csr_matrix(A, dtype=float)
+    A = A0
+    m2 = A.sum()
+    n = A.shape[0]
+
+    ci = np.arange(n)
+    if m2 == 0:
+        return ci, 0.0
+
+    while True:
+        k = np.asarray(A.sum(axis=1)).ravel()
+        order = random_state.permutation(A.shape[0])
+
+        comm, improved = _move_nodes(A, k, m2, order)
+        if not improved:
+            break
+
+        # Second phase: each module becomes a node of a new network
+        _, comm = np.unique(comm, return_inverse=True)
+        ci = comm[ci]
+        P = sp.csr_matrix((np.ones(comm.shape[0]), (np.arange(comm.shape[0]), comm)))
+        A = P.T.dot(A).dot(P).tocsr()
+
+    return ci, modularity(A0, ci)
+
+#-----------------------------------------------------------------------------
+
+# Tags that keep the random numbers of the restarts, the consensus
+# clustering and the restarts on the null networks apart
+RESTARTS, CONSENSUS, NULL = 0, 1, 2
+
+def louvain_seed(seed, sub, stream, *keys):
+    '''
+    The random seed for one run of the Louvain method: one of the
+    streams above for one subject, then eg: the restart number
+    '''
+    return [seed, sub, stream] + list(keys)
+
+#-----------------------------------------------------------------------------
+
+def _louvain_worker(task):
+    '''
+    Run the Louvain method on one network with one seed
+    '''
+    A, key, seed = task
+    ci, Q = louvain(A, random_state=seed)
+    return key, ci, Q
+
+#-----------------------------------------------------------------------------
+
+def run_louvain(tasks, pool=None):
+    '''
+    Run a list of (A, key, seed) Louvain tasks, in the pool if given
+    '''
+    if pool is None:
+        return list(map(_louvain_worker, tasks))
+    return pool.map(_louvain_worker, tasks)
+
+#-----------------------------------------------------------------------------
+
+def agreement(partitions):
+    '''
+    The fraction of partitions in which each pair of nodes are
+    in the same module (BCT: agreement)
+    '''
+    partitions = np.asarray(partitions)
+    n_part, n = partitions.shape
+
+    # Give every module in every partition its own column
+    offsets = np.concatenate([[0], np.cumsum(partitions.max(axis=1) + 1)[:-1]])
+    cols = (partitions + offsets[:, np.newaxis]).reshape(-1)
+    rows = np.tile(np.arange(n), n_part)
+    H = sp.csr_matrix((np.ones(cols.shape[0]), (rows, cols)))
+
+    return H.dot(H.T).toarray() / float(n_part)
+
+#-----------------------------------------------------------------------------
+
+def consensus_partition(partitions, tau=0.5, n_reps=None, sub=0, seed=0, pool=None,
+                            max_iter=20):
+    '''
+    Combine many partitions of the same network into one
+    (BCT: consensus_und).
+
+    Pairs of nodes that are in the same module less often than tau
+    are disconnected and the agreement matrix is clustered n_reps
+    times until all the answers are the same.
+    '''
+    partitions = np.asarray(partitions)
+    if n_reps is None:
+        n_reps = partitions.shape[0]
+
+    D = agreement(partitions)
+    n = D.shape[0]
+
+    for it in range(max_iter):
+        D[D < tau] = 0
+        D[np.arange(n), np.arange(n)] = 0
+
+        tasks = [ (D, rep, louvain_seed(seed, sub, CONSENSUS, it, rep))
+                        for rep in range(n_reps) ]
+        partitions = np.array([ ci for key, ci, Q in run_louvain(tasks, pool=pool) ])
+
+        D = agreement(partitions)
+        if np.all((D == 0) | (D == 1)):
+            break
+
+    return partitions[0]
+
+#-----------------------------------------------------------------------------
+
+def subject_modularity(A, n_restarts=100, sub=0, seed=0, pool=None):
+    '''
+    Run the Louvain method n_restarts times on A.
+    Returns all the partitions (n_restarts, n_nodes) and Q values.
+    '''
+    tasks = [ (A, restart, louvain_seed(seed, sub, RESTARTS, restart))
+                    for restart in range(n_restarts) ]
+    results = run_louvain(tasks, pool=pool)
+
+    partitions = np.array([ ci for key, ci, Q in results ])
+    Q = np.array([ Q for key, ci, Q in results ])
+
+    return partitions, Q
+
+#-----------------------------------------------------------------------------
+
+def _null_Q_worker(task):
+    '''
+    Make one random network and return its best Q
+    '''
+    A, sub, null, n_iter, n_restarts, seed = task
+
+    # The same random network as null_models.py makes for this
+    # subject and seed
+    R = randmio_und_connected(A, n_iter=n_iter,
+                                random_state=null_seed(seed, sub, null))
+    R = sp.csr_matrix(R, dtype=float)
+
+    return max([ louvain(R, random_state=louvain_seed(seed, sub, NULL, null, restart))[1]
+                    for restart in range(n_restarts) ])
+
+#-----------------------------------------------------------------------------
+
+def null_modularity(A, sub=0, n_null=100, n_iter=5, n_restarts=10, seed=0,
+                        pool=None):
+    '''
+    The best Q of each of n_null degree preserving random versions of A
+    '''
+    tasks = [ (A, sub, null, n_iter, n_restarts, seed) for null in range(n_null) ]
+    if pool is None:
+        return np.array(list(map(_null_Q_worker, tasks)))
+    return np.array(pool.map(_null_Q_worker, tasks))
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+    M_file_list_file = arguments.M_file_list
+
+    M_file_list = [ M.strip() for M in open(M_file_list_file) if M.strip() ]
+
+    # Load all the matrices and binarize them
+    A_stack = gm.binarize_stack(gm.load_matrix_stack(M_file_list))
+
+    pool = None
+    if arguments.n_jobs > 1:
+        pool = mp.Pool(arguments.n_jobs)
+
+    csv_name = os.path.splitext(M_file_list_file)[0] + '_modularity.csv'
+    ci_name = os.path.splitext(M_file_list_file)[0] + '_consensusPartitions.txt'
+
+    with open(csv_name, 'w') as f:
+        f.write('M_file,M,M_std,n_modules,Mrand,Mrand_std\n')
+
+        consensus = []
+        for sub, (M_file, A) in enumerate(zip(M_file_list, A_stack)):
+            print('{}'.format(M_file))
+            A = sp.csr_matrix(A, dtype=float)
+
+            partitions, Q = subject_modularity(A,
+                                                n_restarts=arguments.n_restarts,
+                                                sub=sub,
+                                                seed=arguments.seed,
+                                                pool=pool)
+
+            ci = consensus_partition(partitions,
+                                        tau=arguments.tau,
+                                        sub=sub,
+                                        seed=arguments.seed,
+                                        pool=pool)
+            consensus.append(ci)
+
+            Qrand = np.array([np.nan])
+            if arguments.n_null > 0:
+                Qrand = null_modularity(A_stack[sub],
+                                        sub=sub,
+                                        n_null=arguments.n_null,
+                                        n_restarts=arguments.n_null_restarts,
+                                        seed=arguments.seed,
+                                        pool=pool)
+
+            f.write('{},{:.5f},{:.5f},{:d},{:.5f},{:.5f}\n'.format(M_file,
+                                                    Q.max(),
+                                                    Q.std(),
+                                                    ci.max() + 1,
+                                                    Qrand.mean(),
+                                                    Qrand.std()))
+
+    np.savetxt(ci_name, np.array(consensus), fmt='%d', delimiter='\t')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+'''
+Write pictures of connectivity matrices straight to png files
+without going through matplotlib.
+
+Each value is looked up in a precomputed colour table (the same jet
+colour map that imshow uses), every matrix entry is blown up into a
+square block of pixels by repeating it, and the colourbar and side
+by side panels are simply pasted into the same array before it is
+compressed and written out.
+
+The colourbar's values (the bottom, middle and top of the colour
+scale) and the panel titles are written into the array with a small
+5 x 7 pixel bitmap font (capital letters, numbers and a little
+punctuation). The colour scale and titles are also saved as text in
+the png file (tEXt chunks) so that they can be read back exactly.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import struct
+import zlib
+import numpy as np
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+def make_jet_lut(n=256):
+    '''
+    A (n, 3) uint8 colour table that matches matplotlib's jet colour map
+    '''
+    # The break points of matplotlib's jet segment data
+    red = [ (0., 0.), (0.35, 0.), (0.66, 1.), (0.89, 1.), (1., 0.5) ]
+    green = [ (0., 0.), (0.125, 0.), (0.375, 1.), (0.64, 1.), (0.91, 0.), (1., 0.) ]
+    blue = [ (0., 0.5), (0.11, 1.), (0.34, 1.), (0.65, 0.), (1., 0.) ]
+
+    x = np.linspace(0, 1, n)
+    lut = np.zeros([n, 3])
+    for i, segments in enumerate([red, green, blue]):
+        xp, fp = zip(*segments)
+        lut[:, i] = np.interp(x, xp, fp)
+
+    return np.round(lut * 255).astype(np.uint8)
+
+JET_LUT = make_jet_lut()
+
+#-----------------------------------------------------------------------------
+
+# A 5 x 7 pixel bitmap font. Lower case letters are drawn as capitals.
+FONT = {
+    ' ' : [ '.....', '.....', '.....', '.....', '.....', '.....', '.....' ],
+    '0' : [ '.###.', '#...#', '#..##', '#.#.#', '##..#', '#...#', '.###.' ],
+    '1' : [ '..#..', '.##..', '..#..', '..#..', '..#..', '..#..', '.###.' ],
+    '2' : [ '.###.', '#...#', '....#', '...#.', '..#..', '.#...', '#####' ],
+    '3' : [ '#####', '...#.', '..#..', '...#.', '....#', '#...#', '.###.' ],
+    '4' : [ '...#.', '..##.', '.#.#.', '#..#.', '#####', '...#.', '...#.' ],
+    '5' : [ '#####', '#....', '####.', '....#', '....#', '#...#', '.###.' ],
+    '6' : [ '..##.', '.#...', '#....', '####.', '#...#', '#...#', '.###.' ],
+    '7' : [ '#####', '....#', '...#.', '..#..', '.#...', '.#...', '.#...' ],
+    '8' : [ '.###.', '#...#', '#...#', '.###.', '#...#', '#...#', '.###.' ],
+    '9' : [ '.###.', '#...#', '#...#', '.####', '....#', '...#.', '.##..' ],
+    'A' : [ '.###.', '#...#', '#...#', '#####', '#...#', '#...#', '#...#' ],
+    'B' : [ '####.', '#...#', '#...#', '####.', '#...#', '#...#', '####.' ],
+    'C' : [ '.###.', '#...#', '#....', '#....', '#....', '#...#', '.###.' ],
+    'D' : [ '###..', '#..#.', '#...#', '#...#', '#...#', '#..#.', '###..' ],
+    'E' : [ '#####', '#....', '#....', '####.', '#....', '#....', '#####' ],
+    'F' : [ '#####', '#....', '#....', '####.', '#....', '#....', '#....' ],
+    'G' : [ '.###.', '#...#', '#....', '#.###', '#...#', '#...#', '.####' ],
+    'H' : [ '#...#', '#...#', '#...#', '#####', '#...#', '#...#', '#...#' ],
+    'I' : [ '.###.', '..#..', '..#..', '..#..', '..#..', '..#..', '.###.' ],
+    'J' : [ '..###', '...#.', '...#.', '...#.', '...#.', '#..#.', '.##..' ],
+    'K' : [ '#...#', '#..#.', '#.#..', '##...', '#.#..', '#..#.', '#...#' ],
+    'L' : [ '#....', '#....', '#....', '#....', '#....', '#....', '#####' ],
+    'M' : [ '#...#', '##.##', '#.#.#', '#.#.#', '#...#', '#...#', '#...#' ],
+    'N' : [ '#...#', '#...#', '##..#', '#.#.#', '#..##', '#...#', '#...#' ],
+    'O' : [ '.###.', '#...#', '#...#', '#...#', '#...#', '#...#', '.###.' ],
+    'P' : [ '####.', '#...#', '#...#', '####.', '#....', '#....', '#....' ],
+    'Q' : [ '.###.', '#...#', '#...#', '#...#', '#.#.#', '#..#.', '.##.#' ],
+    'R' : [ '####.', '#...#', '#...#', '####.', '#.#..', '#..#.', '#...#' ],
+    'S' : [ '.####', '#....', '#....', '.###.', '....#', '....#', '####.' ],
+    'T' : [ '#####', '..#..', '..#..', '..#..', '..#..', '..#..', '..#..' ],
+    'U' : [ '#...#', '#...#', '#...#', '#...#', '#...#', '#...#', '.###.' ],
+    'V' : [ '#...#', '#...#', '#...#', '#...#', '#...#', '.#.#.', '..#..' ],
+    'W' : [ '#...#', '#...#', '#...#', '#.#.#', '#.#.#', '#.#.#', '.#.#.' ],
+    'X' : [ '#...#', '#...#', '.#.#.', '..#..', '.#.#.', '#...#', '#...#' ],
+    'Y' : [ '#...#', '#...#', '.#.#.', '..#..', '..#..', '..#..', '..#..' ],
+    'Z' : [ '#####', '....#', '...#.', '..#..', '.#...', '#....', '#####' ],
+    '.' : [ '.....', '.....', '.....', '.....', '.....', '.##..', '.##..' ],
+    ',' : [ '.....', '.....', '.....', '.....', '.##..', '..#..', '.#...' ],
+    ':' : [ '.....', '.##..', '.##..', '.....', '.##..', '.##..', '.....' ],
+    '-' : [ '.....', '.....', '.....', '#####', '.....', '.....', '.....' ],
+    '+' : [ '.....', '..#..', '..#..', '#####', '..#..', '..#..', '.....' ],
+    '>' : [ '.#...', '..#..', '...#.', '....#', '...#.', '..#..', '.#...' ],
+    '<' : [ '...#.', '..#..', '.#...', '#....', '.#...', '..#..', '...#.' ],
+    '(' : [ '...#.', '..#..', '.#...', '.#...', '.#...', '..#..', '...#.' ],
+    ')' : [ '.#...', '..#..', '...#.', '...#.', '...#.', '..#..', '.#...' ],
+    '/' : [ '.....', '....#', '...#.', '..#..', '.#...', '#....', '.....' ],
+    '_' : [ '.....', '.....', '.....', '.....', '.....', '.....', '#####' ],
+    '?' : [ '.###.', '#...#', '....#', '...#.', '..#..', '.....', '..#..' ],
+    }
+
+FONT_BITMAPS = dict([ (char, np.array([ [ c == '#' for c in row ] for row in rows ]))
+                            for char, rows in FONT.items() ])
+
+#-----------------------------------------------------------------------------
+
+def text_image(text, scale=1, color=0):
+    '''
+    Write text (which can have more than one line) in the bitmap font
+    as a (rows, cols, 3) uint8 array, black on white by default. Each
+    pixel of the font is a scale x scale block.
+    '''
+    lines = text.upper().split('\n')
+    n_chars = max([ len(line) for line in lines ])
+
+    # Each character is 5 pixels wide with 1 pixel between them,
+    # and there are 2 pixels between the lines
+    mask = np.zeros([9 * len(lines) - 2, max(1, 6 * n_chars - 1)], dtype=bool)
+    for i, line in enumerate(lines):
+        # Centre each line
+        x0 = 3 * (n_chars - len(line))
+        for j, char in enumerate(line):
+            bitmap = FONT_BITMAPS.get(char, FONT_BITMAPS['?'])
+            mask[9*i:9*i+7, x0+6*j:x0+6*j+5] = bitmap
+
+    mask = np.repeat(np.repeat(mask, scale, axis=0), scale, axis=1)
+    rgb = np.full(mask.shape + (3,), 255, dtype=np.uint8)
+    rgb[mask] = color
+
+    return rgb
+
+#-----------------------------------------------------------------------------
+
+def format_value(x):
+    '''
+    A short label for a colourbar value
+    '''
+    return '{:.3g}'.format(x)
+
+#-----------------------------------------------------------------------------
+
+def value_range(M, vmin=None, vmax=None):
+    '''
+    The ends of the colour scale: vmin and vmax, or the minimum and
+    maximum of M if they aren't given (as in imshow)
+    '''
+    M = np.asarray(M, dtype=float)
+    finite = np.isfinite(M)
+
+    if vmin is None:
+        vmin = M[finite].min() if finite.any() else 0.0
+    if vmax is None:
+        vmax = M[finite].max() if finite.any() else 1.0
+
+    return float(vmin), float(vmax)
+
+#-----------------------------------------------------------------------------
+
+def to_rgb(M, vmin=None, vmax=None, lut=JET_LUT):
+    '''
+    Map the values in M onto the colour table between vmin and vmax
+    (which default to the minimum and maximum of M, as in imshow).
+    Not a number values are white.
+    Returns a (rows, cols, 3) uint8 array.
+    '''
+    M = np.asarray(M, dtype=float)
+    finite = np.isfinite(M)
+
+    vmin, vmax = value_range(M, vmin=vmin, vmax=vmax)
+
+    scale = (lut.shape[0] - 1) / float(vmax - vmin) if vmax > vmin else 0.0
+    idx = np.clip((np.where(finite, M, vmin) - vmin) * scale, 0, lut.shape[0] - 1)
+
+    rgb = lut[idx.astype(int)]
+    rgb[~finite] = 255
+
+    return rgb
+
+#-----------------------------------------------------------------------------
+
+def upsample(rgb, scale):
+    '''
+    Make each pixel a scale x scale block
+    '''
+    return np.repeat(np.repeat(rgb, scale, axis=0), scale, axis=1)
+
+#-----------------------------------------------------------------------------
+
+def colorbar(height, width, lut=JET_LUT):
+    '''
+    A vertical colourbar (high values at the top) with a black outline
+    '''
+    idx = np.linspace(lut.shape[0] - 1, 0, height).astype(int)
+    bar = np.repeat(lut[idx][:, np.newaxis, :], width, axis=1)
+    bar[[0, -1], :] = 0
+    bar[:, [0, -1]] = 0
+
+    return bar
+
+#-----------------------------------------------------------------------------
+
+def labelled_colorbar(height, width, vmin, vmax, text_scale=1, lut=JET_LUT):
+    '''
+    A colourbar with a tick and the value at the bottom, middle and
+    top of the colour scale written to the right of it
+    '''
+    bar = colorbar(height, width, lut=lut)
+
+    values = [ vmax, (vmin + vmax) / 2.0, vmin ]
+    labels = [ text_image(format_value(v), scale=text_scale) for v in values ]
+    tick = max(2, width // 3)
+    gap = max(1, text_scale)
+    label_width = max([ l.shape[1] for l in labels ])
+
+    canvas = np.full([height, width + tick + gap + label_width, 3], 255, dtype=np.uint8)
+    canvas[:, :width] = bar
+
+    for y, label in zip([ 0, (height - 1) // 2, height - 1 ], labels):
+        canvas[max(0, y - text_scale // 2):y + max(1, text_scale // 2), width:width+tick] = 0
+        # Centre the label on its tick, but keep it next to the bar
+        top = int(np.clip(y - label.shape[0] // 2, 0, height - label.shape[0]))
+        canvas[top:top+label.shape[0], width+tick+gap:width+tick+gap+label.shape[1]] = label
+
+    return canvas
+
+#-----------------------------------------------------------------------------
+
+def compose_panels(panels, gap=0):
+    '''
+    Put images side by side on a white background, lined up at the top
+    '''
+    height = max([ p.shape[0] for p in panels ])
+    width = sum([ p.shape[1] for p in panels ]) + gap * (len(panels) - 1)
+
+    canvas = np.full([height, width, 3], 255, dtype=np.uint8)
+    x = 0
+    for p in panels:
+        canvas[:p.shape[0], x:x+p.shape[1]] = p
+        x += p.shape[1] + gap
+
+    return canvas
+
+#-----------------------------------------------------------------------------
+
+def add_border(rgb, border):
+    '''
+    Pad an image with a white border
+    '''
+    return np.pad(rgb, [(border, border), (border, border), (0, 0)],
+                    mode='constant', constant_values=255)
+
+#-----------------------------------------------------------------------------
+
+def write_png(rgb, png_name, compress_level=6, text=None):
+    '''
+    Write a (rows, cols, 3) uint8 array to an 8 bit RGB png file,
+    with a tEXt chunk for every key and value in the text list
+    '''
+    rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+    height, width = rgb.shape[:2]
+
+    # Every row starts with a 0 to say it isn't filtered
+    raw = np.zeros([height, width * 3 + 1], dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data
+                    + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+
+    with open(png_name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', header))
+        for key, value in (text or []):
+            f.write(chunk(b'tEXt', (key + '\0' + value).encode('latin-1')))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), compress_level)))
+        f.write(chunk(b'IEND', b''))
+
+#-----------------------------------------------------------------------------
+
+def matrix_panel(M, vmin=None, vmax=None, size=1600, cbar=True, title=None,
+                    lut=JET_LUT):
+    '''
+    The picture of one matrix, about size pixels across, with a
+    labelled colourbar on the right and the title above it
+    '''
+    vmin, vmax = value_range(M, vmin=vmin, vmax=vmax)
+    rgb = to_rgb(M, vmin=vmin, vmax=vmax, lut=lut)
+    scale = max(1, size // max(rgb.shape[:2]))
+    rgb = upsample(rgb, scale)
+    text_scale = max(1, rgb.shape[0] // 160)
+
+    height, width = rgb.shape[:2]
+    if title is not None:
+        rgb = add_title(rgb, title, text_scale)
+
+    if cbar:
+        bar = labelled_colorbar(height, max(4, width // 20), vmin, vmax,
+                                    text_scale=text_scale, lut=lut)
+        # Line the colourbar up with the matrix rather than the title
+        bar = np.pad(bar, [(rgb.shape[0] - height, 0), (0, 0), (0, 0)],
+                        mode='constant', constant_values=255)
+        rgb = compose_panels([rgb, bar], gap=max(2, width // 25))
+
+    return rgb
+
+#-----------------------------------------------------------------------------
+
+def add_title(rgb, title, text_scale=1):
+    '''
+    Write the title in the middle above the picture
+    '''
+    label = text_image(title, scale=text_scale)
+    gap = 4 * text_scale
+    width = max(rgb.shape[1], label.shape[1])
+
+    canvas = np.full([label.shape[0] + gap + rgb.shape[0], width, 3], 255, dtype=np.uint8)
+    x = (width - label.shape[1]) // 2
+    canvas[:label.shape[0], x:x+label.shape[1]] = label
+    x = (width - rgb.shape[1]) // 2
+    canvas[label.shape[0]+gap:, x:x+rgb.shape[1]] = rgb
+
+    return canvas
+
+#-----------------------------------------------------------------------------
+
+def save_matrix_png(M, png_name, vmin=None, vmax=None, size=1600, cbar=True, title=None):
+    '''
+    Save a png picture of matrix M. The ends of the colour scale are
+    also saved in the file as vmin and vmax.
+    '''
+    vmin, vmax = value_range(M, vmin=vmin, vmax=vmax)
+    rgb = matrix_panel(M, vmin=vmin, vmax=vmax, size=size, cbar=cbar, title=title)
+
+    text = [ ('vmin', repr(vmin)), ('vmax', repr(vmax)) ]
+    if title is not None:
+        text.append(('Title', title))
+    write_png(add_border(rgb, max(2, rgb.shape[0] // 20)), png_name, text=text)
+
+#-----------------------------------------------------------------------------
+
+def save_matrix_panels(M_list, png_name, vmin=None, vmax=None, size=1600, titles=None):
+    '''
+    Save a png picture of a list of matrices side by side (with
+    titles if given) on the same colour scale, which is shown by one
+    colourbar on the right. The colour scale is the range of all the
+    matrices unless vmin and vmax are given.
+    '''
+    if vmin is None:
+        vmin = min([ value_range(M)[0] for M in M_list ])
+    if vmax is None:
+        vmax = max([ value_range(M)[1] for M in M_list ])
+    if titles is None:
+        titles = [ None ] * len(M_list)
+    else:
+        # Give all the titles the same number of lines so that the
+        # matrices line up
+        n_lines = max([ t.count('\n') for t in titles ])
+        titles = [ '\n' * (n_lines - t.count('\n')) + t for t in titles ]
+
+    panels = [ matrix_panel(M, vmin=vmin, vmax=vmax, size=size, title=title,
+                                cbar=(i == len(M_list) - 1))
+                    for i, (M, title) in enumerate(zip(M_list, titles)) ]
+    rgb = compose_panels(panels, gap=max(2, panels[0].shape[1] // 10))
+
+    text = [ ('vmin', repr(float(vmin))), ('vmax', repr(float(vmax))) ]
+    if any([ title is not None for title in titles ]):
+        text.append(('Title', ' | '.join([ t.strip().replace('\n', ' ') for t in titles if t ])))
+    write_png(add_border(rgb, max(2, rgb.shape[0] // 20)), png_name, text=text)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+'''
+Degree preserving random (null) networks.
+
+This does the same job as randmio_und_connected.m from the Brain
+Connectivity Toolbox: pairs of edges a-b and c-d are swapped to a-d
+and c-b so every node keeps its degree, and a swap is only kept if
+it does not break the network into more pieces. Instead of testing
+one swap at a time, swaps that don't share any nodes are applied
+together in a batch and the connectedness of the whole network is
+checked once per batch. Swaps that share a node with an earlier one
+in the batch wait for the next batch, so no edges are rewired less
+often than the others. If the check fails the batch is undone and
+tried again in smaller batches.
+
+Many null networks are made for each subject in a pool of worker
+processes. Every null network has its own random seed, built from
+the seed you pass in, the subject number and the null number, so
+the results don't depend on how many processes you use.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+import graph_measures as gm
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+def n_components(A):
+    '''
+    Number of connected components in a single binary undirected
+    network. Every node takes the smallest label of its neighbours
+    until nothing changes.
+    '''
+    A = np.asarray(A, dtype=bool)
+    n = A.shape[0]
+    # Let each node see itself as well as its neighbours
+    A = A | np.eye(n, dtype=bool)
+
+    labels = np.arange(n)
+    while True:
+        new_labels = np.where(A, labels[np.newaxis, :], n).min(axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    return np.unique(labels).shape[0]
+
+#-----------------------------------------------------------------------------
+
+def randmio_und_connected(A, n_iter=5, random_state=None, max_batch=None):
+    '''
+    Randomise a binary undirected network while keeping the degree
+    of every node and without disconnecting it
+    (BCT: randmio_und_connected).
+
+    n_iter is the number of times, on average, that each edge is
+    rewired. random_state can be a seed or a np.random.RandomState.
+    Returns the rewired (boolean) adjacency matrix.
+    '''
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    rs = random_state
+
+    R = np.asarray(A) > 0
+    R = R | R.T
+    np.fill_diagonal(R, False)
+    n = R.shape[0]
+
+    # Keep a list of the edges - the i, j pairs
+    ei, ej = np.nonzero(np.triu(R, 1))
+    K = ei.shape[0]
+    if K < 2:
+        return R
+
+    n_comp = n_components(R)
+
+    # Swaps in one batch must not share any nodes, so there's no
+    # point drawing many more than n/4 of them at once
+    if max_batch is None:
+        max_batch = max(1, n // 8)
+    batch = max_batch
+
+    n_swaps = n_iter * K
+    # Give up if it's impossible to find enough swaps
+    max_draws = 100 * n_swaps
+
+    # The swaps are drawn as pairs of places in the edge list (and
+    # which way round to join them). Swaps that can't go in this batch
+    # because they share a node with an earlier one wait at the front
+    # of the queue for the next batch rather than being thrown away,
+    # so the edges of the hubs (which share nodes the most) are
+    # rewired as often as everybody else's.
+    queue_e1 = np.zeros(0, dtype=int)
+    queue_e2 = np.zeros(0, dtype=int)
+    queue_flip = np.zeros(0, dtype=bool)
+
+    done = 0
+    drawn = 0
+    while done < n_swaps and drawn < max_draws:
+        b = min(batch, n_swaps - done)
+
+        # Top the queue up with new swaps
+        n_new = max(0, b - queue_e1.shape[0])
+        drawn += n_new
+        queue_e1 = np.concatenate([ queue_e1, rs.randint(K, size=n_new) ])
+        queue_e2 = np.concatenate([ queue_e2, rs.randint(K, size=n_new) ])
+        queue_flip = np.concatenate([ queue_flip, rs.rand(n_new) > 0.5 ])
+
+        e1, e2, flip = queue_e1[:b], queue_e2[:b], queue_flip[:b]
+        queue_e1, queue_e2, queue_flip = queue_e1[b:], queue_e2[b:], queue_flip[b:]
+
+        # The edges are looked up now as earlier swaps may have
+        # changed them
+        a, bb = ei[e1], ej[e1]
+        c, d = ei[e2], ej[e2]
+
+        # Swap to c-b, a-d or to d-b, a-c with equal probability
+        c, d = np.where(flip, d, c), np.where(flip, c, d)
+
+        # The four nodes have to be different
+        ok = (a != c) & (a != d) & (bb != c) & (bb != d)
+        # and the new edges can't already exist
+        ok &= ~R[a, d] & ~R[c, bb]
+
+        # Each node can only be in one swap of the batch: the first
+        # swap in the queue that uses it. The rest wait for the next one.
+        idx = np.flatnonzero(ok)
+        nodes = np.vstack([ a, bb, c, d ])[:, idx]
+        first = np.full(n, b)
+        np.minimum.at(first, nodes.reshape(-1), np.tile(idx, 4))
+        go = (first[nodes] == idx).all(axis=0)
+        keep, wait = idx[go], idx[~go]
+
+        queue_e1 = np.concatenate([ e1[wait], queue_e1 ])
+        queue_e2 = np.concatenate([ e2[wait], queue_e2 ])
+        queue_flip = np.concatenate([ flip[wait], queue_flip ])
+
+        if keep.shape[0] == 0:
+            continue
+
+        e1, e2, flip = e1[keep], e2[keep], flip[keep]
+        a, bb, c, d = a[keep], bb[keep], c[keep], d[keep]
+
+        # Rewire
+        R[a, bb] = R[bb, a] = R[c, d] = R[d, c] = False
+        R[a, d] = R[d, a] = R[c, bb] = R[bb, c] = True
+
+        if n_components(R) <= n_comp:
+            # Keep these swaps and update the edge list
+            ej[e1] = d
+            ei[e2] = c
+            ej[e2] = bb
+            done += keep.shape[0]
+            batch = min(batch * 2, max_batch)
+        else:
+            # Undo the batch. A single swap that disconnects the
+            # network is thrown away, otherwise the swaps go back to
+            # the front of the queue to be tried in smaller batches.
+            R[a, d] = R[d, a] = R[c, bb] = R[bb, c] = False
+            R[a, bb] = R[bb, a] = R[c, d] = R[d, c] = True
+            if keep.shape[0] > 1:
+                queue_e1 = np.concatenate([ e1, queue_e1 ])
+                queue_e2 = np.concatenate([ e2, queue_e2 ])
+                queue_flip = np.concatenate([ flip, queue_flip ])
+            batch = max(1, batch // 2)
+
+    return R
+
+#-----------------------------------------------------------------------------
+
+def null_seed(seed, sub, null):
+    '''
+    The random seed for one null network of one subject
+    '''
+    return [seed, sub, null]
+
+#-----------------------------------------------------------------------------
+
+def _null_measures_worker(task):
+    '''
+    Make a chunk of null networks for one subject and return their
+    measures (not the networks themselves, to keep memory low)
+    '''
+    A, sub, nulls, n_iter, seed = task
+
+    R = np.array([ randmio_und_connected(A, n_iter=n_iter,
+                                            random_state=null_seed(seed, sub, null))
+                        for null in nulls ])
+
+    D = gm.distance_bin(R)
+    measures = { 'a' : gm.assortativity_bin(R),
+                 'C' : gm.clustering_coef_bu(R).mean(axis=-1),
+                 'L' : gm.path_length(D),
+                 'E' : gm.efficiency_bin(D) }
+
+    return sub, nulls, measures
+
+#-----------------------------------------------------------------------------
+
+def null_measures(A, n_null=100, n_iter=5, seed=0, n_jobs=1, chunk_size=10):
+    '''
+    Make n_null random networks for every subject in the stack A and
+    calculate their measures.
+
+    Returns a dictionary of (n_subs, n_null) arrays keyed by
+    arand, Crand, Lrand and Erand.
+    '''
+    A = gm.binarize_stack(A)
+    n_subs = A.shape[0]
+
+    tasks = []
+    for sub in range(n_subs):
+        for start in range(0, n_null, chunk_size):
+            nulls = list(range(start, min(start + chunk_size, n_null)))
+            tasks.append((A[sub], sub, nulls, n_iter, seed))
+
+    rand = {}
+    for name in [ 'a', 'C', 'L', 'E' ]:
+        rand[name + 'rand'] = np.zeros([n_subs, n_null])
+
+    pool = None
+    if n_jobs != 1:
+        pool = mp.Pool(n_jobs)
+
+    try:
+        if pool is None:
+            results = map(_null_measures_worker, tasks)
+        else:
+            results = pool.imap_unordered(_null_measures_worker, tasks)
+
+        for sub, nulls, measures in results:
+            for name, values in measures.items():
+                rand[name + 'rand'][sub, nulls] = values
+
+    except:
+        # Don't wait for the rest of the tasks if something went wrong
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return rand
+
+#-----------------------------------------------------------------------------
+
+def normalised_measures(s, rand):
+    '''
+    Add the measures averaged over the null networks to the s
+    dictionary from graph_measures.graph_measures along with the
+    small world coefficient and the cost efficiency of the nulls
+    '''
+    for name, values in rand.items():
+        s[name] = values.mean(axis=-1)
+
+    s['Sigma'] = gm.small_world_sigma(s['C'], s['L'], s['Crand'], s['Lrand'])
+    s['CErand'] = s['Erand'] - s['cost']
+
+    return s
@@ -11,6 +11,8 @@ Connectivity plots for a matrix
 import numpy as np
 import matplotlib.pylab as plt
 import argparse
+import os
+import sys
 
 #=============================================================================
 # FUNCTIONS
@@ -35,7 +37,7 @@ def setup_argparser():
     parser.add_argument('M_file',
                             type=str,
                             metavar='M_file',
-                            help='Matrix (text file)')
+                            help='Matrix (text file), or in batch mode a text file listing matrices or a .npy stack of matrices')
         
     # Optional argument: minimum
     parser.add_argument('--hist_min',
@@ -67,11 +69,154 @@ def setup_argparser():
                             help='do not show cost in text box',
                             action='store_true',
                             default=False)
+
+    # Optional argument: n_bins
+    parser.add_argument('--n_bins',
+                            dest='n_bins',
+                            type=int,
+                            help='number of histogram bins',
+                            default=10,
+                            action='store')
+
+    # Optional argument: batch
+    parser.add_argument('--batch',
+                            dest='batch',
+                            help='histogram a whole list (or .npy stack) of matrices at once',
+                            action='store_true',
+                            default=False)
+
+    # Optional argument: plot
+    parser.add_argument('--plot',
+                            dest='plot',
+                            help='in batch mode also make a histogram figure for every matrix',
+                            action='store_true',
+                            default=False)
                             
     arguments = parser.parse_args()
     
     return arguments, parser
 
+#-----------------------------------------------------------------------------
+
+def load_matrices(M_file):
+    '''
+    Load a stack of matrices either from a .npy file or from
+    a text file that lists one matrix file per line.
+    Returns the names of the matrices and the stack.
+    '''
+    if M_file.endswith('.npy'):
+        M_stack = np.load(M_file)
+        names = [ '{}_{:04d}'.format(M_file.replace('.npy', ''), i)
+                        for i in range(M_stack.shape[0]) ]
+    else:
+        names = [ M.strip() for M in open(M_file) if M.strip() ]
+        M_stack = np.array([ np.loadtxt(M) for M in names ])
+
+    return names, M_stack
+
+#-----------------------------------------------------------------------------
+
+def weight_histograms(M_stack, bins):
+    '''
+    Histogram the non-zero weights in the top triangle of every matrix
+    in M_stack using the same bins for everyone. All the matrices are
+    counted with one call to np.bincount.
+    Returns an (n_subs, n_bins) array of counts and the cost of each matrix.
+    '''
+    n_subs, n = M_stack.shape[:2]
+    n_bins = bins.shape[0] - 1
+
+    # One row of top triangle weights per matrix
+    W = M_stack[:, np.triu_indices(n, 1)[0], np.triu_indices(n, 1)[1]]
+
+    # Calculate the density (cost)
+    cost = (np.count_nonzero(W, axis=1) * 2) / float(n * (n-1))
+
+    # Find the bin of every weight (the last bin includes its
+    # right hand edge, as in np.histogram)
+    idx = np.searchsorted(bins, W, side='right') - 1
+    idx[W == bins[-1]] = n_bins - 1
+    keep = (W > 0) & (idx >= 0) & (idx < n_bins)
+
+    # Give every matrix its own set of bins and count them all at once
+    idx = idx + np.arange(n_subs)[:, np.newaxis] * n_bins
+    counts = np.bincount(idx[keep], minlength=n_subs * n_bins)
+
+    return counts.reshape(n_subs, n_bins), cost
+
+#-----------------------------------------------------------------------------
+
+def save_histogram_table(names, counts, cost, bins, table_name):
+    '''
+    Write the cost and the histogram counts of every matrix
+    to a comma separated file
+    '''
+    with open(table_name, 'w') as f:
+        header = [ 'M_file', 'cost' ] + [ 'bin_{:g}'.format(b) for b in bins[:-1] ]
+        f.write(','.join(header) + '\n')
+        for name, c, row in zip(names, cost, counts):
+            f.write(','.join([ name, '{:.5f}'.format(c) ] + [ '{:d}'.format(x) for x in row ]) + '\n')
+
+#-----------------------------------------------------------------------------
+
+def format_hist_axis(ax, hist_min, hist_max):
+    '''
+    Set the limits and labels of a weights histogram
+    '''
+    ax.set_xlim([hist_min, hist_max])
+    ax.set_ylim([1, 10000])
+    ax.set_yscale('log')
+    ax.set_xlabel('Connection weight')
+    ax.set_ylabel('Frequency (log scale)')
+
+#-----------------------------------------------------------------------------
+
+def plot_histograms(names, counts, cost, bins, hist_color, no_cost_box=False):
+    '''
+    Make a histogram figure for each matrix. The same figure is
+    cleared and reused for every one.
+    '''
+    fig, ax = plt.subplots(figsize=(4,4))
+
+    for name, c, row in zip(names, cost, counts):
+        ax.cla()
+        ax.bar(bins[:-1], row, width=np.diff(bins), align='edge', color=hist_color)
+        format_hist_axis(ax, bins[0], bins[-1])
+
+        # Add in the cost in the top right corner
+        if not no_cost_box:
+            ax.text(0.95, 0.95,
+                    'cost = {:.2f}%'.format(c*100),
+                    transform=ax.transAxes,
+                    horizontalalignment='right',
+                    verticalalignment='top')
+
+        plt.tight_layout()
+        fig.savefig(os.path.splitext(name)[0] + '_weights.png', bbox_inches=0, dpi=600)
+
+    plt.close(fig)
+
+#-----------------------------------------------------------------------------
+
+def plot_group_overlay(counts, bins, hist_color, fig_name):
+    '''
+    Draw everyone's weight distribution on one set of axes
+    with the median across the group on top
+    '''
+    fig, ax = plt.subplots(figsize=(4,4))
+
+    # Repeat the last count so the steps reach the last bin edge
+    steps = np.hstack([counts, counts[:, -1:]]).T
+    ax.step(bins, steps, where='post', color='grey', alpha=0.2, linewidth=0.5)
+    ax.step(bins, np.median(np.hstack([counts, counts[:, -1:]]), axis=0),
+                where='post', color=hist_color, linewidth=2)
+
+    format_hist_axis(ax, bins[0], bins[-1])
+
+    plt.tight_layout()
+    fig.savefig(fig_name, bbox_inches=0, dpi=600)
+    plt.close(fig)
+
 #=============================================================================
 # Define some variables
 #=============================================================================
@@ -83,6 +228,24 @@ hist_min = arguments.hist_min
 hist_max = arguments.hist_max
 hist_color = arguments.hist_color
 
+if arguments.batch:
+    # Histogram everyone at once
+    bins = np.linspace(hist_min, hist_max, arguments.n_bins + 1)
+    names, M_stack = load_matrices(M_file)
+    counts, cost = weight_histograms(M_stack, bins)
+
+    # Save the table of counts and the group figure next to the list
+    root = os.path.splitext(M_file)[0]
+    save_histogram_table(names, counts, cost, bins, root + '_weights.csv')
+    plot_group_overlay(counts, bins, hist_color, root + '_weights_overlay.png')
+
+    # Only draw the individual figures if you've asked for them
+    if arguments.plot:
+        plot_histograms(names, counts, cost, bins, hist_color,
+                            no_cost_box=arguments.no_cost_box)
+
+    sys.exit()
+
 # Load in the matrix
 M = np.loadtxt(M_file)
 
@@ -100,6 +263,7 @@ fig, ax = plt.subplots(figsize=(4,4))
 n, bins, patches = ax.hist(M_triu[M_triu>0], 
                             log=True, 
                             range=(hist_min,hist_max), 
+                            bins=arguments.n_bins,
                             color=hist_color)
 
 ax.set_xlim([hist_min, hist_max])
@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+
+'''
+Permutation tests of the TBSS skeleton data in python.
+
+This runs the same tests as RunRandomiseTBSS.sh (every .mat and .con
+pair in every <TBSS_DIR>/GLM/<group> directory, for FA, L1, L23, MD and
+MO) and saves the results in the same place:
+
+    <TBSS_DIR>/RESULTS/<group>/<test_name>/<measure>_<n_perms>_tstat<i>.nii.gz
+    <TBSS_DIR>/RESULTS/<group>/<test_name>/<measure>_<n_perms>_vox_corrp_tstat<i>.nii.gz
+    <TBSS_DIR>/RESULTS/<group>/<test_name>/<measure>_<n_perms>_tfce_corrp_tstat<i>.nii.gz
+
+where the corrp images are 1 - p, FWE corrected with the maximum
+t statistic or the maximum TFCE value (with randomise's --T2 settings,
+see skeleton_tfce.py) over the skeleton, as randomise writes them.
+
+Rather than reading the 4D file again for every test, the skeleton
+data for each group and measure is read once as a subjects x skeleton
+voxels matrix (only the voxels in the mean FA skeleton mask).
+
+The model is fitted for every voxel at once with the pseudo-inverse of
+the design. The residuals are permuted with Freedman-Lane: the data is
+split into the part explained by the nuisance regressors (the part of
+the design that the contrast doesn't test) and the residuals, which are
+shuffled (or have their signs flipped). Because the residual forming
+matrix of the nuisance regressors and the permutation are both
+linear, every statistic that's needed for one permutation is a row
+vector times the data:
+
+    numerator = (w * s)[inv] . Rz . Y
+    RSS       = Y' Rz Y - || ((U * s)[inv])' . Rz . Y ||^2
+
+w is the row of the pseudo-inverse that the contrast picks out, U is an
+orthonormal basis of the design, Rz is the residual forming matrix of
+the nuisance regressors, s are the signs and inv is the inverse
+permutation. The rows for a block of permutations are stacked and
+multiplied by the data in one go, and the blocks are shared out over a
+pool of processes.
+
+All the designs in a group directory use the same subjects (the subs
+file), so they're run together: the data is read once, one set of
+permutations is drawn (and one set of sign flips for the one sample
+tests), the rows for every contrast of every design are stacked into
+the same matrix product for each block, and all of the block's t maps
+go through one TFCE sweep.
+
+That saves reading the data and most of the GLM work, but not the
+TFCE, which is most of the time. Every permuted t map has its own
+threshold steps (randomise's dh is 1/100 of that map's maximum) and so
+its own clusters, and the maximum TFCE of every one of them is needed
+for the corrected p values, so there's nothing to share between maps
+without changing the statistic. A group with N contrasts still takes
+about N times as long as one contrast on its own (16 designs x 2
+contrasts take about 15x as long as one design).
+
+Sign flipping is used for one sample t tests (a design with a single
+constant column) and permutations for everything else, as randomise
+does. F tests (the Anova designs) aren't supported.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import errno
+import argparse
+import multiprocessing as mp
+from glob import glob
+import numpy as np
+import nibabel as nib
+
+from skeleton_tfce import skeleton_edges, tfce
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Run permutation tests on TBSS skeleton data for every design in the GLM directory')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: tbss_dir
+    parser.add_argument(dest='tbss_dir',
+                            type=str,
+                            metavar='tbss_dir',
+                            help='TBSS directory containing GLM, SKELETON_DATA and PRE_PROCESSING')
+
+    # Required argument: n_perms
+    parser.add_argument(dest='n_perms',
+                            type=int,
+                            metavar='n_perms',
+                            help='number of permutations (including the unpermuted data)')
+
+    # Optional argument: measures
+    parser.add_argument('--measures',
+                            dest='measures',
+                            type=str,
+                            nargs='+',
+                            help='DTI measures to test',
+                            default=[ 'FA', 'L1', 'L23', 'MD', 'MO' ],
+                            action='store')
+
+    # Optional argument: n_jobs
+    parser.add_argument('--n_jobs',
+                            dest='n_jobs',
+                            type=int,
+                            help='number of processes running blocks of permutations',
+                            default=1,
+                            action='store')
+
+    # Optional argument: block_size
+    parser.add_argument('--block_size',
+                            dest='block_size',
+                            type=int,
+                            help='number of t maps (permutations x contrasts) in each block',
+                            default=100,
+                            action='store')
+
+    # Optional argument: seed
+    parser.add_argument('--seed',
+                            dest='seed',
+                            type=int,
+                            help='seed for the random permutations',
+                            default=0,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+# randomise's --T2 TFCE settings for skeletons
+TFCE_H = 2.0
+TFCE_E = 1.0
+
+#-----------------------------------------------------------------------------
+
+def read_vest(vest_file):
+    '''
+    Read the matrix from an FSL (VEST) .mat, .con or .fts file
+    as a 2D array (the header lines start with a /)
+    '''
+    rows = []
+    for line in open(vest_file):
+        if line.strip() and not line.strip().startswith('/'):
+            rows.append([ float(x) for x in line.split() ])
+
+    return np.array(rows, ndmin=2)
+
+#-----------------------------------------------------------------------------
+
+def sorted_designs(group_dir):
+    '''
+    The .mat files in a group directory, shortest name first
+    (the same order as matlist_sorted in RunRandomiseTBSS.sh)
+    '''
+    mat_files = glob(os.path.join(group_dir, '*.mat'))
+    return sorted(mat_files, key=lambda f: (len(f), f))
+
+#-----------------------------------------------------------------------------
+
+def load_skeleton(tbss_dir, group, subs, measure, mask):
+    '''
+    The skeleton data in the mask for every subject as an
+    (n_subs, n_voxels) array. The merged 4D file that
+    RunRandomiseTBSS.sh makes is used if it's there, otherwise
+    each subject's file is read from SKELETON_DATA.
+
+    RunRandomiseTBSS.sh multiplies the merged file by 1000 if the
+    standard deviation of its non-zero voxels (fslstats -S) is less
+    than 0.001, so the subjects' files are scaled in the same way
+    here (the t statistics don't change, but the data matches the
+    merged file's).
+    Everything outside the skeleton is zero in these files, so the
+    non-zero voxels in the mask are the same ones that fslstats uses.
+    '''
+    merged_file = os.path.join(tbss_dir, 'INPUT_FILES', group,
+                                'all_{}_skeletonised.nii.gz'.format(measure))
+
+    if os.path.exists(merged_file):
+        img = nib.load(merged_file, keep_file_open=True)
+        return np.vstack([ np.asarray(img.dataobj[..., i], dtype=float)[mask]
+                                for i in range(img.shape[3]) ])
+
+    data = []
+    for sub in subs:
+        sub_file = os.path.join(tbss_dir, 'SKELETON_DATA', measure,
+                                    '{}_{}_skeletonised.nii.gz'.format(sub, measure))
+        data.append(np.asarray(nib.load(sub_file).dataobj, dtype=float)[mask])
+    data = np.vstack(data)
+
+    # Multiply the data by 1000 if it's "too small"
+    nonzero = data[data != 0]
+    if nonzero.shape[0] > 0 and nonzero.std() < 0.001:
+        data *= 1000
+
+    return data
+
+#-----------------------------------------------------------------------------
+
+def is_one_sample(X):
+    '''
+    True for a design with a single constant column
+    (these are sign flipped rather than permuted)
+    '''
+    return X.shape[1] == 1 and np.all(X == X[0, 0])
+
+#-----------------------------------------------------------------------------
+
+def contrast_model(X, c, demean=True):
+    '''
+    Everything that's needed to calculate the t statistic of the
+    contrast c under any permutation of the Freedman-Lane residuals
+    (see the description at the top):
+        A     - the (n_subs, 1 + rank) columns [ w, U ]
+        Rz    - the residual forming matrix of the nuisance regressors
+        scale - c (X'X)^-1 c'
+        dof   - degrees of freedom
+        flip  - True if the residuals are sign flipped rather than
+                permuted (a one sample test)
+    If demean is True the columns of X (and so the data) are demeaned,
+    which uses up one more degree of freedom.
+    '''
+    X = np.array(X, dtype=float)
+    c = np.asarray(c, dtype=float).reshape(-1)
+    n = X.shape[0]
+    flip = is_one_sample(X)
+
+    if demean:
+        X = X - X.mean(axis=0)
+
+    X_pinv = np.linalg.pinv(X)
+    w = c.dot(X_pinv)
+
+    # An orthonormal basis of the design
+    u, sv, vt = np.linalg.svd(X, full_matrices=False)
+    rank = int((sv > sv.max() * max(X.shape) * np.finfo(float).eps).sum())
+    U = u[:, :rank]
+
+    # The nuisance regressors are the part of the design
+    # that the contrast doesn't look at
+    cu = np.linalg.svd(c[np.newaxis, :])[2][1:].T
+    Z = X.dot(cu)
+    Rz = np.eye(n) - Z.dot(np.linalg.pinv(Z))
+    if demean:
+        Rz -= 1.0 / n
+
+    model = {}
+    model['A'] = np.column_stack([ w, U ])
+    model['Rz'] = Rz
+    model['scale'] = w.dot(w)
+    model['dof'] = n - rank - int(demean)
+    model['flip'] = flip
+
+    return model
+
+#-----------------------------------------------------------------------------
+
+def draw_transforms(n_subs, n_perms, flip=False, seed=0):
+    '''
+    The permutations (n_perms, n_subs) of the subjects and their signs.
+    The first one is always the unpermuted data. If flip is True the
+    subjects are sign flipped rather than shuffled.
+    '''
+    rng = np.random.RandomState(seed)
+
+    perms = np.tile(np.arange(n_subs), [n_perms, 1])
+    signs = np.ones([n_perms, n_subs])
+
+    for k in range(1, n_perms):
+        if flip:
+            signs[k] = rng.choice([-1.0, 1.0], size=n_subs)
+        else:
+            perms[k] = rng.permutation(n_subs)
+
+    return perms, signs
+
+#-----------------------------------------------------------------------------
+
+def transform_rows(model, perms, signs):
+    '''
+    The rows that multiply the data to give the numerator and the
+    projections onto the design for each of a block of permutations.
+    Returns a (n_block, 1 + rank, n_subs) array.
+    '''
+    inv = np.argsort(perms, axis=1)
+    A = model['A'][np.newaxis, :, :] * signs[:, :, np.newaxis]
+    A = A[np.arange(perms.shape[0])[:, np.newaxis], inv]
+
+    return np.einsum('kjr,jm->krm', A, model['Rz'])
+
+#-----------------------------------------------------------------------------
+
+def t_maps(model, projected, rss_total):
+    '''
+    The (n_block, n_voxels) t statistics from the data multiplied by
+    the transform_rows and the residual sum of squares of the data
+    after removing the nuisance regressors
+    '''
+    num = projected[:, 0, :]
+    rss = rss_total - (projected[:, 1:, :] ** 2).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = num / np.sqrt(np.fmax(rss, 0) / model['dof'] * model['scale'])
+
+    t[~np.isfinite(t)] = 0
+
+    return t
+
+#-----------------------------------------------------------------------------
+
+def residual_ss(models, Y):
+    '''
+    The residual sum of squares of the data after removing the
+    nuisance regressors of each model (the same for every permutation)
+    '''
+    return [ (model['Rz'].dot(Y) ** 2).sum(axis=0) for model in models ]
+
+#-----------------------------------------------------------------------------
+
+def permuted_t(models, Y, transforms, rss_totals=None):
+    '''
+    The t maps of every model for a block of permutations.
+    transforms is a dictionary of the (perms, signs) for the permuted
+    (False) and sign flipped (True) models, which must be the same
+    length. The rows for all the models (which can come from different
+    designs, as long as they have the same subjects) are stacked so
+    that the data is only multiplied once.
+    Returns a list of (n_block, n_voxels) arrays.
+    '''
+    if rss_totals is None:
+        rss_totals = residual_ss(models, Y)
+
+    rows = [ transform_rows(model, *transforms[model['flip']]) for model in models ]
+    n_subs = Y.shape[0]
+    projected = np.vstack([ r.reshape([-1, n_subs]) for r in rows ]).dot(Y)
+
+    t_list = []
+    start = 0
+    for model, r, rss_total in zip(models, rows, rss_totals):
+        n_block, n_rows = r.shape[:2]
+        model_projected = projected[start:start + n_block * n_rows].reshape([n_block, n_rows, -1])
+        t_list.append(t_maps(model, model_projected, rss_total))
+        start += n_block * n_rows
+
+    return t_list
+
+#-----------------------------------------------------------------------------
+
+def _init_worker(Y, models, rss_totals, edges):
+    global _data
+    _data = (Y, models, rss_totals, edges)
+
+def _perm_worker(block):
+    '''
+    The maximum t statistic and TFCE value of every model for each
+    permutation in a block. Returns two (n_models, n_block) arrays.
+    '''
+    Y, models, rss_totals, edges = _data
+    t_list = permuted_t(models, Y, block, rss_totals=rss_totals)
+
+    # Enhance the maps of all the models in the block with one sweep
+    n_block = t_list[0].shape[0]
+    max_t = np.array([ t.max(axis=1) for t in t_list ])
+    max_tfce = tfce(np.vstack(t_list), edges, H=TFCE_H, E=TFCE_E).max(axis=1)
+    return max_t, max_tfce.reshape([len(models), n_block])
+
+#-----------------------------------------------------------------------------
+
+def max_distribution(Y, models, edges, transforms, block_size=100, n_jobs=1):
+    '''
+    The maximum t statistic and TFCE value over the skeleton of every
+    model for every permutation (see permuted_t for the transforms),
+    as two (n_models, n_perms) arrays.
+    Each block has about block_size t maps in it, shared between
+    the models.
+    '''
+    rss_totals = residual_ss(models, Y)
+
+    n_perms = list(transforms.values())[0][0].shape[0]
+    perms_per_block = max(1, block_size // len(models))
+    blocks = []
+    for i in range(0, n_perms, perms_per_block):
+        blocks.append(dict([ (flip, (perms[i:i+perms_per_block], signs[i:i+perms_per_block]))
+                                for flip, (perms, signs) in transforms.items() ]))
+
+    if n_jobs > 1:
+        pool = mp.Pool(n_jobs, initializer=_init_worker,
+                            initargs=(Y, models, rss_totals, edges))
+        results = pool.map(_perm_worker, blocks)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(Y, models, rss_totals, edges)
+        results = [ _perm_worker(block) for block in blocks ]
+
+    return (np.hstack([ r[0] for r in results ]),
+                np.hstack([ r[1] for r in results ]))
+
+#-----------------------------------------------------------------------------
+
+def corrected_p(t, max_dist):
+    '''
+    1 - the FWE corrected p value of each t statistic: the fraction of
+    permutations whose maximum is at least as big
+    '''
+    max_sorted = np.sort(max_dist)
+    n_above = max_sorted.shape[0] - np.searchsorted(max_sorted, t, side='left')
+    return 1.0 - n_above / float(max_sorted.shape[0])
+
+#-----------------------------------------------------------------------------
+
+def save_skeleton_map(values, mask_img, mask, filename):
+    '''
+    Put the values back into the skeleton mask and save them
+    '''
+    data = np.zeros(mask.shape, dtype=np.float32)
+    data[mask] = values
+    img = nib.Nifti1Image(data, mask_img.affine, mask_img.header)
+    img.set_data_dtype(np.float32)
+    nib.save(img, filename)
+
+#-----------------------------------------------------------------------------
+
+def start_marker(marker_file):
+    '''
+    Make the (empty) marker file that shows that a test has been
+    started. Returns False if it's already there.
+    '''
+    try:
+        fd = os.open(marker_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    os.close(fd)
+    return True
+
+#-----------------------------------------------------------------------------
+
+def run_designs(Y, designs, n_perms, mask_img, mask, edges,
+                    block_size=100, n_jobs=1, seed=0):
+    '''
+    Test every contrast of every design in the list of
+    (X, C, demean, outfile) designs, which must all have the same
+    subjects as the rows of Y, and save the tstat, vox_corrp and
+    tfce_corrp images as <outfile>_tstat<i>.nii.gz etc.
+
+    All the designs are tested with the same permutations (and all the
+    one sample tests with the same sign flips) so every contrast of
+    every design is worked out from one matrix product, and all their
+    t maps are enhanced in one TFCE sweep, for each block.
+    '''
+    # One model for each contrast, and where its results go
+    models, outputs = [], []
+    for X, C, demean, outfile in designs:
+        for i, c in enumerate(C):
+            models.append(contrast_model(X, c, demean=demean))
+            outputs.append((outfile, i+1))
+
+    transforms = {}
+    for flip in set([ model['flip'] for model in models ]):
+        transforms[flip] = draw_transforms(Y.shape[0], n_perms, flip=flip, seed=seed)
+
+    t_obs = permuted_t(models, Y, dict([ (flip, (perms[:1], signs[:1]))
+                                            for flip, (perms, signs) in transforms.items() ]))
+    tfce_obs = tfce(np.vstack(t_obs), edges, H=TFCE_H, E=TFCE_E)
+    max_t, max_tfce = max_distribution(Y, models, edges, transforms,
+                                            block_size=block_size, n_jobs=n_jobs)
+
+    for i, (outfile, con) in enumerate(outputs):
+        t = t_obs[i][0]
+        save_skeleton_map(t, mask_img, mask,
+                            '{}_tstat{}.nii.gz'.format(outfile, con))
+        save_skeleton_map(corrected_p(t, max_t[i]), mask_img, mask,
+                            '{}_vox_corrp_tstat{}.nii.gz'.format(outfile, con))
+        save_skeleton_map(corrected_p(tfce_obs[i], max_tfce[i]), mask_img, mask,
+                            '{}_tfce_corrp_tstat{}.nii.gz'.format(outfile, con))
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    tbss_dir = os.path.abspath(arguments.tbss_dir)
+    n_perms = arguments.n_perms
+
+    mask_file = os.path.join(tbss_dir, 'PRE_PROCESSING', 'stats', 'mean_FA_skeleton_mask.nii.gz')
+    mask_img = nib.load(mask_file)
+    mask = np.asarray(mask_img.dataobj) > 0
+
+    # The neighbours on the skeleton are the same for every test
+    edges = skeleton_edges(mask)
+
+    for group_dir in sorted(glob(os.path.join(tbss_dir, 'GLM', '*'))):
+        group = os.path.basename(group_dir)
+        print(group)
+
+        subs_file = os.path.join(group_dir, 'subs')
+        if not os.path.exists(subs_file):
+            print("Subs file doesn't exist - check!")
+            continue
+        subs = [ sub.strip() for sub in open(subs_file) if sub.strip() ]
+
+        for measure in arguments.measures:
+            # Collect all the designs that still need to be run
+            # so that they can share the data and the permutations
+            designs = []
+
+            for mat_file in sorted_designs(group_dir):
+                test_name = os.path.basename(mat_file)[:-4]
+                con_file = mat_file[:-4] + '.con'
+
+                if test_name.startswith('Anova'):
+                    print('F tests are not supported, skipping {}'.format(test_name))
+                    continue
+
+                test_dir = os.path.join(tbss_dir, 'RESULTS', group, test_name)
+                outfile = os.path.join(test_dir, '{}_{}'.format(measure, n_perms))
+
+                C = read_vest(con_file)
+                if os.path.exists('{}_tfce_corrp_tstat{}.nii.gz'.format(outfile, C.shape[0])):
+                    # The results are already here, so remove any
+                    # marker file that might be left over
+                    print('Data already exists for {} {}'.format(test_name, measure))
+                    if os.path.exists(outfile + '_alreadystarted'):
+                        os.remove(outfile + '_alreadystarted')
+                    continue
+
+                if not os.path.isdir(test_dir):
+                    os.makedirs(test_dir)
+
+                # Don't run it if it's already been started somewhere
+                # else (the marker file is made and checked in one go
+                # so that two runs can't both claim it)
+                if not start_marker(outfile + '_alreadystarted'):
+                    print('Permutations for {} {} are already in progress'.format(test_name, measure))
+                    continue
+
+                # If you're running a TTest then you shouldn't demean your columns
+                demean = not test_name.startswith('TTest')
+
+                print('Adding {} {}'.format(test_name, measure))
+                designs.append((read_vest(mat_file), C, demean, outfile))
+
+            if designs:
+                print('Running permutations for {} designs'.format(len(designs)))
+                try:
+                    Y = load_skeleton(tbss_dir, group, subs, measure, mask)
+                    run_designs(Y, designs, n_perms, mask_img, mask, edges,
+                                    block_size=arguments.block_size,
+                                    n_jobs=arguments.n_jobs,
+                                    seed=arguments.seed)
+                finally:
+                    for outfile in [ d[3] for d in designs ]:
+                        os.remove(outfile + '_alreadystarted')
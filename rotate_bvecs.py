@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+'''
+Rotate the bvecs to match the eddy current correction.
+
+This does the same thing as fdt_rotate_bvecs.sh: every diffusion
+direction is multiplied by the rotation part of the registration
+matrix that eddy_correct found for its volume. The rotations are
+taken from all the matrices in the .ecclog at once, using the same
+decomposition as avscale (see QUALITY_CONTROL/ec_motion.py), and all
+the bvecs are rotated with one matrix product rather than calling
+avscale nine times and bc three times for every volume.
+
+The rotated bvecs are written in FSL format (three rows) and their
+lengths are checked against the original bvecs.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'QUALITY_CONTROL'))
+from ec_motion import read_ecclog, decompose_aff
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Rotate bvecs using the registration matrices from eddy_correct')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: bvecs_orig
+    parser.add_argument(dest='bvecs_orig',
+                            type=str,
+                            metavar='bvecs_orig',
+                            help='original bvecs file')
+
+    # Required argument: bvecs_rot
+    parser.add_argument(dest='bvecs_rot',
+                            type=str,
+                            metavar='bvecs_rot',
+                            help='rotated bvecs file to create')
+
+    # Required argument: ecclog
+    parser.add_argument(dest='ecclog',
+                            type=str,
+                            metavar='ecclog',
+                            help='eddy current log file (eg: dti_ec.ecclog)')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def read_bvecs(bvecs_file):
+    '''
+    Read a bvecs file as a (3, n_vols) array. Files with one row per
+    volume (n_vols, 3) are transposed.
+    '''
+    bvecs = np.loadtxt(bvecs_file, ndmin=2)
+    if bvecs.shape[0] != 3 and bvecs.shape[1] == 3:
+        bvecs = bvecs.T
+    return bvecs
+
+#-----------------------------------------------------------------------------
+
+def rotate_bvecs(bvecs, mats):
+    '''
+    Rotate each column of the (3, n_vols) bvecs by the rotation
+    part of the matching (n_vols, 4, 4) registration matrix
+    '''
+    if mats.shape[0] != bvecs.shape[1]:
+        raise ValueError('{} matrices for {} bvecs'.format(mats.shape[0], bvecs.shape[1]))
+
+    # The centre doesn't change the rotations
+    rotmat = decompose_aff(mats, np.zeros(3))['rotmat']
+
+    return np.einsum('vij,jv->iv', rotmat, bvecs)
+
+#-----------------------------------------------------------------------------
+
+def check_norms(bvecs, bvecs_rot, tol=1e-4):
+    '''
+    Make sure that rotating the bvecs hasn't changed their lengths
+    (so the b0 volumes still have 0 vectors and the rest have unit
+    vectors if they did to start with)
+    '''
+    diff = np.abs(np.linalg.norm(bvecs_rot, axis=0) - np.linalg.norm(bvecs, axis=0))
+    bad = np.flatnonzero(diff > tol)
+    if bad.shape[0] > 0:
+        raise ValueError('Rotated bvecs have changed length for volumes {}'.format(
+                            ' '.join([ str(v) for v in bad ])))
+
+#-----------------------------------------------------------------------------
+
+def save_bvecs(bvecs, bvecs_file):
+    '''
+    Save (3, n_vols) bvecs in FSL format
+    '''
+    np.savetxt(bvecs_file, bvecs, fmt='%.7f', delimiter='\t')
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    if not os.path.exists(arguments.bvecs_orig):
+        sys.exit('Source bvecs {} does not exist!'.format(arguments.bvecs_orig))
+    if not os.path.exists(arguments.ecclog):
+        sys.exit('Ecc log file {} does not exist!'.format(arguments.ecclog))
+
+    bvecs = read_bvecs(arguments.bvecs_orig)
+    mats = read_ecclog(arguments.ecclog)
+
+    bvecs_rot = rotate_bvecs(bvecs, mats)
+    check_norms(bvecs, bvecs_rot)
+
+    save_bvecs(bvecs_rot, arguments.bvecs_rot)
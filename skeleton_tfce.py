@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+'''
+Threshold-free cluster enhancement (TFCE) on the TBSS skeleton.
+
+TFCE (Smith and Nichols 2009) replaces the value of every voxel with
+
+    sum over thresholds h <= t(v) of  e(h)^E * h^H * dh
+
+where e(h) is the size of the cluster that contains the voxel when the
+map is thresholded at h. As in randomise, the thresholds are steps of
+dh = (maximum of the map) / 100, only positive values are enhanced and
+clusters are made of voxels that touch (26 neighbours). randomise's
+--T2 option (for skeletons) uses H = 2 and E = 1.
+
+Rather than labelling the clusters again at every threshold, the
+neighbouring pairs of skeleton voxels are found once (skeleton_edges).
+Every voxel and every pair are then given the number of the highest
+threshold that they're above, and the thresholds are swept from the
+top down, joining the clusters that the pairs at each threshold link
+together (a union-find where the roots are found by pointer jumping and
+the clusters linked at one threshold are joined with one call to
+scipy's connected components). Each join makes a new node of the
+cluster tree, which has the same size for all the thresholds between
+when it's made and when it's joined to something else, so its
+contribution to the TFCE values can be worked out in one go. The TFCE
+value of a voxel is the sum of the contributions of the nodes above it
+in the tree.
+
+Many maps (eg: a block of permutations) are enhanced at the same time
+by stacking copies of the skeleton graph next to each other, which
+shares the cost of the sweep between them.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import itertools as it
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+def skeleton_edges(mask, connectivity=26):
+    '''
+    The pairs of neighbouring voxels in a 3D mask (6, 18 or 26
+    neighbours) as two arrays of indices into the voxels of the mask
+    (in the order that mask[mask] gives them)
+    '''
+    index = np.full(mask.shape, -1, dtype=np.int32)
+    index[mask] = np.arange(mask.sum())
+
+    # Each pair only needs to be found once so only look at half
+    # of the neighbours
+    offsets = [ o for o in it.product([-1, 0, 1], repeat=3)
+                    if o > (0, 0, 0) and np.abs(o).sum() <= { 6 : 1, 18 : 2, 26 : 3 }[connectivity] ]
+
+    padded = np.pad(index, 1, mode='constant', constant_values=-1)
+    x, y, z = np.nonzero(mask)
+
+    edges_u, edges_v = [], []
+    for dx, dy, dz in offsets:
+        neighbour = padded[x + 1 + dx, y + 1 + dy, z + 1 + dz]
+        found = neighbour >= 0
+        edges_u.append(index[x, y, z][found])
+        edges_v.append(neighbour[found])
+
+    return np.concatenate(edges_u), np.concatenate(edges_v)
+
+#-----------------------------------------------------------------------------
+
+def _find_roots(uf, nodes):
+    '''
+    The roots of nodes in the union-find array uf (with the nodes
+    pointed straight at their roots afterwards)
+    '''
+    roots = uf[nodes]
+    while True:
+        up = uf[roots]
+        if np.all(up == roots):
+            break
+        roots = up
+    uf[nodes] = roots
+    return roots
+
+#-----------------------------------------------------------------------------
+
+def tfce(t_maps, edges, H=2.0, E=1.0, n_steps=100):
+    '''
+    TFCE of each row of the (n_maps, n_voxels) t_maps on the graph
+    given by edges (from skeleton_edges).
+    Returns an (n_maps, n_voxels) array.
+    '''
+    t_maps = np.atleast_2d(t_maps)
+    n_maps, n_vox = t_maps.shape
+    n_nodes = n_maps * n_vox
+
+    # The step size for each map and the number of the highest
+    # step that each voxel is above
+    dh = t_maps.max(axis=1) / float(n_steps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        levels = np.floor(t_maps * n_steps / t_maps.max(axis=1, keepdims=True))
+    levels[~(dh > 0)] = 0
+    levels = np.clip(np.nan_to_num(levels), 0, n_steps).astype(np.int16).reshape(-1)
+
+    # Only the voxels above the first threshold are part of
+    # the cluster tree
+    active = np.flatnonzero(levels > 0)
+    node_of = np.full(n_nodes, -1, dtype=np.int32)
+    node_of[active] = np.arange(active.shape[0], dtype=np.int32)
+    n_nodes = active.shape[0]
+
+    # Copy the graph for each map and give every pair the
+    # highest step where both voxels are above the threshold
+    offset = (np.arange(n_maps, dtype=np.int32) * n_vox)[:, np.newaxis]
+    u = (edges[0][np.newaxis, :] + offset).reshape(-1)
+    v = (edges[1][np.newaxis, :] + offset).reshape(-1)
+    edge_levels = np.minimum(levels[u], levels[v])
+    keep = edge_levels > 0
+    u, v, edge_levels = node_of[u[keep]], node_of[v[keep]], edge_levels[keep]
+
+    # Sort the pairs from the highest step down (a stable sort
+    # of 16 bit integers is a radix sort)
+    order = np.argsort(n_steps - edge_levels, kind='stable')
+    u, v = u[order], v[order]
+    starts = np.concatenate([ [ 0 ], np.cumsum(np.bincount(n_steps - edge_levels,
+                                                            minlength=n_steps + 1)) ])
+
+    # The nodes of the cluster tree: the voxels and then one for
+    # every join. A node lasts from its birth step down to the
+    # step after it's joined to its parent.
+    max_nodes = 2 * n_nodes
+    parent = np.full(max_nodes, -1, dtype=np.int32)
+    size = np.zeros(max_nodes)
+    size[:n_nodes] = 1
+    birth = np.zeros(max_nodes, dtype=np.int64)
+    birth[:n_nodes] = levels[active]
+    death = np.zeros(max_nodes, dtype=np.int64)
+    map_of = np.zeros(max_nodes, dtype=np.int64)
+    map_of[:n_nodes] = active // n_vox
+
+    # The union-find is kept separately on the voxels (each cluster
+    # is represented by one of its voxels and smaller clusters are
+    # joined to bigger ones so the paths stay short) along with the
+    # tree node that each representative's cluster is at
+    uf = np.arange(n_nodes, dtype=np.int32)
+    uf_size = np.ones(n_nodes)
+    tree_node = np.arange(n_nodes, dtype=np.int32)
+
+    # Somewhere to number the clusters that are joined at each step
+    # (quicker than np.unique because it doesn't need a sort)
+    slot = np.zeros(n_nodes, dtype=np.int64)
+
+    next_node = n_nodes
+    new_nodes_by_step = []
+    for step in range(n_steps, 0, -1):
+        start, stop = starts[n_steps - step], starts[n_steps - step + 1]
+        if start == stop:
+            new_nodes_by_step.append(np.zeros(0, dtype=np.int32))
+            continue
+
+        ru = _find_roots(uf, u[start:stop])
+        rv = _find_roots(uf, v[start:stop])
+        linked = ru != rv
+        ru, rv = ru[linked], rv[linked]
+        if ru.shape[0] == 0:
+            new_nodes_by_step.append(np.zeros(0, dtype=np.int32))
+            continue
+
+        # Join all the clusters that these pairs link together
+        ends = np.concatenate([ ru, rv ])
+        slot[ends] = np.arange(ends.shape[0])
+        roots = ends[slot[ends] == np.arange(ends.shape[0])]
+        n_roots = roots.shape[0]
+        slot[roots] = np.arange(n_roots)
+        idx = slot[ends]
+        n_pairs = ru.shape[0]
+        graph = coo_matrix((np.ones(n_pairs), (idx[:n_pairs], idx[n_pairs:])),
+                                shape=(n_roots, n_roots))
+        n_new, labels = connected_components(graph, directed=False)
+
+        # The biggest cluster in each group represents the new one
+        root_size = uf_size[roots]
+        biggest = np.zeros(n_new)
+        np.maximum.at(biggest, labels, root_size)
+        is_biggest = np.flatnonzero(root_size == biggest[labels])
+        reps = np.zeros(n_new, dtype=np.int32)
+        reps[labels[is_biggest]] = roots[is_biggest]
+
+        uf[roots] = reps[labels]
+        uf_size[reps] = np.bincount(labels, weights=uf_size[roots], minlength=n_new)
+
+        new_nodes = np.arange(next_node, next_node + n_new, dtype=np.int32)
+        next_node += n_new
+
+        old_nodes = tree_node[roots]
+        parent[old_nodes] = new_nodes[labels]
+        death[old_nodes] = step
+        size[new_nodes] = uf_size[reps]
+        birth[new_nodes] = step
+        map_of[new_nodes] = map_of[tree_node[reps]]
+        tree_node[reps] = new_nodes
+
+        new_nodes_by_step.append(new_nodes)
+
+    # Each node's contribution for all the steps that it lasts
+    # (sum over steps of size^E * (step * dh)^H * dh)
+    step_sums = np.concatenate([ [ 0 ], np.cumsum(np.arange(1, n_steps + 1, dtype=float) ** H) ])
+    dh_nodes = np.where(dh > 0, dh, 0)[map_of[:next_node]]
+    contrib = (size[:next_node] ** E
+                    * (step_sums[birth[:next_node]] - step_sums[death[:next_node]])
+                    * dh_nodes ** (H + 1))
+
+    # Add up the contributions from the top of the tree down
+    # (parents are always made at a lower step than their children)
+    total = np.zeros(next_node)
+    for new_nodes in new_nodes_by_step[::-1]:
+        p = parent[new_nodes]
+        total[new_nodes] = contrib[new_nodes] + np.where(p >= 0, total[np.fmax(p, 0)], 0)
+
+    p = parent[:n_nodes]
+    total_vox = np.zeros(n_maps * n_vox)
+    total_vox[active] = contrib[:n_nodes] + np.where(p >= 0, total[np.fmax(p, 0)], 0)
+
+    return total_vox.reshape([n_maps, n_vox])
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+'''
+Test-retest reliability of connectivity edges or ROI values.
+
+Subjects who have data at every occasion (MRI0, MRI1, ...) are paired
+up and the intraclass correlation is calculated for every edge of
+the connectivity matrices, or every ROI in a FreeSurfer stats file:
+
+    ICC(2,1) - two way random effects, absolute agreement
+    ICC(3,1) - two way mixed effects, consistency
+
+(Shrout & Fleiss, 1979) along with percentile bootstrap confidence
+intervals from resampling the subjects.
+
+All the two way ANOVA sums of squares are written as weighted sums
+over subjects, where the weights are how many times each subject was
+drawn, so every bootstrap sample for every edge comes out of a few
+matrix products rather than a loop.
+'''
+
+#=============================================================================
+# IMPORTS
+#=============================================================================
+import os
+import sys
+import argparse
+import numpy as np
+
+#=============================================================================
+# FUNCTIONS
+#=============================================================================
+
+# Set up the argparser so you can read arguments from the command line
+def setup_argparser():
+    '''
+    # Code to read in arguments from the command line
+    # Also allows you to change some settings
+    '''
+
+    # Build a basic parser.
+    help_text = ('Calculate the test-retest reliability of connectivity matrices or ROI values')
+
+    sign_off = 'Author: Kirstie Whitaker <kw401@cam.ac.uk>'
+
+    parser = argparse.ArgumentParser(description=help_text, epilog=sign_off)
+
+    # Now add the arguments
+    # Required argument: data_dir
+    parser.add_argument(dest='data_dir',
+                            type=str,
+                            metavar='data_dir',
+                            help='Data directory (containing SUB_DATA)')
+
+    # Required argument: file_template
+    parser.add_argument(dest='file_template',
+                            type=str,
+                            metavar='file_template',
+                            help=('Path to the matrix or stats file inside each subject dir'
+                                    ' with {occ} for the occasion'
+                                    ' eg: DTI/MRI{occ}/CONNECTIVITY/Msym.txt'))
+
+    # Optional argument: occasions
+    parser.add_argument('--occasions',
+                            dest='occasions',
+                            type=str,
+                            nargs='+',
+                            help='occasions to compare',
+                            default=['0', '1'],
+                            action='store')
+
+    # Optional argument: column
+    parser.add_argument('--column',
+                            dest='column',
+                            type=str,
+                            help=('column of the stats files to compare'
+                                    ' (eg: Mean for mri_segstats, ThickAvg or'
+                                    ' GrayVol for mris_anatomical_stats)'),
+                            default='Mean',
+                            action='store')
+
+    # Optional argument: n_boot
+    parser.add_argument('--n_boot',
+                            dest='n_boot',
+                            type=int,
+                            help='number of bootstrap samples',
+                            default=1000,
+                            action='store')
+
+    # Optional argument: seed
+    parser.add_argument('--seed',
+                            dest='seed',
+                            type=int,
+                            help='random seed for the bootstrap',
+                            default=0,
+                            action='store')
+
+    arguments = parser.parse_args()
+
+    return arguments, parser
+
+#-----------------------------------------------------------------------------
+
+def find_paired_files(data_dir, file_template, occasions):
+    '''
+    Find the subjects in data_dir/SUB_DATA who have a file for every
+    occasion. Returns the list of subject ids and a list (one entry
+    per subject) of lists of files (one per occasion).
+    '''
+    sub_data_dir = os.path.join(data_dir, 'SUB_DATA')
+
+    subs = []
+    file_lists = []
+    for sub in sorted(os.listdir(sub_data_dir)):
+        files = [ os.path.join(sub_data_dir, sub, file_template.format(occ=occ))
+                        for occ in occasions ]
+        if all([ os.path.isfile(f) for f in files ]):
+            subs.append(sub)
+            file_lists.append(files)
+
+    return subs, file_lists
+
+#-----------------------------------------------------------------------------
+
+def stats_columns(stats_file):
+    '''
+    The column headers of a FreeSurfer .stats file
+    '''
+    for line in open(stats_file):
+        if line.startswith('# ColHeaders'):
+            return line.split()[2:]
+    return []
+
+#-----------------------------------------------------------------------------
+
+def read_segstats(stats_file, column='Mean'):
+    '''
+    Read the StructName and one column (Mean by default) from a
+    FreeSurfer .stats file (from mri_segstats or mris_anatomical_stats)
+    '''
+    headers = stats_columns(stats_file)
+    if 'StructName' not in headers or column not in headers:
+        raise ValueError('Column {} not found in {}. The columns are: {}'.format(
+                            column, stats_file, ', '.join(headers)))
+    name_col = headers.index('StructName')
+    value_col = headers.index(column)
+
+    names = []
+    values = []
+    for line in open(stats_file):
+        if line.strip() and not line.startswith('#'):
+            parts = line.split()
+            names.append(parts[name_col])
+            values.append(float(parts[value_col]))
+
+    return names, np.array(values)
+
+#-----------------------------------------------------------------------------
+
+def load_features(file_lists, column='Mean'):
+    '''
+    Load everybody's data into a (n_subs, n_occasions, n_features) array.
+    Square matrices are reduced to the edges in their top triangle.
+    Returns the array, the feature names (for stats files) or the
+    matrix size (for matrices).
+
+    The ROIs in stats files are matched up by their StructName, and
+    only the ones that are in every file are kept (in the order of the
+    first file).
+    '''
+    if file_lists and file_lists[0][0].endswith('.stats'):
+        stats = [ [ read_segstats(f, column=column) for f in files ]
+                        for files in file_lists ]
+
+        first_names = stats[0][0][0]
+        common = set(first_names)
+        all_names = set()
+        for row in stats:
+            for roi_names, _ in row:
+                common &= set(roi_names)
+                all_names |= set(roi_names)
+
+        names = [ name for name in first_names if name in common ]
+        dropped = sorted(all_names - common)
+        if dropped:
+            print('Dropping {} ROIs that are not in every stats file: {}'.format(
+                        len(dropped), ', '.join(dropped)))
+
+        Y = []
+        for row in stats:
+            Y.append([ [ dict(zip(roi_names, values))[name] for name in names ]
+                            for roi_names, values in row ])
+
+        return np.array(Y, dtype=float), names, None
+
+    Y = []
+    n = None
+    for files in file_lists:
+        row = []
+        for f in files:
+            M = np.loadtxt(f)
+            n = M.shape[0]
+            row.append(M[np.triu_indices(n, 1)])
+        Y.append(row)
+
+    return np.array(Y, dtype=float), None, n
+
+#-----------------------------------------------------------------------------
+
+def icc(Y, W=None):
+    '''
+    ICC(2,1) and ICC(3,1) for every feature of Y, an
+    (n_subs, n_occasions, n_features) array.
+
+    W is an optional (n_samples, n_subs) array of how many times each
+    subject is included in each (bootstrap) sample. The default is
+    everybody once. Returns two (n_samples, n_features) arrays.
+    '''
+    Y = np.asarray(Y, dtype=float)
+    n, k, F = Y.shape
+    if W is None:
+        W = np.ones([1, n])
+    W = np.asarray(W, dtype=float)
+
+    # Subject means and the deviations of each occasion from them
+    row_mean = Y.mean(axis=1)
+    Z = Y - row_mean[:, np.newaxis, :]
+
+    # Between subjects
+    grand = W.dot(row_mean) / n
+    SSR = k * (W.dot(row_mean ** 2) - n * grand ** 2)
+
+    # Between occasions and the residuals
+    SSC = np.zeros_like(grand)
+    SSE = np.zeros_like(grand)
+    for j in range(k):
+        z_bar = W.dot(Z[:, j, :]) / n
+        SSC += n * z_bar ** 2
+        SSE += W.dot(Z[:, j, :] ** 2) - n * z_bar ** 2
+
+    MSR = SSR / (n - 1)
+    MSC = SSC / (k - 1)
+    MSE = SSE / ((n - 1) * (k - 1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        icc21 = (MSR - MSE) / (MSR + (k - 1) * MSE + k * (MSC - MSE) / n)
+        icc31 = (MSR - MSE) / (MSR + (k - 1) * MSE)
+
+    return icc21, icc31
+
+#-----------------------------------------------------------------------------
+
+def bootstrap_icc(Y, n_boot=1000, seed=0, chunk_size=100, ci=95):
+    '''
+    Percentile bootstrap confidence intervals for ICC(2,1) and ICC(3,1)
+    by resampling the subjects. Returns a dictionary of
+    (n_features,) arrays.
+    '''
+    n = Y.shape[0]
+    rs = np.random.RandomState(seed)
+
+    boot21 = []
+    boot31 = []
+    for start in range(0, n_boot, chunk_size):
+        n_chunk = min(chunk_size, n_boot - start)
+        draws = rs.randint(n, size=(n_chunk, n))
+        W = np.array([ np.bincount(d, minlength=n) for d in draws ])
+        icc21, icc31 = icc(Y, W)
+        boot21.append(icc21)
+        boot31.append(icc31)
+
+    boot21 = np.vstack(boot21)
+    boot31 = np.vstack(boot31)
+
+    icc21, icc31 = icc(Y)
+    alpha = (100 - ci) / 2.0
+
+    results = {}
+    results['ICC21'] = icc21[0]
+    results['ICC31'] = icc31[0]
+    results['ICC21_lower'], results['ICC21_upper'] = np.nanpercentile(boot21,
+                                                            [alpha, 100 - alpha], axis=0)
+    results['ICC31_lower'], results['ICC31_upper'] = np.nanpercentile(boot31,
+                                                            [alpha, 100 - alpha], axis=0)
+
+    return results
+
+#-----------------------------------------------------------------------------
+
+def save_mat(M, M_text_name):
+    # Save the matrix as a text file
+    # NOTE THAT THIS IS NOT THE SAME
+    # COMMAND AS IN calculate_connectivity_matrix.py
+    np.savetxt(M_text_name,
+                   M[:,:],
+                   fmt='%.5f',
+                   delimiter='\t',
+                   newline='\n')
+
+#=============================================================================
+# Define some variables
+#=============================================================================
+if __name__ == '__main__':
+    # Read in the arguments from argparse
+    arguments, parser = setup_argparser()
+
+    data_dir = arguments.data_dir
+    file_template = arguments.file_template
+
+    subs, file_lists = find_paired_files(data_dir, file_template, arguments.occasions)
+    print('Found {} subjects with data at all occasions'.format(len(subs)))
+
+    if not file_lists:
+        sys.exit('No subjects have a {} file at every occasion'.format(file_template))
+
+    # Check that the stats files have the column you asked for
+    if file_lists[0][0].endswith('.stats'):
+        headers = stats_columns(file_lists[0][0])
+        if 'StructName' not in headers or arguments.column not in headers:
+            sys.exit('Column {} not found in {}. The columns are: {}'.format(
+                        arguments.column, file_lists[0][0], ', '.join(headers)))
+
+    Y, names, n = load_features(file_lists, column=arguments.column)
+
+    results = bootstrap_icc(Y, n_boot=arguments.n_boot, seed=arguments.seed)
+
+    # Name the output files after the input file
+    basename = os.path.splitext(os.path.basename(file_template))[0]
+    output_dir = os.path.join(data_dir, 'RELIABILITY')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    keys = [ 'ICC21', 'ICC21_lower', 'ICC21_upper',
+                'ICC31', 'ICC31_lower', 'ICC31_upper' ]
+
+    if names is None:
+        # Put the edges back into (symmetric) matrices
+        for key in keys:
+            M = np.zeros([n, n])
+            M[np.triu_indices(n, 1)] = results[key]
+            M = M + M.T
+            save_mat(M, os.path.join(output_dir, '{}_{}.txt'.format(basename, key)))
+    else:
+        csv_name = os.path.join(output_dir, '{}_ICC.csv'.format(basename))
+        with open(csv_name, 'w') as f:
+            f.write(','.join(['StructName'] + keys) + '\n')
+            for i, name in enumerate(names):
+                values = [ '{:.5f}'.format(results[key][i]) for key in keys ]
+                f.write(','.join([name] + values) + '\n')
+
+    with open(os.path.join(output_dir, '{}_subs.txt'.format(basename)), 'w') as f:
+        f.write('\n'.join(subs) + '\n')
@@ -13,9 +13,9 @@ difficulty calculating the correct value
 # IMPORTS
 #=============================================================================
 import numpy as np
-import matplotlib.pylab as plt
 import argparse
 import os
+from matrix_png import save_matrix_png
 
 #=============================================================================
 # FUNCTIONS
@@ -110,17 +110,8 @@ def save_png(M, M_fig_name):
     # NOTE THAT THIS IS NOT THE SAME
     # COMMAND AS IN calculate_connectivity_matrix.py
     if not os.path.exists(M_fig_name):
-
-        fig, ax = plt.subplots(figsize=(4,4))    
         # Plot the matrix on a log scale
-        axM = ax.imshow(np.log1p(M[:,:]), 
-                        interpolation='nearest',
-                        cmap='jet')
-        
-        # Add a colorbar
-        cbar = fig.colorbar(axM)
-
-        fig.savefig(M_fig_name, bbox_inches=0, dpi=600)
+        save_matrix_png(np.log1p(M[:,:]), M_fig_name)
     
 #=============================================================================
 # Define some variables